@@ -0,0 +1,212 @@
+"""Bulk loader for the formatted to_sql_* CSVs (or DataFrames of the same shape).
+
+Every source is streamed with COPY FROM STDIN into a temporary staging table and
+merged into its target table, all in a single transaction.
+
+    python -m app.api.bulk_load --dbname QLKTDB --user dev --host localhost \\
+        --fields ../source/data/formatted/csv/to_sql_fields.csv \\
+        --plan ../source/data/formatted/csv/to_sql_planning_prod.csv \\
+        --daily ../source/data/formatted/csv/to_sql_daily_prod.csv
+"""
+import argparse
+import csv
+import io
+import os
+import time
+
+import pandas as pd
+import psycopg2
+
+from .field_metadata import field_metadata, print_missing_layout_fields, read_field_metadata
+
+# Target table -> column types, primary key and CSV header names that differ from the column names
+TABLES = {
+    'field': {
+        'columns': {
+            'field_id': 'VARCHAR',
+            'field_name': 'VARCHAR',
+            'unit': 'VARCHAR',
+            'field_type': 'VARCHAR',
+            'conversion_factor': 'FLOAT',
+        },
+        'key': ('field_id', 'field_type'),
+        'csv_names': {'short_name': 'field_id', 'full_name': 'field_name', 'prod_type': 'field_type'},
+    },
+    'plan_prod': {
+        'columns': {
+            'field_id': 'VARCHAR',
+            'report_date': 'DATE',
+            'plan_type': 'VARCHAR',
+            'prod_ton': 'FLOAT',
+            'prod_bbls': 'FLOAT',
+            'prod_m3': 'FLOAT',
+            'prod_ft3': 'FLOAT',
+        },
+        'key': ('field_id', 'report_date', 'plan_type'),
+        'csv_names': {},
+    },
+    'daily_prod': {
+        'columns': {
+            'field_id': 'VARCHAR',
+            'report_date': 'DATE',
+            'prod_type': 'VARCHAR',
+            'prod_ton': 'FLOAT',
+            'prod_bbls': 'FLOAT',
+            'prod_m3': 'FLOAT',
+            'prod_ft3': 'FLOAT',
+        },
+        'key': ('field_id', 'report_date', 'prod_type'),
+        'csv_names': {},
+    },
+}
+
+# Load order, so a full reload replaces field definitions before production rows
+LOAD_ORDER = ('field', 'plan_prod', 'daily_prod')
+
+# Rows per chunk when a DataFrame is rendered to CSV for COPY
+DATAFRAME_CHUNK_ROWS = 10000
+
+
+class _ChunkReader(io.RawIOBase):
+    # Read-only file object over an iterator of str chunks, so COPY can stream a DataFrame
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks).encode("utf-8")
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+def _dataframe_chunks(df):
+    for start in range(0, len(df), DATAFRAME_CHUNK_ROWS):
+        chunk = df.iloc[start:start + DATAFRAME_CHUNK_ROWS]
+        yield chunk.to_csv(index=False, header=start == 0, date_format="%Y-%m-%d")
+    if len(df) == 0:
+        yield df.to_csv(index=False)
+
+
+def _open_source(source):
+    # (header, file object positioned at the header line) of a CSV path or a DataFrame
+    if isinstance(source, pd.DataFrame):
+        return list(source.columns), io.BufferedReader(_ChunkReader(_dataframe_chunks(source)))
+    f = open(source, "rb")
+    header = next(csv.reader([f.readline().decode("utf-8-sig")]))
+    f.seek(0)
+    return header, f
+
+
+def copy_table(cur, table_name, source, replace=False):
+    # Stream one CSV/DataFrame into table_name through a staging table, returns the number of rows staged.
+    # With replace=True the table is emptied first, otherwise rows are upserted on the primary key.
+    spec = TABLES[table_name]
+    header, f = _open_source(source)
+    try:
+        stage_columns = [spec['csv_names'].get(name, name) for name in header]
+        missing = set(spec['key']) - set(stage_columns)
+        if missing:
+            raise ValueError(f"{table_name} source is missing key columns {sorted(missing)}")
+        stage = f"_stage_{table_name}"
+        # Everything lands as text, then it is cast on the way into the target table
+        cur.execute(f"""
+            CREATE TEMP TABLE {stage} ({", ".join(f'"{column}" TEXT' for column in stage_columns)}) ON COMMIT DROP;
+        """)
+        cur.copy_expert(f"COPY {stage} FROM STDIN WITH (FORMAT csv, HEADER true)", f)
+    finally:
+        f.close()
+
+    columns = [column for column in spec['columns'] if column in stage_columns]
+    updates = [column for column in columns if column not in spec['key']]
+    if replace:
+        cur.execute(f"DELETE FROM {table_name};")
+    cur.execute(f"""
+        INSERT INTO {table_name} ({", ".join(columns)})
+        SELECT {", ".join(f"CAST(NULLIF({column}, '') AS {spec['columns'][column]})" for column in columns)}
+        FROM {stage}
+        ON CONFLICT ({", ".join(spec['key'])}) DO {"UPDATE SET " + ", ".join(f"{column} = EXCLUDED.{column}" for column in updates) if updates else "NOTHING"};
+    """)
+    cur.execute(f"SELECT COUNT(*) FROM {stage};")
+    return cur.fetchone()[0]
+
+
+def bulk_load(conn, fields=None, plan_prod=None, daily_prod=None, replace=False):
+    # Load any of the three sources (CSV path or DataFrame) in one transaction
+    # -> {table_name: {'rows': ..., 'seconds': ..., 'rows_per_second': ...}}
+    sources = {'field': fields, 'plan_prod': plan_prod, 'daily_prod': daily_prod}
+    stats = {}
+    try:
+        with conn.cursor() as cur:
+            # to_sql_* CSVs write dates as dd/mm/yyyy
+            cur.execute("SET LOCAL datestyle = 'ISO, DMY';")
+            for table_name in LOAD_ORDER:
+                source = sources[table_name]
+                if source is None:
+                    continue
+                start = time.perf_counter()
+                rows = copy_table(cur, table_name, source, replace=replace)
+                seconds = time.perf_counter() - start
+                stats[table_name] = {
+                    'rows': rows,
+                    'seconds': seconds,
+                    'rows_per_second': rows / seconds if seconds > 0 else float('inf'),
+                }
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if 'field' in stats:
+        field_metadata.invalidate((conn.info.host, conn.info.port, conn.info.dbname))
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk load the formatted to_sql_* CSVs with COPY")
+    parser.add_argument("--dbname", default=os.environ.get("POSTGRES_DB"))
+    parser.add_argument("--user", default=os.environ.get("POSTGRES_USER"))
+    parser.add_argument("--password", default=os.environ.get("POSTGRES_PASSWORD"))
+    parser.add_argument("--host", default=os.environ.get("HOST", "localhost"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 5432)))
+    parser.add_argument("--fields", help="to_sql_fields.csv")
+    parser.add_argument("--plan", help="to_sql_planning_prod.csv")
+    parser.add_argument("--daily", help="to_sql_daily_prod.csv")
+    parser.add_argument("--replace", action="store_true", help="empty each loaded table first instead of upserting")
+    args = parser.parse_args(argv)
+    if not (args.fields or args.plan or args.daily):
+        parser.error("nothing to load, pass --fields, --plan and/or --daily")
+
+    conn = psycopg2.connect(
+        host=args.host,
+        port=args.port,
+        dbname=args.dbname,
+        user=args.user,
+        password=args.password
+    )
+    try:
+        start = time.perf_counter()
+        stats = bulk_load(conn, fields=args.fields, plan_prod=args.plan, daily_prod=args.daily, replace=args.replace)
+        total = time.perf_counter() - start
+        if args.fields:
+            with conn.cursor() as cur:
+                layout_metadata = read_field_metadata(cur)
+            conn.commit()
+    finally:
+        conn.close()
+    for table_name, s in stats.items():
+        print(f"{table_name}: {s['rows']} rows in {s['seconds']:.3f}s ({s['rows_per_second']:.0f} rows/s)")
+    print(f"Committed in {total:.3f}s")
+    if args.fields:
+        print_missing_layout_fields(layout_metadata, args.dbname)
+
+
+if __name__ == "__main__":
+    main()
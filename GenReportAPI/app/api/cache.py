@@ -0,0 +1,143 @@
+import asyncio
+import os
+import threading
+from collections import OrderedDict
+
+from .metrics import REPORT_FLIGHTS
+from .pgdb_async import AsyncPGReportQuery, generate_oil_gas_reports_async
+from .report_engine import to_date
+
+# Maximum number of cached reports, least recently used ones are evicted first
+REPORT_CACHE_SIZE = int(os.environ.get("REPORT_CACHE_SIZE", 256))
+
+
+class ReportCache:
+    def __init__(self, max_entries=REPORT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (watermark, report)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, watermark):
+        # Cached report of key if it was built at the same data watermark, else None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != watermark:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, watermark, report):
+        with self._lock:
+            self._entries[key] = (watermark, report)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses}
+
+
+report_cache = ReportCache()
+
+
+class SingleFlight:
+    # Concurrent calls of the same key await one in-flight coroutine and share its result
+    def __init__(self):
+        self._flights = {}  # key -> task of the running event loop
+
+    async def run(self, key, build):
+        # Result of build() for key, started by the first caller and joined by the others until it finishes
+        loop = asyncio.get_running_loop()
+        task = self._flights.get(key)
+        if task is None or task.get_loop() is not loop:
+            task = loop.create_task(build())
+            self._flights[key] = task
+            task.add_done_callback(lambda done: self._land(key, done))
+            REPORT_FLIGHTS.labels("built").inc()
+        else:
+            REPORT_FLIGHTS.labels("coalesced").inc()
+        # A caller that goes away must not cancel the build the others are waiting for
+        return await asyncio.shield(task)
+
+    def _land(self, key, task):
+        # A finished flight is forgotten, so the next caller starts a fresh build (or retries a failed one)
+        if self._flights.get(key) is task:
+            del self._flights[key]
+
+    def __len__(self):
+        return len(self._flights)
+
+
+report_flights = SingleFlight()
+
+
+def report_cache_key(HOST, PORT, POSTGRES_DB, POSTGRES_USER, kind, query_date):
+    # Per role as well as per database: privileges, row-level security and search_path can
+    # give two users of one database different reports, as the pool keys already assume
+    return (HOST, int(PORT), POSTGRES_DB, POSTGRES_USER, kind, to_date(query_date))
+
+
+async def cached_report_async(kind, generate, query_date,
+                    POSTGRES_DB,
+                    POSTGRES_USER,
+                    POSTGRES_PASSWORD,
+                    HOST,
+                    PORT):
+    # Report of `kind` for query_date from the cache while daily_prod/plan_prod have not changed
+    # for that date, otherwise built with generate(query_date, POSTGRES_DB, ...) and cached.
+    # Concurrent requests for the same report and data watermark share one build.
+    # The key parses query_date, so a malformed date fails before any connection is opened
+    key = report_cache_key(HOST, PORT, POSTGRES_DB, POSTGRES_USER, kind, query_date)
+    PGDB = await AsyncPGReportQuery.connect(POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, HOST, PORT)
+    watermark = await PGDB.get_data_watermark(query_date)
+    if watermark is not None:
+        report = report_cache.get(key, watermark)
+        if report is not None:
+            return report.copy()
+
+    async def build():
+        report = await generate(query_date, POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, HOST, PORT)
+        if watermark is not None:
+            report_cache.put(key, watermark, report)
+        return report
+
+    # Callers get their own copy, the cached frame is never mutated
+    return (await report_flights.run((key, watermark), build)).copy()
+
+
+async def cached_oil_gas_reports_async(query_date,
+                    POSTGRES_DB,
+                    POSTGRES_USER,
+                    POSTGRES_PASSWORD,
+                    HOST,
+                    PORT):
+    # Typed oil and gas reports of one data version. Served from the "oil_values"/"gas_values"
+    # entries when both are current, otherwise built together in one snapshot and cached.
+    keys = [report_cache_key(HOST, PORT, POSTGRES_DB, POSTGRES_USER, kind, query_date) for kind in ("oil_values", "gas_values")]
+    PGDB = await AsyncPGReportQuery.connect(POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, HOST, PORT)
+    watermark = await PGDB.get_data_watermark(query_date)
+    if watermark is not None:
+        reports = [report_cache.get(key, watermark) for key in keys]
+        if all(report is not None for report in reports):
+            return [report.copy() for report in reports]
+
+    async def build():
+        # The snapshot's own watermark, so the entries are tagged with the data they were built from
+        built_watermark, oil, gas = await generate_oil_gas_reports_async(query_date, POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, HOST, PORT, formatted=False)
+        if built_watermark is not None:
+            for key, report in zip(keys, (oil, gas)):
+                report_cache.put(key, built_watermark, report)
+        return oil, gas
+
+    flight_key = report_cache_key(HOST, PORT, POSTGRES_DB, POSTGRES_USER, "oil_gas_values", query_date)
+    oil, gas = await report_flights.run((flight_key, watermark), build)
+    return [oil.copy(), gas.copy()]
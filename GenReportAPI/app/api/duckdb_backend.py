@@ -0,0 +1,176 @@
+"""Embedded DuckDB backend: reports straight from the formatted to_sql_* CSVs or Parquet files.
+
+The files are loaded into an in-process DuckDB database with the field, plan_prod and
+daily_prod tables of Postgres, and the same report queries run against it:
+
+    from app.api.duckdb_backend import DuckDBReportQuery
+    from app.api.pgdb import oil_report
+
+    with DuckDBReportQuery() as db:
+        db.load(fields="to_sql_fields.csv", plan_prod="to_sql_planning_prod.csv", daily_prod="to_sql_daily_prod.csv")
+        report = oil_report(db, "2025/07/01")
+
+or from the command line, one CSV for a single date or a backfill range:
+
+    python -m app.api.duckdb_backend --fields ../source/data/formatted/csv/to_sql_fields.csv \\
+        --plan ../source/data/formatted/csv/to_sql_planning_prod.csv \\
+        --daily ../source/data/formatted/csv/to_sql_daily_prod.csv \\
+        --report oil --date 2025/07/01 --end-date 2025/07/31 --engine vector --output oil_july.csv
+"""
+import argparse
+import functools
+from datetime import timedelta
+
+import pandas as pd
+
+from .bulk_load import LOAD_ORDER, TABLES
+from .pgdb import format_report, gas_report, gas_report_w_latest_data, oil_report, oil_report_w_latest_data
+from .report_engine import SQL_PARAMETER, to_date
+from .report_query import ReportQuery
+from .vector_engine import iter_report_backfill
+
+# Optional, only offline reporting needs it
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# Postgres FLOAT is double precision, DuckDB FLOAT is single
+DUCKDB_TYPES = {'FLOAT': 'DOUBLE'}
+# to_sql_* CSVs write dd/mm/yyyy, files written by pandas use ISO dates
+CSV_DATE_FORMATS = ['%d/%m/%Y', '%Y-%m-%d']
+
+REPORTS = {
+    ('oil', False): oil_report,
+    ('gas', False): gas_report,
+    ('oil', True): oil_report_w_latest_data,
+    ('gas', True): gas_report_w_latest_data,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def duckdb_sql(sql):
+    # %(name)s query -> ($name query, names of its parameters)
+    return SQL_PARAMETER.sub(r"$\1", sql), tuple(dict.fromkeys(SQL_PARAMETER.findall(sql)))
+
+
+def _table_ddl(table_name):
+    spec = TABLES[table_name]
+    columns = [f"{column} {DUCKDB_TYPES.get(sql_type, sql_type)}" for column, sql_type in spec['columns'].items()]
+    return f"CREATE TABLE IF NOT EXISTS {table_name} ({', '.join(columns)}, PRIMARY KEY ({', '.join(spec['key'])}));"
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+class DuckDBReportQuery(ReportQuery):
+    # ReportQuery backend on an embedded DuckDB database, in memory unless a file is given
+    def __init__(self, database=":memory:"):
+        if duckdb is None:
+            raise ImportError("DuckDBReportQuery needs the duckdb package")
+        self.conn = duckdb.connect(database)
+        for table_name in LOAD_ORDER:
+            self.conn.execute(_table_ddl(table_name))
+
+    def close(self):
+        if self.conn is None:
+            return
+        self.conn.close()
+        self.conn = None
+
+    def query(self, sql, params=None):
+        sql, names = duckdb_sql(sql)
+        cur = self.conn.execute(sql, {name: params[name] for name in names} if names else None)
+        return [d[0] for d in cur.description], cur.fetchall()
+
+    def load_table(self, table_name, source):
+        # Upsert one CSV/Parquet path or DataFrame into table_name, returns the number of rows read.
+        # CSVs are read as text and cast like the Postgres bulk loader does.
+        spec = TABLES[table_name]
+        if isinstance(source, pd.DataFrame):
+            self.conn.register("_source", source)
+            relation, text = "_source", False
+        elif str(source).lower().endswith(".parquet"):
+            relation, text = f"read_parquet('{str(source).replace(chr(39), chr(39) * 2)}')", False
+        else:
+            relation, text = f"read_csv('{str(source).replace(chr(39), chr(39) * 2)}', header = true, all_varchar = true)", True
+        try:
+            header = [row[0] for row in self.conn.execute(f"DESCRIBE SELECT * FROM {relation}").fetchall()]
+            source_columns = {spec['csv_names'].get(name, name): name for name in header}
+            missing = set(spec['key']) - set(source_columns)
+            if missing:
+                raise ValueError(f"{table_name} source is missing key columns {sorted(missing)}")
+
+            columns = [column for column in spec['columns'] if column in source_columns]
+            values = []
+            for column in columns:
+                sql_type = DUCKDB_TYPES.get(spec['columns'][column], spec['columns'][column])
+                value = _quote(source_columns[column])
+                if text:
+                    value = f"NULLIF({value}, '')"
+                    if sql_type == 'DATE':
+                        value = f"try_strptime({value}, {CSV_DATE_FORMATS})"
+                values.append(f"CAST({value} AS {sql_type})")
+            self.conn.execute(f"""
+                INSERT OR REPLACE INTO {table_name} ({", ".join(columns)})
+                SELECT {", ".join(values)} FROM {relation};
+            """)
+            return self.conn.execute(f"SELECT COUNT(*) FROM {relation}").fetchone()[0]
+        finally:
+            if relation == "_source":
+                self.conn.unregister("_source")
+
+    def load(self, fields=None, plan_prod=None, daily_prod=None):
+        # Load any of the three sources -> {table_name: rows read}
+        sources = {'field': fields, 'plan_prod': plan_prod, 'daily_prod': daily_prod}
+        return {
+            table_name: self.load_table(table_name, sources[table_name])
+            for table_name in LOAD_ORDER if sources[table_name] is not None
+        }
+
+
+def report_dates(start_date, end_date=None):
+    start_date = to_date(start_date)
+    end_date = to_date(end_date) if end_date is not None else start_date
+    if end_date < start_date:
+        raise ValueError("end_date is before start_date")
+    return [start_date + timedelta(days=n) for n in range((end_date - start_date).days + 1)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate reports from the formatted CSV/Parquet files, without a database server")
+    parser.add_argument("--fields", required=True, help="to_sql_fields.csv or .parquet")
+    parser.add_argument("--plan", required=True, help="to_sql_planning_prod.csv or .parquet")
+    parser.add_argument("--daily", required=True, help="to_sql_daily_prod.csv or .parquet")
+    parser.add_argument("--report", choices=("oil", "gas"), default="oil")
+    parser.add_argument("--date", required=True, help="report date, %%Y/%%m/%%d")
+    parser.add_argument("--end-date", help="last report date of a backfill range, %%Y/%%m/%%d")
+    parser.add_argument("--latest", action="store_true", help="compute each row at its latest complete date")
+    parser.add_argument("--engine", choices=("sql", "vector"), default="sql",
+                        help="report queries per date, or one snapshot and vectorized columns for all dates")
+    parser.add_argument("--database", default=":memory:", help="DuckDB file to load into and keep")
+    parser.add_argument("--output", required=True, help="CSV file to write")
+    args = parser.parse_args(argv)
+
+    dates = report_dates(args.date, args.end_date)
+    generate = REPORTS[(args.report, args.latest)]
+    with DuckDBReportQuery(args.database) as db:
+        for table_name, rows in db.load(fields=args.fields, plan_prod=args.plan, daily_prod=args.daily).items():
+            print(f"{table_name}: {rows} rows")
+        if args.engine == "vector":
+            reports = list(iter_report_backfill(db, args.report, dates, latest=args.latest, formatted=False))
+        else:
+            reports = []
+            for report_date in dates:
+                report = generate(db, report_date.strftime("%Y/%m/%d"), formatted=False)
+                report.insert(0, 'Ngày báo cáo', report_date.strftime("%d/%m/%Y"))
+                reports.append(report)
+        if len(dates) == 1:
+            reports[0] = reports[0].drop(columns='Ngày báo cáo')
+    format_report(pd.concat(reports, ignore_index=True)).to_csv(args.output, index=False)
+    print(f"Wrote {len(dates)} report date(s) to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
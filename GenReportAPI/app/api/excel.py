@@ -0,0 +1,106 @@
+import os
+import tempfile
+from contextlib import aclosing
+
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Font
+from openpyxl.utils import get_column_letter
+
+from .pgdb import REPORT_DECIMALS
+
+XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# Bytes per chunk when the finished workbook is sent
+XLSX_CHUNK_SIZE = 64 * 1024
+
+# Column A of the official sheet, the report columns follow from B
+INDEX_HEADER = "TT"
+INDEX_WIDTH = 5
+FIELD_NAME_WIDTH = 30
+VALUE_WIDTH = 14
+
+
+def write_report_sheet(workbook, title, report, decimals=REPORT_DECIMALS):
+    # Append one report (float64 value columns) as a sheet of a write-only workbook:
+    # TT in column A, then the report columns in their order from column B
+    sheet = workbook.create_sheet(title)
+    value_columns = {column for column in report.columns if report[column].dtype == 'float64'}
+    number_format = "0." + "0" * decimals if decimals else "0"
+
+    # Column widths must be set before the first row of a write-only sheet
+    sheet.column_dimensions[get_column_letter(1)].width = INDEX_WIDTH
+    for n, column in enumerate(report.columns, 2):
+        sheet.column_dimensions[get_column_letter(n)].width = VALUE_WIDTH if column in value_columns else FIELD_NAME_WIDTH
+
+    header = []
+    for name in [INDEX_HEADER] + list(report.columns):
+        cell = WriteOnlyCell(sheet, value=name)
+        cell.font = Font(bold=True)
+        cell.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
+        header.append(cell)
+    sheet.append(header)
+
+    columns = list(report.columns)
+    for index, row in enumerate(report.itertuples(index=False, name=None), 1):
+        cells = [index]
+        for column, value in zip(columns, row):
+            if column in value_columns:
+                cell = WriteOnlyCell(sheet, value=float(value))
+                cell.number_format = number_format
+                cells.append(cell)
+            else:
+                cells.append(value)
+        sheet.append(cells)
+
+
+async def write_workbook(sheets):
+    # Async iterator of (sheet title, report) -> path of a temporary .xlsx file.
+    # Rows go straight to the write-only sheets, so only the current report is held in memory,
+    # and openpyxl runs in the threadpool so other requests are served meanwhile.
+    # An .xlsx is a zip whose directory is written when the workbook is saved, and openpyxl
+    # can only save to a file, so no byte can be sent before the last sheet: the workbook is
+    # saved to a temporary file, which xlsx_response then streams and removes.
+    workbook = Workbook(write_only=True)
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        async with aclosing(sheets):
+            async for title, report in sheets:
+                await run_in_threadpool(write_report_sheet, workbook, title, report)
+        await run_in_threadpool(workbook.save, path)
+    except BaseException:
+        # Also when the request is cancelled: nothing of the half-built workbook stays on disk
+        _discard_sheets(workbook)
+        os.remove(path)
+        raise
+    return path
+
+
+def _discard_sheets(workbook):
+    # Remove the temporary files the write-only sheets of an unsaved workbook hold their rows in,
+    # which save() would have moved into the .xlsx
+    for sheet in workbook.worksheets:
+        writer = getattr(sheet, "_writer", None)
+        if writer is not None and os.path.exists(writer.out):
+            sheet.close()
+            writer.cleanup()
+
+
+class TemporaryFileResponse(FileResponse):
+    # Sends a temporary file and removes it however the response ends: sent, failed, or
+    # abandoned by a client that went away before the body started
+    chunk_size = XLSX_CHUNK_SIZE
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            os.remove(self.path)
+
+
+def xlsx_response(path, filename):
+    response = TemporaryFileResponse(path, media_type=XLSX)
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
@@ -0,0 +1,84 @@
+import os
+import threading
+import time
+from collections import namedtuple
+
+from .report_plan import REPORT_PLANS
+
+# Seconds the field table of a database is trusted before it is read again
+FIELD_METADATA_TTL = float(os.environ.get("FIELD_METADATA_TTL", 300))
+
+FIELD_METADATA_SQL = "SELECT * FROM field;"
+
+# One row of the field table. location is None on databases whose field table has no such column.
+FieldInfo = namedtuple("FieldInfo", ["field_id", "field_type", "field_name", "unit", "conversion_factor", "location"])
+
+# Report layout ids -> field_type they must exist with in the field table
+LAYOUT_FIELDS = {}
+for _report_plan in REPORT_PLANS.values():
+    for _field_type, _field_ids in ((_report_plan.plan_field_type, _report_plan.plan_fields),
+                                    (_report_plan.prod_type, _report_plan.daily_field_ids)):
+        LAYOUT_FIELDS[_field_type] = list(dict.fromkeys(LAYOUT_FIELDS.get(_field_type, []) + _field_ids))
+
+
+def field_metadata_from_rows(columns, rows):
+    # Rows of SELECT * FROM field -> {(field_id, field_type): FieldInfo}
+    metadata = {}
+    for row in rows:
+        values = dict(zip(columns, row))
+        info = FieldInfo(*(values.get(name) for name in FieldInfo._fields))
+        metadata[(info.field_id, info.field_type)] = info
+    return metadata
+
+
+def read_field_metadata(cur):
+    # {(field_id, field_type): FieldInfo} read with a psycopg2 cursor
+    cur.execute(FIELD_METADATA_SQL)
+    return field_metadata_from_rows([d[0] for d in cur.description], cur.fetchall())
+
+
+def missing_layout_fields(metadata):
+    # {field_type: [layout ids without a field row]}, empty when the report specs match the database
+    missing = {}
+    for field_type, field_ids in LAYOUT_FIELDS.items():
+        absent = [field_id for field_id in field_ids if (field_id, field_type) not in metadata]
+        if absent:
+            missing[field_type] = absent
+    return missing
+
+
+def print_missing_layout_fields(metadata, source):
+    # Report rows that will always be 0 or blank
+    for field_type, field_ids in missing_layout_fields(metadata).items():
+        print(f"Report layout fields missing from the {field_type} rows of the field table {source}: {field_ids}")
+
+
+class FieldMetadataCache:
+    # Field table of every database, loaded once and kept for FIELD_METADATA_TTL seconds
+    # or until invalidate() is called after a write to the field table
+    def __init__(self, ttl=FIELD_METADATA_TTL):
+        self.ttl = ttl
+        self._entries = {}  # (host, port, dbname) -> (metadata, loaded_at)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        # Cached metadata of key if still fresh, else None
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[1] < self.ttl:
+            return entry[0]
+        return None
+
+    def put(self, key, metadata):
+        with self._lock:
+            self._entries[key] = (metadata, time.monotonic())
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+field_metadata = FieldMetadataCache()
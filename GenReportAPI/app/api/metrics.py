@@ -0,0 +1,156 @@
+import time
+from contextvars import ContextVar
+
+import psycopg2.extensions
+from prometheus_client import Counter, Histogram
+
+from .field_metadata import FIELD_METADATA_SQL
+from .migrations import SCHEMA_MIGRATIONS_EXISTS_SQL, SCHEMA_VERSION_SQL
+from .report_engine import (
+    COMPLETE_UNITS,
+    DAILY_AGGREGATES_ROLLUP_SQL,
+    DAILY_AGGREGATES_SQL,
+    DAILY_ROWS_SQL,
+    DATA_WATERMARK_SQL,
+    PLAN_AGGREGATES_SQL,
+    PLAN_ROWS_SQL,
+    latest_complete_dates_sql,
+)
+from .report_plan import REPORT_PLANS
+
+# SQL text -> query label, anything else is recorded as "other"
+QUERY_NAMES = {
+    DAILY_AGGREGATES_SQL: "daily_aggregates",
+    DAILY_AGGREGATES_ROLLUP_SQL: "daily_aggregates_rollup",
+    PLAN_AGGREGATES_SQL: "plan_aggregates",
+    DAILY_ROWS_SQL: "daily_rows",
+    PLAN_ROWS_SQL: "plan_rows",
+    DATA_WATERMARK_SQL: "data_watermark",
+    FIELD_METADATA_SQL: "field_metadata",
+    SCHEMA_MIGRATIONS_EXISTS_SQL: "schema_version",
+    SCHEMA_VERSION_SQL: "schema_version",
+}
+for _prod_type in COMPLETE_UNITS:
+    QUERY_NAMES[latest_complete_dates_sql(_prod_type)] = "latest_complete_dates"
+    QUERY_NAMES[latest_complete_dates_sql(_prod_type, indexed=True)] = "latest_complete_dates"
+# Aggregate queries of the compiled report plans, which select only the sums their reports read
+for _report_plan in REPORT_PLANS.values():
+    QUERY_NAMES[_report_plan.daily_sql] = "daily_aggregates"
+    QUERY_NAMES[_report_plan.daily_rollup_sql] = "daily_aggregates_rollup"
+    QUERY_NAMES[_report_plan.plan_sql] = "plan_aggregates"
+
+# Table each report query reads its unit sums from
+QUERY_TABLES = {
+    "daily_aggregates": "daily_prod",
+    "daily_aggregates_rollup": "daily_prod",
+    "daily_rows": "daily_prod",
+    "plan_aggregates": "plan_prod",
+    "plan_rows": "plan_prod",
+}
+
+
+def report_columns_by_selected_column(report_plans):
+    # {(table, selected column): report columns computed from it} of the compiled plans. The
+    # aggregate queries select one column per aggregate key ('mtd_prod_ton'), the row queries
+    # one per unit ('prod_ton'), which feeds every window of that unit.
+    columns = {}
+    for report_plan in report_plans.values():
+        for letter, aggregates in report_plan.column_aggregates.items():
+            for aggregate in aggregates:
+                if aggregate[0] == 'plan':
+                    table, (_, _, window, unit) = "plan_prod", aggregate
+                else:
+                    table, (_, window, unit, _) = "daily_prod", aggregate
+                for selected in (f'{window}_{unit}', unit):
+                    columns.setdefault((table, selected), set()).add(letter)
+    return {key: tuple(sorted(letters)) for key, letters in columns.items()}
+
+
+SELECTED_COLUMN_REPORT_COLUMNS = report_columns_by_selected_column(REPORT_PLANS)
+
+QUERY_SECONDS = Histogram(
+    "report_query_duration_seconds", "Latency of report queries", ["query"],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5),
+)
+QUERY_ROWS = Histogram(
+    "report_query_rows", "Rows returned by report queries", ["query"],
+    buckets=(0, 1, 5, 10, 25, 50, 100, 250, 1000, 10000, 100000),
+)
+COLUMN_QUERIES = Counter(
+    "report_column_queries_total", "Queries issued for each report column", ["column"],
+)
+REPORT_FLIGHTS = Counter(
+    "report_flights_total", "Report requests that started a build or joined one in flight", ["outcome"],
+)
+REQUEST_SECONDS = Histogram(
+    "report_request_duration_seconds", "Latency of report endpoints until the response starts", ["path"],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30),
+)
+
+# {query label: [count, seconds]} of the request being served, for its Server-Timing header
+_request_timings = ContextVar("request_timings", default=None)
+
+
+def label_query(sql, name):
+    # Record sql under the label name, for statements derived from a labelled query
+    QUERY_NAMES[sql] = name
+
+
+def query_name(sql):
+    try:
+        return QUERY_NAMES.get(sql, "other")
+    except TypeError:  # composed statements are not hashable
+        return "other"
+
+
+def query_report_columns(name, columns):
+    # Report columns fed by a query labelled name that selected columns (cursor.description names)
+    table = QUERY_TABLES.get(name)
+    if table is None:
+        return ()
+    return sorted({
+        letter
+        for column in columns
+        for letter in SELECTED_COLUMN_REPORT_COLUMNS.get((table, column), ())
+    })
+
+
+def observe_query(sql, seconds, rows, columns=()):
+    name = query_name(sql)
+    QUERY_SECONDS.labels(name).observe(seconds)
+    QUERY_ROWS.labels(name).observe(max(rows, 0))
+    for letter in query_report_columns(name, columns):
+        COLUMN_QUERIES.labels(letter).inc()
+    timings = _request_timings.get()
+    if timings is not None:
+        entry = timings.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+
+def start_request_timings():
+    # Collect the queries of the current request from here on, returns the dict they land in
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+
+def server_timing_header(timings, total_seconds):
+    # Server-Timing value: one metric per query label plus the whole request, durations in ms
+    parts = [
+        f'{name};dur={seconds * 1000:.2f};desc="{count} queries"'
+        for name, (count, seconds) in sorted(timings.items(), key=lambda item: -item[1][1])
+    ]
+    parts.append(f"total;dur={total_seconds * 1000:.2f}")
+    return ", ".join(parts)
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    # psycopg2 cursor that records the latency and row count of every execute
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            columns = [column.name for column in self.description or ()]
+            observe_query(query, time.perf_counter() - start, self.rowcount, columns)
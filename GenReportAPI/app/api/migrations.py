@@ -0,0 +1,556 @@
+"""Versioned schema migrations for the production database.
+
+Applied migrations are recorded in schema_migrations, so running the command again
+only applies the new ones:
+
+    python -m app.api.migrations --dbname QLKTDB --user dev --host localhost
+    python -m app.api.migrations --dbname QLKTDB --user dev --host localhost --status
+    python -m app.api.migrations --dbname QLKTDB --user dev --host localhost --rebuild-monthly-prod
+    python -m app.api.migrations --dbname QLKTDB --user dev --host localhost --rebuild-complete-dates
+"""
+import argparse
+import os
+import threading
+import time
+
+import psycopg2
+
+from .field_metadata import print_missing_layout_fields, read_field_metadata
+
+# Arbitrary key of the advisory lock that keeps two runners from migrating at once
+MIGRATION_LOCK_ID = 7305194
+# Arbitrary class of the (class, key) advisory locks that serialize the writers of one monthly_prod row
+MONTHLY_PROD_LOCK_CLASS = 7305195
+
+BASE_TABLES_DDL = """
+    CREATE TABLE IF NOT EXISTS field (
+        field_id        VARCHAR,
+        field_name      VARCHAR NOT NULL,
+        unit            VARCHAR,
+        field_type      VARCHAR(10) NOT NULL CHECK (field_type IN ('OIL_PROD', 'GAS_PROD', 'OIL_PLAN', 'GAS_PLAN')),
+        conversion_factor FLOAT,
+        PRIMARY KEY (field_id, field_type)
+    );
+
+    CREATE TABLE IF NOT EXISTS plan_prod (
+        field_id    VARCHAR,
+        report_date DATE NOT NULL,
+        plan_type   VARCHAR(20) NOT NULL,
+        prod_ton    FLOAT,
+        prod_bbls   FLOAT,
+        prod_m3     FLOAT,
+        prod_ft3    FLOAT,
+        PRIMARY KEY (field_id, report_date, plan_type)
+    );
+
+    CREATE TABLE IF NOT EXISTS daily_prod (
+        field_id    VARCHAR,
+        report_date DATE NOT NULL,
+        prod_type   VARCHAR,
+        prod_ton    FLOAT,
+        prod_bbls   FLOAT,
+        prod_m3     FLOAT,
+        prod_ft3    FLOAT,
+        PRIMARY KEY (field_id, report_date, prod_type)
+    );
+"""
+
+# The primary keys lead with (field_id, report_date), which does not serve the
+# "one field and type over a date range" scans of the reports. These do, and carry
+# the units so the aggregates are answered from the index alone.
+REPORT_INDEXES_DDL = """
+    CREATE INDEX IF NOT EXISTS daily_prod_field_type_date_idx
+        ON daily_prod (field_id, prod_type, report_date)
+        INCLUDE (prod_ton, prod_bbls, prod_m3, prod_ft3);
+
+    CREATE INDEX IF NOT EXISTS plan_prod_field_type_date_idx
+        ON plan_prod (field_id, plan_type, report_date)
+        INCLUDE (prod_ton, prod_bbls, prod_m3, prod_ft3);
+"""
+
+# Change sequence per (table, report_date), bumped by statement triggers on every
+# write to daily_prod and plan_prod. Report caches compare it to detect stale dates.
+DATA_VERSION_DDL = """
+    CREATE SEQUENCE IF NOT EXISTS data_version_seq;
+
+    CREATE TABLE IF NOT EXISTS data_version (
+        table_name  VARCHAR,
+        report_date DATE NOT NULL,
+        version     BIGINT NOT NULL,
+        PRIMARY KEY (table_name, report_date)
+    );
+
+    CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger AS $$
+    DECLARE
+        _version BIGINT := nextval('data_version_seq');
+    BEGIN
+        IF TG_OP = 'TRUNCATE' THEN
+            -- -infinity is before every report date, so all reports become stale
+            INSERT INTO data_version (table_name, report_date, version)
+            VALUES (TG_TABLE_NAME, '-infinity', _version)
+            ON CONFLICT (table_name, report_date) DO UPDATE SET version = EXCLUDED.version;
+            RETURN NULL;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO data_version (table_name, report_date, version)
+            SELECT DISTINCT TG_TABLE_NAME, report_date, _version FROM new_rows
+            ON CONFLICT (table_name, report_date) DO UPDATE SET version = EXCLUDED.version;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            INSERT INTO data_version (table_name, report_date, version)
+            SELECT DISTINCT TG_TABLE_NAME, report_date, _version FROM old_rows
+            ON CONFLICT (table_name, report_date) DO UPDATE SET version = EXCLUDED.version;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+""" + "".join(f"""
+    DROP TRIGGER IF EXISTS {table_name}_version_insert ON {table_name};
+    DROP TRIGGER IF EXISTS {table_name}_version_update ON {table_name};
+    DROP TRIGGER IF EXISTS {table_name}_version_delete ON {table_name};
+    DROP TRIGGER IF EXISTS {table_name}_version_truncate ON {table_name};
+    CREATE TRIGGER {table_name}_version_insert AFTER INSERT ON {table_name}
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+    CREATE TRIGGER {table_name}_version_update AFTER UPDATE ON {table_name}
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+    CREATE TRIGGER {table_name}_version_delete AFTER DELETE ON {table_name}
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+    CREATE TRIGGER {table_name}_version_truncate AFTER TRUNCATE ON {table_name}
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+""" for table_name in ('daily_prod', 'plan_prod'))
+
+# Monthly totals per (field_id, prod_type), so previous-month accumulation is one small
+# indexed read instead of a scan of the daily rows. Statement triggers recompute the
+# months touched by every write to daily_prod.
+MONTHLY_PROD_DDL = """
+    CREATE TABLE IF NOT EXISTS monthly_prod (
+        field_id    VARCHAR,
+        prod_type   VARCHAR,
+        year        INT NOT NULL,
+        month       INT NOT NULL,
+        prod_ton    FLOAT,
+        prod_bbls   FLOAT,
+        prod_m3     FLOAT,
+        prod_ft3    FLOAT,
+        row_count   INT NOT NULL,
+        PRIMARY KEY (field_id, prod_type, year, month)
+    );
+
+    CREATE OR REPLACE FUNCTION refresh_monthly_prod(_field_ids VARCHAR[], _prod_types VARCHAR[], _month_starts DATE[])
+    RETURNS void AS $$
+        WITH keys AS (
+            SELECT DISTINCT * FROM unnest(_field_ids, _prod_types, _month_starts) AS k(field_id, prod_type, month_start)
+        ), sums AS (
+            SELECT k.field_id, k.prod_type,
+                EXTRACT(YEAR FROM k.month_start)::INT AS year,
+                EXTRACT(MONTH FROM k.month_start)::INT AS month,
+                SUM(d.prod_ton) AS prod_ton,
+                SUM(d.prod_bbls) AS prod_bbls,
+                SUM(d.prod_m3) AS prod_m3,
+                SUM(d.prod_ft3) AS prod_ft3,
+                COUNT(d.report_date) AS row_count
+            FROM keys k
+            LEFT JOIN daily_prod d ON d.field_id = k.field_id AND d.prod_type = k.prod_type
+                AND d.report_date >= k.month_start AND d.report_date < (k.month_start + INTERVAL '1 month')::DATE
+            GROUP BY k.field_id, k.prod_type, k.month_start
+        ), emptied AS (
+            DELETE FROM monthly_prod m USING sums s
+            WHERE s.row_count = 0 AND m.field_id = s.field_id AND m.prod_type = s.prod_type
+            AND m.year = s.year AND m.month = s.month
+        )
+        INSERT INTO monthly_prod (field_id, prod_type, year, month, prod_ton, prod_bbls, prod_m3, prod_ft3, row_count)
+        SELECT field_id, prod_type, year, month, prod_ton, prod_bbls, prod_m3, prod_ft3, row_count
+        FROM sums WHERE row_count > 0
+        ON CONFLICT (field_id, prod_type, year, month) DO UPDATE SET
+            prod_ton = EXCLUDED.prod_ton,
+            prod_bbls = EXCLUDED.prod_bbls,
+            prod_m3 = EXCLUDED.prod_m3,
+            prod_ft3 = EXCLUDED.prod_ft3,
+            row_count = EXCLUDED.row_count;
+    $$ LANGUAGE sql;
+
+    CREATE OR REPLACE FUNCTION refresh_monthly_prod_trigger() RETURNS trigger AS $$
+    DECLARE
+        _field_ids VARCHAR[];
+        _prod_types VARCHAR[];
+        _month_starts DATE[];
+    BEGIN
+        IF TG_OP = 'TRUNCATE' THEN
+            DELETE FROM monthly_prod;
+            RETURN NULL;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            SELECT array_agg(field_id), array_agg(prod_type), array_agg(month_start)
+            INTO _field_ids, _prod_types, _month_starts
+            FROM (SELECT DISTINCT field_id, prod_type, date_trunc('month', report_date)::DATE AS month_start FROM new_rows) k;
+            PERFORM refresh_monthly_prod(_field_ids, _prod_types, _month_starts);
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            SELECT array_agg(field_id), array_agg(prod_type), array_agg(month_start)
+            INTO _field_ids, _prod_types, _month_starts
+            FROM (SELECT DISTINCT field_id, prod_type, date_trunc('month', report_date)::DATE AS month_start FROM old_rows) k;
+            PERFORM refresh_monthly_prod(_field_ids, _prod_types, _month_starts);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS daily_prod_monthly_insert ON daily_prod;
+    DROP TRIGGER IF EXISTS daily_prod_monthly_update ON daily_prod;
+    DROP TRIGGER IF EXISTS daily_prod_monthly_delete ON daily_prod;
+    DROP TRIGGER IF EXISTS daily_prod_monthly_truncate ON daily_prod;
+    CREATE TRIGGER daily_prod_monthly_insert AFTER INSERT ON daily_prod
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION refresh_monthly_prod_trigger();
+    CREATE TRIGGER daily_prod_monthly_update AFTER UPDATE ON daily_prod
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION refresh_monthly_prod_trigger();
+    CREATE TRIGGER daily_prod_monthly_delete AFTER DELETE ON daily_prod
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION refresh_monthly_prod_trigger();
+    CREATE TRIGGER daily_prod_monthly_truncate AFTER TRUNCATE ON daily_prod
+        FOR EACH STATEMENT EXECUTE FUNCTION refresh_monthly_prod_trigger();
+"""
+
+# Full recomputation of monthly_prod from daily_prod, for backfills and repairs
+REBUILD_MONTHLY_PROD_SQL = """
+    DELETE FROM monthly_prod;
+    INSERT INTO monthly_prod (field_id, prod_type, year, month, prod_ton, prod_bbls, prod_m3, prod_ft3, row_count)
+    SELECT field_id, prod_type,
+        EXTRACT(YEAR FROM report_date)::INT,
+        EXTRACT(MONTH FROM report_date)::INT,
+        SUM(prod_ton), SUM(prod_bbls), SUM(prod_m3), SUM(prod_ft3), COUNT(*)
+    FROM daily_prod
+    GROUP BY 1, 2, 3, 4;
+"""
+
+# Dates on which a (field_id, prod_type) has a complete daily row, the units of
+# report_engine.COMPLETE_UNITS all present. The latest complete date on or before a
+# report date is then one backward probe of the primary key per field, however many
+# incomplete rows follow it. Statement triggers keep it in step with daily_prod.
+COMPLETE_DATES_DDL = """
+    CREATE TABLE IF NOT EXISTS complete_dates (
+        field_id    VARCHAR,
+        prod_type   VARCHAR,
+        report_date DATE,
+        PRIMARY KEY (field_id, prod_type, report_date)
+    );
+
+    CREATE OR REPLACE FUNCTION refresh_complete_dates_trigger() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'TRUNCATE' THEN
+            DELETE FROM complete_dates;
+            RETURN NULL;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            DELETE FROM complete_dates c USING old_rows o
+            WHERE c.field_id = o.field_id AND c.prod_type = o.prod_type AND c.report_date = o.report_date;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO complete_dates (field_id, prod_type, report_date)
+            SELECT field_id, prod_type, report_date FROM new_rows
+            WHERE (prod_type = 'OIL_PROD' AND prod_ton IS NOT NULL AND prod_bbls IS NOT NULL)
+               OR (prod_type = 'GAS_PROD' AND prod_m3 IS NOT NULL AND prod_ft3 IS NOT NULL)
+            ON CONFLICT DO NOTHING;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS daily_prod_complete_insert ON daily_prod;
+    DROP TRIGGER IF EXISTS daily_prod_complete_update ON daily_prod;
+    DROP TRIGGER IF EXISTS daily_prod_complete_delete ON daily_prod;
+    DROP TRIGGER IF EXISTS daily_prod_complete_truncate ON daily_prod;
+    CREATE TRIGGER daily_prod_complete_insert AFTER INSERT ON daily_prod
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION refresh_complete_dates_trigger();
+    CREATE TRIGGER daily_prod_complete_update AFTER UPDATE ON daily_prod
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION refresh_complete_dates_trigger();
+    CREATE TRIGGER daily_prod_complete_delete AFTER DELETE ON daily_prod
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION refresh_complete_dates_trigger();
+    CREATE TRIGGER daily_prod_complete_truncate AFTER TRUNCATE ON daily_prod
+        FOR EACH STATEMENT EXECUTE FUNCTION refresh_complete_dates_trigger();
+"""
+
+# Full recomputation of complete_dates from daily_prod, for backfills and repairs
+REBUILD_COMPLETE_DATES_SQL = """
+    DELETE FROM complete_dates;
+    INSERT INTO complete_dates (field_id, prod_type, report_date)
+    SELECT field_id, prod_type, report_date FROM daily_prod
+    WHERE (prod_type = 'OIL_PROD' AND prod_ton IS NOT NULL AND prod_bbls IS NOT NULL)
+       OR (prod_type = 'GAS_PROD' AND prod_m3 IS NOT NULL AND prod_ft3 IS NOT NULL);
+"""
+
+# refresh_monthly_prod of version 4 recomputes a month from the writer's READ COMMITTED
+# snapshot, so two transactions writing the same field/product/month each summed only their
+# own rows and the last to commit overwrote the other's. Each refresh now first takes a
+# transaction-level advisory lock per (field_id, prod_type, month), in sorted order, and only
+# then reads the sums: a fresh snapshot taken after the lock, which includes every row of the
+# writer that held it.
+MONTHLY_PROD_LOCKING_DDL = f"""
+    CREATE OR REPLACE FUNCTION refresh_monthly_prod(_field_ids VARCHAR[], _prod_types VARCHAR[], _month_starts DATE[])
+    RETURNS void AS $$
+    DECLARE
+        _key INT;
+    BEGIN
+        FOR _key IN
+            SELECT DISTINCT hashtext(k.field_id || '/' || k.prod_type || '/' || k.month_start)
+            FROM unnest(_field_ids, _prod_types, _month_starts) AS k(field_id, prod_type, month_start)
+            ORDER BY 1
+        LOOP
+            PERFORM pg_advisory_xact_lock({MONTHLY_PROD_LOCK_CLASS}, _key);
+        END LOOP;
+
+        WITH keys AS (
+            SELECT DISTINCT * FROM unnest(_field_ids, _prod_types, _month_starts) AS k(field_id, prod_type, month_start)
+        ), sums AS (
+            SELECT k.field_id, k.prod_type,
+                EXTRACT(YEAR FROM k.month_start)::INT AS year,
+                EXTRACT(MONTH FROM k.month_start)::INT AS month,
+                SUM(d.prod_ton) AS prod_ton,
+                SUM(d.prod_bbls) AS prod_bbls,
+                SUM(d.prod_m3) AS prod_m3,
+                SUM(d.prod_ft3) AS prod_ft3,
+                COUNT(d.report_date) AS row_count
+            FROM keys k
+            LEFT JOIN daily_prod d ON d.field_id = k.field_id AND d.prod_type = k.prod_type
+                AND d.report_date >= k.month_start AND d.report_date < (k.month_start + INTERVAL '1 month')::DATE
+            GROUP BY k.field_id, k.prod_type, k.month_start
+        ), emptied AS (
+            DELETE FROM monthly_prod m USING sums s
+            WHERE s.row_count = 0 AND m.field_id = s.field_id AND m.prod_type = s.prod_type
+            AND m.year = s.year AND m.month = s.month
+        )
+        INSERT INTO monthly_prod (field_id, prod_type, year, month, prod_ton, prod_bbls, prod_m3, prod_ft3, row_count)
+        SELECT field_id, prod_type, year, month, prod_ton, prod_bbls, prod_m3, prod_ft3, row_count
+        FROM sums WHERE row_count > 0
+        ON CONFLICT (field_id, prod_type, year, month) DO UPDATE SET
+            prod_ton = EXCLUDED.prod_ton,
+            prod_bbls = EXCLUDED.prod_bbls,
+            prod_m3 = EXCLUDED.prod_m3,
+            prod_ft3 = EXCLUDED.prod_ft3,
+            row_count = EXCLUDED.row_count;
+    END;
+    $$ LANGUAGE plpgsql;
+"""
+
+# Versions of version 3 come from a sequence, whose order is not commit order: a writer that
+# drew a lower version and committed after one with a higher version left MAX(version)
+# unchanged, and reports cached in between stayed stale. The version of each writing
+# statement now comes from a per-table counter row, locked until the writer commits, so the
+# next writer of the table draws a higher version only after that commit.
+DATA_VERSION_COMMIT_ORDER_DDL = """
+    CREATE TABLE IF NOT EXISTS data_version_counter (
+        table_name  VARCHAR PRIMARY KEY,
+        version     BIGINT NOT NULL
+    );
+
+    CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger AS $$
+    DECLARE
+        _version BIGINT;
+    BEGIN
+        -- Starts above every sequence version already in data_version
+        INSERT INTO data_version_counter (table_name, version)
+        VALUES (TG_TABLE_NAME, nextval('data_version_seq'))
+        ON CONFLICT (table_name) DO UPDATE SET version = data_version_counter.version + 1
+        RETURNING version INTO _version;
+        IF TG_OP = 'TRUNCATE' THEN
+            -- -infinity is before every report date, so all reports become stale
+            INSERT INTO data_version (table_name, report_date, version)
+            VALUES (TG_TABLE_NAME, '-infinity', _version)
+            ON CONFLICT (table_name, report_date) DO UPDATE SET version = EXCLUDED.version;
+            RETURN NULL;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO data_version (table_name, report_date, version)
+            SELECT DISTINCT TG_TABLE_NAME, report_date, _version FROM new_rows
+            ON CONFLICT (table_name, report_date) DO UPDATE SET version = EXCLUDED.version;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            INSERT INTO data_version (table_name, report_date, version)
+            SELECT DISTINCT TG_TABLE_NAME, report_date, _version FROM old_rows
+            ON CONFLICT (table_name, report_date) DO UPDATE SET version = EXCLUDED.version;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+"""
+
+# (version, name, SQL), append only: never edit a migration that has shipped
+MIGRATIONS = [
+    (1, "base tables", BASE_TABLES_DDL),
+    (2, "report covering indexes", REPORT_INDEXES_DDL),
+    (3, "data version watermark", DATA_VERSION_DDL),
+    (4, "monthly production rollup", MONTHLY_PROD_DDL + REBUILD_MONTHLY_PROD_SQL),
+    (5, "complete dates index", COMPLETE_DATES_DDL + REBUILD_COMPLETE_DATES_SQL),
+    # Rebuilt, a month may already have lost rows to the race
+    (6, "serialize monthly rollup writers", MONTHLY_PROD_LOCKING_DDL + REBUILD_MONTHLY_PROD_SQL),
+    (7, "data versions in commit order", DATA_VERSION_COMMIT_ORDER_DDL),
+]
+
+# Schema version from which the data_version watermark is maintained
+WATERMARK_VERSION = 3
+# Schema version from which the report queries read previous months from monthly_prod
+MONTHLY_PROD_VERSION = 4
+# Schema version from which the latest complete dates are looked up in complete_dates
+COMPLETE_DATES_VERSION = 5
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+SCHEMA_MIGRATIONS_EXISTS_SQL = "SELECT to_regclass('schema_migrations');"
+SCHEMA_VERSION_SQL = "SELECT COALESCE(MAX(version), 0) FROM schema_migrations;"
+
+
+def get_schema_version(cur):
+    # Highest applied migration, 0 for a database that was never migrated
+    cur.execute(SCHEMA_MIGRATIONS_EXISTS_SQL)
+    if cur.fetchone()[0] is None:
+        return 0
+    cur.execute(SCHEMA_VERSION_SQL)
+    return cur.fetchone()[0]
+
+
+# Seconds a database's schema version is trusted before it is read again
+SCHEMA_VERSION_TTL = float(os.environ.get("SCHEMA_VERSION_TTL", 60))
+_schema_versions = {}  # (host, port, dbname) -> (version, checked_at)
+_schema_versions_lock = threading.Lock()
+
+
+def get_cached_schema_version(key):
+    # Schema version stored for key if it was read less than SCHEMA_VERSION_TTL ago, else None
+    with _schema_versions_lock:
+        cached = _schema_versions.get(key)
+    if cached is not None and time.monotonic() - cached[1] < SCHEMA_VERSION_TTL:
+        return cached[0]
+    return None
+
+
+def store_schema_version(key, version):
+    with _schema_versions_lock:
+        _schema_versions[key] = (version, time.monotonic())
+
+
+def cached_schema_version(key, cur):
+    # Schema version of the database behind cur, read at most once per SCHEMA_VERSION_TTL.
+    # Lets the report queries pick the fastest path the database supports.
+    version = get_cached_schema_version(key)
+    if version is None:
+        version = get_schema_version(cur)
+        store_schema_version(key, version)
+    return version
+
+
+def rebuild_monthly_prod(conn):
+    # Recompute the whole rollup in one transaction, returns the number of monthly rows
+    with conn.cursor() as cur:
+        cur.execute(REBUILD_MONTHLY_PROD_SQL)
+        cur.execute("SELECT COUNT(*) FROM monthly_prod;")
+        rows = cur.fetchone()[0]
+    conn.commit()
+    return rows
+
+
+def rebuild_complete_dates(conn):
+    # Recompute the whole index in one transaction, returns the number of complete dates
+    with conn.cursor() as cur:
+        cur.execute(REBUILD_COMPLETE_DATES_SQL)
+        cur.execute("SELECT COUNT(*) FROM complete_dates;")
+        rows = cur.fetchone()[0]
+    conn.commit()
+    return rows
+
+
+def migrate(conn, target=None):
+    # Apply pending migrations up to target (default: all), each in its own transaction.
+    # Returns the versions applied.
+    target = LATEST_VERSION if target is None else target
+    applied = []
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version     INT PRIMARY KEY,
+                name        VARCHAR NOT NULL,
+                applied_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+        """)
+        conn.commit()
+        for version, name, sql in MIGRATIONS:
+            if version > target:
+                break
+            cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK_ID,))
+            # Re-read under the lock, another runner may have applied it meanwhile
+            cur.execute("SELECT 1 FROM schema_migrations WHERE version = %s;", (version,))
+            if cur.fetchone() is not None:
+                conn.commit()
+                continue
+            try:
+                cur.execute(sql)
+                cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s);", (version, name))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            applied.append(version)
+    return applied
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply the versioned schema migrations")
+    parser.add_argument("--dbname", default=os.environ.get("POSTGRES_DB"))
+    parser.add_argument("--user", default=os.environ.get("POSTGRES_USER"))
+    parser.add_argument("--password", default=os.environ.get("POSTGRES_PASSWORD"))
+    parser.add_argument("--host", default=os.environ.get("HOST", "localhost"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 5432)))
+    parser.add_argument("--target", type=int, help="migrate up to this version only")
+    parser.add_argument("--status", action="store_true", help="print the current version and exit")
+    parser.add_argument("--rebuild-monthly-prod", action="store_true", help="recompute the monthly_prod rollup and exit")
+    parser.add_argument("--rebuild-complete-dates", action="store_true", help="recompute the complete_dates index and exit")
+    args = parser.parse_args(argv)
+
+    conn = psycopg2.connect(
+        host=args.host,
+        port=args.port,
+        dbname=args.dbname,
+        user=args.user,
+        password=args.password
+    )
+    try:
+        with conn.cursor() as cur:
+            version = get_schema_version(cur)
+        conn.commit()
+        if args.status:
+            print(f"Schema version {version} of {LATEST_VERSION}")
+            return
+        if args.rebuild_monthly_prod:
+            if version < MONTHLY_PROD_VERSION:
+                parser.error(f"monthly_prod needs schema version {MONTHLY_PROD_VERSION}, run the migrations first")
+            print(f"Rebuilt monthly_prod: {rebuild_monthly_prod(conn)} rows")
+            return
+        if args.rebuild_complete_dates:
+            if version < COMPLETE_DATES_VERSION:
+                parser.error(f"complete_dates needs schema version {COMPLETE_DATES_VERSION}, run the migrations first")
+            print(f"Rebuilt complete_dates: {rebuild_complete_dates(conn)} rows")
+            return
+        applied = migrate(conn, target=args.target)
+        # The report specs are checked against the field table here, not on every report
+        with conn.cursor() as cur:
+            layout_metadata = read_field_metadata(cur)
+        conn.commit()
+    finally:
+        conn.close()
+    for version, name, _ in MIGRATIONS:
+        if version in applied:
+            print(f"Applied {version}: {name}")
+    if not applied:
+        print(f"Schema already at version {version}")
+    print_missing_layout_fields(layout_metadata, args.dbname)
+
+
+if __name__ == "__main__":
+    main()
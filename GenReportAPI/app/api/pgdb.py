@@ -1,18 +1,171 @@
+import contextlib
+import functools
+import hashlib
+import os
+
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.extras
 import pandas as pd
-from datetime import datetime
+from .report_engine import (
+    DAILY_PROD_TYPES,
+    DATA_WATERMARK_SQL,
+    SNAPSHOT_TRANSACTION_SQL,
+    SQL_PARAMETER,
+    latest_row_dates,
+    month_range,
+    print_lagging_rows,
+    report_window_params,
+    to_date,
+    year_range,
+)
+from .migrations import (
+    COMPLETE_DATES_VERSION,
+    DATA_VERSION_COMMIT_ORDER_DDL,
+    DATA_VERSION_DDL,
+    MONTHLY_PROD_VERSION,
+    cached_schema_version,
+)
+from .pool import get_pool
+from .field_metadata import field_metadata
+from .metrics import InstrumentedCursor, label_query, query_name
+from .report_plan import REPORT_PLANS
+from .report_query import ReportQuery
+
+# Decimals the report values are shown with, presentation only
+REPORT_DECIMALS = 2
+
+# Parameterized report queries run as server-side prepared statements, parsed and planned once
+# per connection. PG_PREPARE=0 turns this off, e.g. behind a transaction-pooling pgbouncer.
+PREPARE_STATEMENTS = os.environ.get("PG_PREPARE", "1") != "0"
+
+
+@functools.lru_cache(maxsize=None)
+def prepared_statement(sql):
+    # %(name)s query -> (statement name, PREPARE statement, EXECUTE statement, parameter names in $n order)
+    names = tuple(dict.fromkeys(SQL_PARAMETER.findall(sql)))
+    body = SQL_PARAMETER.sub(lambda m: f"${names.index(m.group(1)) + 1}", sql).strip().rstrip(";")
+    name = "report_" + hashlib.sha1(sql.encode("utf-8")).hexdigest()[:16]
+    prepare = f"PREPARE {name} AS {body};"
+    execute = f"EXECUTE {name} ({', '.join(['%s'] * len(names))});"
+    # Executions are timed under the label of the query they run
+    label_query(prepare, "prepare")
+    label_query(execute, query_name(sql))
+    return name, prepare, execute, names
+
+
+def report_frame(data, formatted=True):
+    # {column: values} with the field names first -> report with float64 value columns,
+    # rendered as '%.2f' strings unless formatted is False
+    report = pd.DataFrame(data)
+    value_columns = list(report.columns[1:])
+    report[value_columns] = report[value_columns].astype('float64')
+    return format_report(report) if formatted else report
+
+
+def format_report(report, decimals=REPORT_DECIMALS):
+    # float64 columns -> fixed-point strings, the format the JSON and CSV outputs use
+    report = report.copy()
+    for column in report.columns:
+        if report[column].dtype == 'float64':
+            report[column] = [f'%.{decimals}f' % v for v in report[column]]
+    return report
+
 
-class PGOilQuery:
+class PGReportQuery(ReportQuery):
+    # ReportQuery backend on a live Postgres database
     def __init__(self, dbname, user, password, host, port):
-        self.conn = psycopg2.connect(
-            host=host,
-            port=port,
+        # Borrow a connection from the shared pool of this database, give it back with close()
+        self.pool = get_pool(
             dbname=dbname,
             user=user,
-            password=password
+            password=password,
+            host=host,
+            port=port
         )
-        self.cur = self.conn.cursor()
+        self.conn = self.pool.getconn()
+        self.cur = self.conn.cursor(cursor_factory=InstrumentedCursor)
+        self.in_snapshot = False
+
+    def close(self):
+        if self.conn is None:
+            return
+        self.cur.close()
+        self.pool.putconn(self.conn)
+        self.conn = None
+        self.cur = None
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        # Run the queries of the block in one READ ONLY REPEATABLE READ transaction, so a report
+        # never mixes data from before and after a concurrent write. Nested blocks join the outer one.
+        if self.in_snapshot:
+            yield self
+            return
+        if self.conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            self.conn.rollback()
+        self.cur.execute(SNAPSHOT_TRANSACTION_SQL)
+        self.in_snapshot = True
+        try:
+            yield self
+        finally:
+            self.in_snapshot = False
+            # Nothing to commit, rollback just ends the transaction
+            self.conn.rollback()
+
+    def query(self, sql, params=None):
+        # Parameterized queries go through a prepared statement of this connection
+        prepared = getattr(self.conn, "prepared", None)
+        if not params or prepared is None or not PREPARE_STATEMENTS:
+            self.cur.execute(sql, params)
+        else:
+            name, prepare, execute, names = prepared_statement(sql)
+            if name not in prepared:
+                self.cur.execute(prepare)
+                prepared.add(name)
+            self.cur.execute(execute, [params[n] for n in names])
+        return [d[0] for d in self.cur.description], self.cur.fetchall()
+
+    @property
+    def db_key(self):
+        return (self.pool.host, int(self.pool.port), self.pool.dbname)
+
+    def has_monthly_rollup(self):
+        # monthly_prod exists and is maintained from this schema version on
+        return cached_schema_version(self.db_key, self.cur) >= MONTHLY_PROD_VERSION
+
+    def has_complete_dates(self):
+        # complete_dates exists and is maintained from this schema version on
+        return cached_schema_version(self.db_key, self.cur) >= COMPLETE_DATES_VERSION
+
+    def get_field_metadata(self):
+        # {(field_id, field_type): FieldInfo} of this database, from the shared cache
+        metadata = field_metadata.get(self.db_key)
+        if metadata is None:
+            metadata = self.load_field_metadata()
+            field_metadata.put(self.db_key, metadata)
+        return metadata
+
+    def get_data_watermark(self, query_date):
+        # Latest change to the daily rows up to query_date and the plan rows up to its year end,
+        # i.e. everything a report for query_date can read. None when data_version does not exist.
+        params = report_window_params(query_date)
+        if self.in_snapshot:
+            # A failed query must not end the snapshot
+            self.cur.execute("SAVEPOINT data_watermark;")
+        try:
+            self.cur.execute(DATA_WATERMARK_SQL, params)
+        except psycopg2.errors.UndefinedTable:
+            if self.in_snapshot:
+                self.cur.execute("ROLLBACK TO SAVEPOINT data_watermark;")
+            else:
+                self.conn.rollback()
+            return None
+        return self.cur.fetchone()
+
 
+class PGOilQuery(PGReportQuery):
     def create_field_table(self):
         self.cur.execute("""
                     CREATE TABLE field (
@@ -59,61 +212,14 @@ class PGOilQuery:
             )
         self.conn.commit()
 
+    def create_data_version_table(self):
+        # Change sequence per (table, report_date) that report caches watch, see migrations.py
+        self.cur.execute(DATA_VERSION_DDL + DATA_VERSION_COMMIT_ORDER_DDL)
+        self.conn.commit()
+
     def get_latest_date_by_field(self, field_id, prod_type, query_date = '2025/07/01'): #"%Y/%m/%d"
         # Check latest date of data before the query_date, if no data, choose the closest data had data
-        query_date = datetime.strptime(query_date, "%Y/%m/%d").date()
-        found = False
-        excepted_dates = []
-        self.cur.execute("""
-                SELECT report_date
-                FROM daily_prod
-                WHERE field_id = %s AND prod_type = %s AND report_date <= %s
-                ORDER BY report_date DESC
-                LIMIT 1;
-            """, (field_id, prod_type, query_date))
-        try:
-            _last_date = self.cur.fetchone()[0]
-        except:
-            _last_date = None
-
-        while not found:
-            # Check the data by that date
-            if _last_date is not None:
-                self.cur.execute("""
-                    SELECT * FROM daily_prod
-                    WHERE field_id = %s AND report_date = %s AND prod_type = %s;
-                """, (field_id, _last_date, prod_type))
-                data = self.cur.fetchone()
-                _prod_ton = data[3] if data is not None else None
-                _prod_bbls = data[4] if data is not None else None
-                _prod_m3 = data[5] if data is not None else None
-                _prod_ft3 = data[6] if data is not None else None
-                if prod_type=='OIL_PROD' and (_prod_ton is not None and _prod_bbls is not None):
-                    found = True
-                    return _last_date#.strftime("%Y/%m/%d")
-                elif prod_type=='GAS_PROD' and (_prod_m3 is not None and _prod_ft3 is not None):
-                    found = True
-                    # Return data as string #"%Y/%m/%d"
-                    return _last_date#.strftime("%Y/%m/%d")
-                else:
-                    excepted_dates.append(_last_date)
-                    print(f"Daily data on {_last_date} is incomplete for {field_id} - {prod_type}. Trying previous date...")
-                    # Temporarily remove that date and check again
-                    self.cur.execute("""
-                        SELECT report_date
-                        FROM daily_prod
-                        WHERE field_id = %s AND prod_type = %s AND report_date <= %s
-                        AND report_date NOT IN %s
-                        ORDER BY report_date DESC
-                        LIMIT 1;
-                    """, (field_id, prod_type, query_date, tuple(excepted_dates)))
-                    try:
-                        _last_date = self.cur.fetchone()[0]
-                    except:
-                        _last_date = None
-            else:
-                print(f"No data found for {field_id} - {prod_type}.")
-                return None
+        return self.get_latest_dates_by_fields([field_id], prod_type, query_date)[field_id]
 
     def get_all_table_names(self):
         self.cur.execute("""
@@ -138,6 +244,8 @@ class PGOilQuery:
     def delete_table(self, table_name):
         self.cur.execute(f"DROP TABLE IF EXISTS {table_name};")
         self.conn.commit()
+        if table_name == 'field':
+            field_metadata.invalidate(self.db_key)
         print(f"Table {table_name} deleted.")
 
     def insert_field(self, field_id, field_name, unit, field_type, conversion_factor):
@@ -146,6 +254,7 @@ class PGOilQuery:
             VALUES (%s, %s, %s, %s, %s);
         """, (field_id, field_name, unit, field_type, conversion_factor))
         self.conn.commit()
+        field_metadata.invalidate(self.db_key)
 
     def insert_plan_prod(self, field_id, report_date, plan_type, prod_ton, prod_bbls, prod_m3, prod_ft3):
         self.cur.execute("""
@@ -161,6 +270,38 @@ class PGOilQuery:
         """, (field_id, report_date, prod_type, prod_ton, prod_bbls, prod_m3, prod_ft3))
         self.conn.commit()
 
+    def upsert_daily_prod(self, rows):
+        # Insert or correct a batch of (field_id, report_date, prod_type, prod_ton, prod_bbls, prod_m3, prod_ft3)
+        # rows in one statement and return the sorted report dates whose data actually changed.
+        # Raises ValueError naming the first row with a malformed date or an unknown prod_type.
+        rows_by_key = {}
+        for i, row in enumerate(rows):
+            field_id, report_date, prod_type = row[:3]
+            try:
+                report_date = to_date(report_date)
+            except ValueError:
+                raise ValueError(f"Row {i}: report_date {report_date!r} is not a %Y/%m/%d date") from None
+            if prod_type not in DAILY_PROD_TYPES:
+                raise ValueError(f"Row {i}: prod_type {prod_type!r} is not one of {', '.join(DAILY_PROD_TYPES)}")
+            # The last row wins when a batch repeats a key, ON CONFLICT cannot touch a row twice
+            rows_by_key[(field_id, report_date, prod_type)] = tuple(row[3:7])
+        if not rows_by_key:
+            return []
+        changed = psycopg2.extras.execute_values(self.cur, """
+            INSERT INTO daily_prod AS d (field_id, report_date, prod_type, prod_ton, prod_bbls, prod_m3, prod_ft3)
+            VALUES %s
+            ON CONFLICT (field_id, report_date, prod_type) DO UPDATE SET
+                prod_ton = EXCLUDED.prod_ton,
+                prod_bbls = EXCLUDED.prod_bbls,
+                prod_m3 = EXCLUDED.prod_m3,
+                prod_ft3 = EXCLUDED.prod_ft3
+            WHERE (d.prod_ton, d.prod_bbls, d.prod_m3, d.prod_ft3)
+                IS DISTINCT FROM (EXCLUDED.prod_ton, EXCLUDED.prod_bbls, EXCLUDED.prod_m3, EXCLUDED.prod_ft3)
+            RETURNING report_date;
+        """, [key + units for key, units in rows_by_key.items()], page_size=len(rows_by_key), fetch=True)
+        self.conn.commit()
+        return sorted({row[0] for row in changed})
+
     def get_daily_prod_by_date(self, field_id, report_date, prod_type, unit='prod_bbls'):
         self.cur.execute(f"""
             SELECT {unit} FROM daily_prod
@@ -169,20 +310,12 @@ class PGOilQuery:
         return self.cur.fetchone()
     
     def get_conversion_factor(self, field_id, prod_type):
-        # Get factor from field table by field_id and prod_type
-        self.cur.execute("""
-            SELECT conversion_factor FROM field
-            WHERE field_id = %s AND field_type = %s;
-        """, (field_id, prod_type))
-        return self.cur.fetchone()[0]
+        # Get factor from the cached field table by field_id and prod_type
+        return self.get_field_metadata()[(field_id, prod_type)].conversion_factor
     
     def get_field_name(self, field_id, field_type):
-        # Get full name from field table by field_id and field_type
-        self.cur.execute("""
-            SELECT field_name FROM field
-            WHERE field_id = %s AND field_type = %s;
-        """, (field_id, field_type))
-        return self.cur.fetchone()[0]
+        # Get full name from the cached field table by field_id and field_type
+        return self.get_field_metadata()[(field_id, field_type)].field_name
 
     #=======GET FOR REPORTING=========
     # Column C, D
@@ -190,8 +323,8 @@ class PGOilQuery:
         # Extract the accumulated production for a specific year by field_id
         self.cur.execute("""
             SELECT SUM(prod_ton) FROM plan_prod
-            WHERE field_id = %s AND EXTRACT(YEAR FROM report_date) = %s AND plan_type = %s;
-        """, (field_id, year, plan_type))
+            WHERE field_id = %s AND report_date >= %s AND report_date < %s AND plan_type = %s;
+        """, (field_id, *year_range(year), plan_type))
         return self.cur.fetchone()[0]
     
     # Column D
@@ -199,8 +332,8 @@ class PGOilQuery:
         # Extract the production for a specific month by field_id
         self.cur.execute("""
             SELECT SUM(prod_ton) FROM daily_prod
-            WHERE field_id = %s AND EXTRACT(MONTH FROM report_date) = %s AND EXTRACT(YEAR FROM report_date) = %s AND prod_type = %s;
-        """, (field_id, month, year, prod_type))
+            WHERE field_id = %s AND report_date >= %s AND report_date < %s AND prod_type = %s;
+        """, (field_id, *month_range(year, month), prod_type))
         return self.cur.fetchone()[0]
 
     def get_accum_daily(self, field_id, month, prod_type, year=2025):
@@ -222,8 +355,8 @@ class PGOilQuery:
         # Extract the production for a specific month by field_id
         self.cur.execute("""
             SELECT SUM(prod_ton) FROM plan_prod
-            WHERE field_id = %s AND EXTRACT(MONTH FROM report_date) = %s AND EXTRACT(YEAR FROM report_date) = %s AND plan_type = %s;
-        """, (field_id, month, year, plan_type))
+            WHERE field_id = %s AND report_date >= %s AND report_date < %s AND plan_type = %s;
+        """, (field_id, *month_range(year, month), plan_type))
         return self.cur.fetchone()[0]
     
     # Column J
@@ -247,276 +380,76 @@ class PGOilQuery:
     
 
 
+def build_report(report_plan, plans, dailies, formatted=True):
+    # Columns B..R of report_plan from the plan and daily aggregates of each report row
+    return report_frame(report_plan.build(plans, dailies), formatted)
+
+def query_report(PGDB, kind, query_date, row_dates=None, formatted=True):
+    # Report of REPORT_PLANS[kind] from any ReportQuery backend
+    # row_dates: optional effective date of each report row, defaults to query_date for all rows
+    # formatted: '%.2f' strings as always, or float64 columns when False
+    report_plan = REPORT_PLANS[kind]
+    if row_dates is None:
+        row_dates = [query_date] * len(report_plan.field_names)
+    with PGDB.snapshot():
+        # Plan and actual aggregates in two grouped queries per distinct row date
+        plans, dailies = PGDB.get_row_aggregates(row_dates, report_plan)
+    return build_report(report_plan, plans, dailies, formatted)
+
+def query_report_w_latest_data(PGDB, kind, query_date, formatted=True):
+    report_plan = REPORT_PLANS[kind]
+    # The latest dates and the aggregates at those dates are read from the same snapshot
+    with PGDB.snapshot():
+        _latest_dates = PGDB.get_latest_dates_by_fields(report_plan.daily_field_ids, report_plan.prod_type, query_date)
+        # Each row is computed once at the latest date its sub-fields have complete data
+        row_dates = latest_row_dates(report_plan.sub_field_ids, _latest_dates, query_date)
+        print_lagging_rows(report_plan.sub_field_ids, row_dates, query_date)
+
+        report = query_report(PGDB, kind, query_date, row_dates=row_dates, formatted=formatted)
+    report['Dữ liệu cập nhật đến ngày'] = [v.strftime("%d/%m/%Y") for v in row_dates]
+    return report
+
+def oil_report(PGDB, query_date, row_dates=None, formatted=True):
+    return query_report(PGDB, 'oil', query_date, row_dates=row_dates, formatted=formatted)
+
+def oil_report_w_latest_data(PGDB, query_date, formatted=True):
+    return query_report_w_latest_data(PGDB, 'oil', query_date, formatted=formatted)
+
 def generate_oil_report(query_date, 
                     POSTGRES_DB, 
                     POSTGRES_USER, 
                     POSTGRES_PASSWORD,
                     HOST,
-                    PORT):
-    PGDB = PGOilQuery(
+                    PORT,
+                    row_dates=None,
+                    formatted=True):
+    with PGOilQuery(
         dbname=POSTGRES_DB,
         user=POSTGRES_USER,
         password=POSTGRES_PASSWORD,
         host=HOST,
         port=PORT
-    )
-
-    query_date = datetime.strptime(query_date, "%Y/%m/%d")
-    month = query_date.month
-    year = query_date.year
-    day = query_date.day
-
-    # Column B
-    field_names = [
-        "Bạch Hổ & Rồng& 50%NR-ĐM",
-        "NR-ĐM (Zarubezhneft)",
-        "Cond. Dinh Cố & GPP Ca Mau",
-        "Đại Hùng",
-        "PM3-CAA",
-        "46 CN",
-        "Rạng Đông+Phương Đông",
-        "Ruby+Pearl+Topaz+ Diamond",
-        "STĐ+STV+STT+STN",
-        "Cá Ngừ Vàng",
-        "Tê  Giác Trắng",
-        "Chim Sáo+ Dừa",
-        "Lan Tây + Lan Đỏ",
-        "Rồng Đôi+Rồng Đôi Tây",
-        "Hải Sư Trắng +Hải Sư Đen",
-        "Thăng Long + Đông Đô",
-        "Hải Thạch + Mộc Tinh",
-        "Kình Ngư Trắng - Nam",
-        "Cá Tầm",
-        "Thiên Ưng",
-        "Sao Vàng -Đại Nguyệt",
-        "Nhenhesky (49%VN)",
-        "Algeria",
-    ]
-    fields =['BHR', 'DM', 'DC', 'DH', 'PM3CA', '46CN', 'RDPD', 'RPT', 'STD-STV-STT-STN', 'CNV', 'TGT', 'CS', 'LTLD', 'RD-RDT', 'HST-HSD', 'TLDD', 'HT-MT', 'KNT-N', 'CT', 'ThienUng', 'SVDN', 'Nhenhexky', 'Algeria']
-    # Column C
-    column_c = [PGDB.get_accum_plan_year(field_id=field, year=year, plan_type='KHSLCPGiaoOil') for field in fields]
-    # Column D
-    column_d = [PGDB.get_accum_plan_year(field_id=field, year=year, plan_type='KHQTOIL') for field in fields]
-    # Column E
-    sub_field_ids = [('BH', 'R', 'GT', 'ThT', 'NR'), 
-                    'DM', 'DC-GPP', 'DH', 'PM3CAA', '46CN',
-                    ('RangDong', 'PhuongDong'),
-                    ('Ruby', 'Pearl', 'Topaz', 'Diamond'),
-                    ('STD', 'STV', 'STD-DB', 'STT', 'STN'), 
-                    'CNV', 'TGT', 'CS', 'LT', 'RD-RDT',
-                    ('HST', 'HSD'), 'TLDD', 'HT-MT', 'KNT-N', 'CT', 
-                    'ThienUng', 'SV', 'Nhenhexky', 'Algeria'
-                    ]
-    column_e = []
-    for _field in sub_field_ids:
-        if isinstance(_field, tuple):
-            _sub_field_prod = []
-            for sub_field in _field:
-                _prod = PGDB.get_accum_daily(field_id=sub_field, month=month, prod_type='OIL_PROD')/1000
-                if _prod is not None:
-                    _sub_field_prod.append(_prod)
-                else:
-                    _sub_field_prod.append(0)
-            column_e.append(sum(_sub_field_prod))
-        else:
-            _prod = PGDB.get_accum_daily(field_id=_field, month=month, prod_type='OIL_PROD')
-            column_e.append(_prod/1000 if _prod is not None else 0)
-    # Column F
-    column_f = [e * 100 / (1000 * c) if c != 0 else 0 for e, c in zip(column_e, column_c)]
-    # Column G
-    column_g = [e * 100 / (1000 * d) if d != 0 else 0 for e, d in zip(column_e, column_d)]
-    # Column H
-    column_h = [PGDB.get_monthly_plan_prod(field_id=field, month=month, plan_type='KHSLCPGiaoOil')*1000 for field in fields]
-    # Column I
-    column_i = [PGDB.get_monthly_plan_prod(field_id=field, month=month, plan_type='KHQTOIL')*1000 for field in fields]
-    # Column J
-    column_j = []
-    for _field in sub_field_ids:
-        if isinstance(_field, tuple):
-            _sub_field_prod = []
-            for sub_field in _field:
-                try:
-                    _prod = PGDB.get_accum_monthly_prod_to_a_date(field_id=sub_field, report_date=query_date, prod_type='OIL_PROD')
-                    _sub_field_prod.append(_prod/1000)
-                except Exception as e:
-                    _sub_field_prod.append(0)
-            column_j.append(sum(_sub_field_prod))
-        else:
-            _prod = PGDB.get_accum_monthly_prod_to_a_date(field_id=_field, report_date=query_date, prod_type='OIL_PROD')
-            column_j.append(_prod/1000 if _prod is not None else 0)
-    # Column K
-    column_k = [j * 100 / h if h != 0 else 0 for j, h in zip(column_j, column_h)]
-
-    # Column L
-    column_l = [j * 100 / i if i != 0 else 0 for j, i in zip(column_j, column_i)]
-
-    # Column M
-    column_m = [e + j for e, j in zip(column_e, column_j)]
-
-    # Column N
-    column_n = []
-    for _field in sub_field_ids:
-        if isinstance(_field, tuple):
-            _unused_fields = ['Pearl', 'Topaz', 'Diamond', 'HSD']
-            _v = 0
-            for sub_field in _field:
-                if sub_field in _unused_fields:
-                    _v += 0
-                else:
-                    _prod = PGDB.get_accum_daily_prod_up_to_date(field_id=sub_field, report_date=query_date, prod_type='OIL_PROD', unit='prod_bbls', year=year)
-                    if _prod is not None:
-                        _v += _prod
-            column_n.append(_v)
-        else:
-            _prod = PGDB.get_accum_daily_prod_up_to_date(field_id=_field, report_date=query_date, prod_type='OIL_PROD', unit='prod_bbls', year=year)
-            if _prod is not None:
-                column_n.append(_prod)
-            else:
-                column_n.append(0)
-
-    # Column O
-    column_o = [m/(1000*c) if c != 0 else 0 for m, c in zip(column_m, column_c)]
-
-    # Column P
-    column_p = [m/(1000*d) if d != 0 else 0 for m, d in zip(column_m, column_d)]
-
-    # Column Q
-    column_q = []
-    for _field in sub_field_ids:
-        if isinstance(_field, tuple):
-            _unused_fields = ['Pearl', 'Topaz', 'Diamond', 'HSD']
-            _v = 0
-            for sub_field in _field:
-                if sub_field in _unused_fields:
-                    _v +=0
-                else:
-                    _daily_prod = PGDB.get_daily_prod_by_date(field_id=sub_field, report_date=query_date, prod_type='OIL_PROD', unit='prod_ton')
-                    if _daily_prod is not None:
-                        _v += _daily_prod[0]
-            column_q.append(_v)
-        else:
-            _daily_prod = PGDB.get_daily_prod_by_date(field_id=_field, report_date=query_date, prod_type='OIL_PROD', unit='prod_ton')
-            if _daily_prod is not None:
-                column_q.append(_daily_prod[0])
-            else:
-                column_q.append(0)
-
-    # Column R
-    column_r = []
-    for _field in sub_field_ids:
-        if isinstance(_field, tuple):
-            _unused_fields = ['Pearl', 'Topaz', 'Diamond', 'HSD']
-            _v = 0
-            for sub_field in _field:
-                if sub_field in _unused_fields:
-                    _v +=0
-                else:
-                    _daily_prod = PGDB.get_daily_prod_by_date(field_id=sub_field, report_date=query_date, prod_type='OIL_PROD', unit='prod_bbls')
-                    if _daily_prod is not None:
-                        _v += _daily_prod[0]
-            column_r.append(_v)
-        else:
-            _daily_prod = PGDB.get_daily_prod_by_date(field_id=_field, report_date=query_date, prod_type='OIL_PROD', unit='prod_bbls')
-            if _daily_prod is not None:
-                column_r.append(_daily_prod[0])
-            else:
-                column_r.append(0)
-    data = {
-        "Mỏ": field_names,
-        "KHCP  (tr.tấn)": [ '%.2f' % elem for elem in column_c ],
-        "KHQT  (tr.tấn)": [ '%.2f' % elem for elem in column_d ],
-        "Tháng trước - Cộng dồn (ng.tấn)": [ '%.2f' % elem for elem in column_e ],
-        "Tháng trước - %KHCP": [ '%.2f' % elem for elem in column_f ],
-        "Tháng trước - %KHQT": [ '%.2f' % elem for elem in column_g ],
-        "Tháng này - KHCP (ng.tấn)": [ '%.2f' % elem for elem in column_h ],
-        "Tháng này - KHQT (ng.tấn)": [ '%.2f' % elem for elem in column_i ],
-        "Tháng này - Thực hiện (ng.tấn)": [ '%.2f' % elem for elem in column_j ],
-        "Tháng này - %KHCP": [ '%.2f' % elem for elem in column_k ],
-        "Tháng này - %KHQT": [ '%.2f' % elem for elem in column_l ],
-        "SL hiện tại - Cộng dồn (ng.tấn)": [ '%.2f' % elem for elem in column_m ],
-        "SL hiện tại - Cộng dồn (thùng)": [ '%.2f' % elem for elem in column_n ],
-        "SL hiện tại - %KHCP": [ '%.2f' % elem for elem in column_o ],
-        "SL hiện tại - %KHQT": [ '%.2f' % elem for elem in column_p ],
-        "SL ngày (tấn)": [ '%.2f' % elem for elem in column_q ],
-        "SL ngày (thùng)": [ '%.2f' % elem for elem in column_r ]
-    }
-    return pd.DataFrame(data)
+    ) as PGDB:
+        return oil_report(PGDB, query_date, row_dates=row_dates, formatted=formatted)
  
 def generate_oil_report_w_latest_data(query_date, 
                     POSTGRES_DB, 
                     POSTGRES_USER, 
                     POSTGRES_PASSWORD,
                     HOST,
-                    PORT):
-    PGDB = PGOilQuery(
+                    PORT,
+                    formatted=True):
+    with PGOilQuery(
         dbname=POSTGRES_DB,
         user=POSTGRES_USER,
         password=POSTGRES_PASSWORD,
         host=HOST,
         port=PORT
-    )
-
-    sub_field_ids = [('BH', 'R', 'GT', 'ThT', 'NR'), 
-                        'DM', 'DC-GPP', 'DH', 'PM3CAA', '46CN',
-                        ('RangDong', 'PhuongDong'),
-                        ('Ruby', 'Pearl', 'Topaz', 'Diamond'),
-                        ('STD', 'STV', 'STD-DB', 'STT', 'STN'), 
-                        'CNV', 'TGT', 'CS', 'LT', 'RD-RDT',
-                        ('HST', 'HSD'), 'TLDD', 'HT-MT', 'KNT-N', 'CT', 
-                        'ThienUng', 'SV', 'Nhenhexky', 'Algeria'
-                    ]
-    _latest_dates_by_field = {}
-    for sub_field_id in sub_field_ids:
-        if isinstance(sub_field_id, tuple):
-            dates = []
-            for field_id in sub_field_id:
-                _date = PGDB.get_latest_date_by_field(field_id, 'OIL_PROD', query_date)
-                dates.append(_date)
-            valid_dates = [d for d in dates if d is not None]
-            _date = max(valid_dates) if valid_dates else None
-            _latest_dates_by_field[sub_field_id] = _date
-        else:
-            _date = PGDB.get_latest_date_by_field(sub_field_id, 'OIL_PROD', query_date)
-            _latest_dates_by_field[sub_field_id] = _date
-
-    report = generate_oil_report(query_date,
-                                POSTGRES_DB, 
-                                POSTGRES_USER, 
-                                POSTGRES_PASSWORD,
-                                HOST,
-                                PORT)
-    _reformat_date = datetime.strptime(query_date, "%Y/%m/%d")
-    report['Dữ liệu cập nhật đến ngày'] = _reformat_date.strftime("%d/%m/%Y")
-    for i, (k, v) in enumerate(_latest_dates_by_field.items()):
-        if v is not None and v != datetime.strptime(query_date, "%Y/%m/%d").date():
-            _query_date = v.strftime("%Y/%m/%d")
-            print(f"Field {k} has latest data on {_query_date}, not {query_date}")
-            _new_query_report = generate_oil_report(_query_date,
-                                                    POSTGRES_DB, 
-                                                    POSTGRES_USER, 
-                                                    POSTGRES_PASSWORD,
-                                                    HOST,
-                                                    PORT)
-            _reformat_date = datetime.strptime(_query_date, "%Y/%m/%d")
-            _new_query_report['Dữ liệu cập nhật đến ngày'] = _reformat_date.strftime("%d/%m/%Y")
-            report.at[i, 'Dữ liệu cập nhật đến ngày'] = v.strftime("%d/%m/%Y")
-            report.loc[i, :] = _new_query_report.loc[i, :].values
-        else:
-            print(f"Field {k} has latest data on same date")
-    return report
+    ) as PGDB:
+        return oil_report_w_latest_data(PGDB, query_date, formatted=formatted)
 
 # ================= GAS REPORT ================================== GAS REPORT ===========================================
-class PGGasQuery:
-    def __init__(self, dbname, user, password, host, port):
-        self.conn = psycopg2.connect(
-            host=host,
-            port=port,
-            dbname=dbname,
-            user=user,
-            password=password
-        )
-        self.cur = self.conn.cursor()
-    
+class PGGasQuery(PGReportQuery):
     def get_all_table_names(self):
         self.cur.execute("""
             SELECT table_name
@@ -527,59 +460,7 @@ class PGGasQuery:
 
     def get_latest_date_by_field(self, field_id, prod_type='GAS_PROD', query_date = '2025/07/01'): #"%Y/%m/%d"
         # Check latest date of data before the query_date, if no data, choose the closest data had data
-        query_date = datetime.strptime(query_date, "%Y/%m/%d").date()
-        found = False
-        excepted_dates = []
-        self.cur.execute("""
-                SELECT report_date
-                FROM daily_prod
-                WHERE field_id = %s AND prod_type = %s AND report_date <= %s
-                ORDER BY report_date DESC
-                LIMIT 1;
-            """, (field_id, prod_type, query_date))
-        try:
-            _last_date = self.cur.fetchone()[0]
-        except:
-            _last_date = None
-
-        while not found:
-            # Check the data by that date
-            if _last_date is not None:
-                self.cur.execute("""
-                    SELECT * FROM daily_prod
-                    WHERE field_id = %s AND report_date = %s AND prod_type = %s;
-                """, (field_id, _last_date, prod_type))
-                data = self.cur.fetchone()
-                _prod_ton = data[3] if data is not None else None
-                _prod_bbls = data[4] if data is not None else None
-                _prod_m3 = data[5] if data is not None else None
-                _prod_ft3 = data[6] if data is not None else None
-                if prod_type=='OIL_PROD' and (_prod_ton is not None and _prod_bbls is not None):
-                    found = True
-                    return _last_date#.strftime("%Y/%m/%d")
-                elif prod_type=='GAS_PROD' and (_prod_m3 is not None and _prod_ft3 is not None):
-                    found = True
-                    # Return data as string #"%Y/%m/%d"
-                    return _last_date#.strftime("%Y/%m/%d")
-                else:
-                    excepted_dates.append(_last_date)
-                    print(f"Daily data on {_last_date} is incomplete for {field_id} - {prod_type}. Trying previous date...")
-                    # Temporarily remove that date and check again
-                    self.cur.execute("""
-                        SELECT report_date
-                        FROM daily_prod
-                        WHERE field_id = %s AND prod_type = %s AND report_date <= %s
-                        AND report_date NOT IN %s
-                        ORDER BY report_date DESC
-                        LIMIT 1;
-                    """, (field_id, prod_type, query_date, tuple(excepted_dates)))
-                    try:
-                        _last_date = self.cur.fetchone()[0]
-                    except:
-                        _last_date = None
-            else:
-                print(f"No data found for {field_id} - {prod_type}.")
-                return None
+        return self.get_latest_dates_by_fields([field_id], prod_type, query_date)[field_id]
     
     #=======GET FOR REPORTING=========
     # Column C, D
@@ -587,8 +468,8 @@ class PGGasQuery:
         # Extract the accumulated production for a specific year by field_id
         self.cur.execute("""
             SELECT SUM(prod_m3) FROM plan_prod
-            WHERE field_id = %s AND EXTRACT(YEAR FROM report_date) = %s AND plan_type = %s;
-        """, (field_id, year, plan_type))
+            WHERE field_id = %s AND report_date >= %s AND report_date < %s AND plan_type = %s;
+        """, (field_id, *year_range(year), plan_type))
         return self.cur.fetchone()[0]
     
     def get_data_by_field(self, field_id):
@@ -612,8 +493,8 @@ class PGGasQuery:
         # Extract the production for a specific month by field_id
         self.cur.execute("""
             SELECT SUM(prod_m3) FROM daily_prod
-            WHERE field_id = %s AND EXTRACT(MONTH FROM report_date) = %s AND EXTRACT(YEAR FROM report_date) = %s AND prod_type = %s;
-        """, (field_id, month, year, prod_type))
+            WHERE field_id = %s AND report_date >= %s AND report_date < %s AND prod_type = %s;
+        """, (field_id, *month_range(year, month), prod_type))
         return self.cur.fetchone()[0]
     
     def get_accum_daily(self, field_id, month, prod_type, year=2025):
@@ -635,8 +516,8 @@ class PGGasQuery:
         # Extract the production for a specific month by field_id
         self.cur.execute("""
             SELECT SUM(prod_m3) FROM plan_prod
-            WHERE field_id = %s AND EXTRACT(MONTH FROM report_date) = %s AND EXTRACT(YEAR FROM report_date) = %s AND plan_type = %s;
-        """, (field_id, month, year, plan_type))
+            WHERE field_id = %s AND report_date >= %s AND report_date < %s AND plan_type = %s;
+        """, (field_id, *month_range(year, month), plan_type))
         return self.cur.fetchone()[0]
     
     # Column J
@@ -666,269 +547,41 @@ class PGGasQuery:
         """, (field_id, report_date, prod_type))
         return self.cur.fetchone()
     
+def gas_report(PGDB, query_date, row_dates=None, formatted=True):
+    return query_report(PGDB, 'gas', query_date, row_dates=row_dates, formatted=formatted)
+
+def gas_report_w_latest_data(PGDB, query_date, formatted=True):
+    return query_report_w_latest_data(PGDB, 'gas', query_date, formatted=formatted)
+
 def generate_gas_report(query_date, 
                     POSTGRES_DB, 
                     POSTGRES_USER, 
                     POSTGRES_PASSWORD,
                     HOST,
-                    PORT):
-    PGDB = PGGasQuery(
+                    PORT,
+                    row_dates=None,
+                    formatted=True):
+    with PGGasQuery(
         dbname=POSTGRES_DB,
         user=POSTGRES_USER,
         password=POSTGRES_PASSWORD,
         host=HOST,
         port=PORT
-    )
-
-    query_date = datetime.strptime(query_date, "%Y/%m/%d")
-    month = query_date.month
-    year = query_date.year
-    day = query_date.day
-
-    # Column B
-    field_names = [
-        'Bạch Hổ+ Rồng',
-        'Tê Giác Trắng',
-        'Rạng Đông+Phương Đông',
-        'Chim Sáo+  Dừa',
-        'STĐ+STV+STT+STN',
-        'Cá Ngừ Vàng',
-        'Kình Ngư Trắng',
-        'Lan Tây+Lan Đỏ',
-        'Rồng Đôi+Rồng Đôi Tây',
-        'Lô PM3-CAA ( tổng khí về bờ)',
-        'Hải Sư Trắng +Hải Sư Đen',
-        'Hải Thạch + Mộc Tinh',
-        'Thái Bình',
-        'Thiên Ưng',
-        'Sao Vàng -Đại Nguyet',
-        'Đại Hùng',
-        'Cá Tầm',
-    ]
-    KHQT_fields = ['BH', 'TGT', 'RangDong', 'CS', 'STD-STV-STT', 'CNV', 'KNT-N', 'LTLD', 'RD-RDT', 'PM3CA-46CN', 'HST-HSD', 'HT-MT', 'TB', 'ThienUng', 'SVDN', 'DH', 'CT']
-    KHCP_fields = ['BH', 'TGT', 'RDPD', 'CS-D', 'STD-STV-STT-STN', 'CNV', 'KNT-N', 'LTLD', 'RD-RDT', 'PM3CA-46CN', 'HST-HSD', 'HT-MT', 'TB', 'ThienUng', 'SVDN', 'DH', 'CT']
-
-    # Column C
-    column_c = [PGDB.get_accum_plan_year(field_id=field, year=year, plan_type='KHSLCPGiaoGas') for field in KHCP_fields]
-    # Column D
-    column_d = [PGDB.get_accum_plan_year(field_id=field, year=year, plan_type='KHQTGAS') for field in KHQT_fields]
-
-    # Column E
-    sub_field_ids = [('BH', 'R'), 
-                    'TGT',
-                    ('RangDong', 'PhuongDong'),
-                    'CS',
-                    ('STD', 'STV', 'STD-DB', 'STT', 'STN'), 
-                    'CNV', 'KNT-N', 'LT', 'RD-RDT', 
-                    'PM3-46CN',
-                    'HST-HSD', 'HT', 'ThaiBinh', 'ThienUng', 'SV', 'DH', 'CT'
-                    ]
-    column_e = []
-    for _field in sub_field_ids:
-        if isinstance(_field, tuple):
-            _sub_field_prod = []
-            for sub_field in _field:
-                _accum_prod = PGDB.get_accum_daily(field_id=sub_field, month=month, prod_type='GAS_PROD')
-                if _accum_prod is not None:
-                    _sub_field_prod.append(_accum_prod)
-                else:
-                    _sub_field_prod.append(0)
-            column_e.append(sum(_sub_field_prod))
-        else:
-            _accum_prod = PGDB.get_accum_daily(field_id=_field, month=month, prod_type='GAS_PROD')
-            if _accum_prod is not None:
-                column_e.append(_accum_prod)
-            else:
-                column_e.append(0)
-
-    # Column F
-    column_f = [e * 100 / (c) if c != 0 else 0 for e, c in zip(column_e, column_c)]
-    # Column G
-    column_g = [e * 100 / (d) if d != 0 else 0 for e, d in zip(column_e, column_d)]
-    # Column H
-    column_h = [PGDB.get_monthly_plan_prod(field_id=field, month=month, plan_type='KHSLCPGiaoGas') for field in KHCP_fields]
-    # Column I
-    column_i = [PGDB.get_monthly_plan_prod(field_id=field, month=month, plan_type='KHQTGAS') for field in KHQT_fields]
-    # Column J
-    column_j = []
-    for _field in sub_field_ids:
-        if isinstance(_field, tuple):
-            _sub_field_prod = []
-            for sub_field in _field:
-                try:
-                    _prod = PGDB.get_accum_monthly_prod_to_a_date(field_id=sub_field, report_date=query_date, prod_type='GAS_PROD')
-                    if _prod is None:
-                        _prod = 0
-                    _sub_field_prod.append(_prod)
-                except Exception as e:
-                    _sub_field_prod.append(0)
-            column_j.append(sum(_sub_field_prod))
-        else:
-            _prod = PGDB.get_accum_monthly_prod_to_a_date(field_id=_field, report_date=query_date, prod_type='GAS_PROD')
-            if _prod is not None:
-                column_j.append(_prod)
-            else:
-                column_j.append(0)
-    # # Column K
-    column_k = [j * 100 / h if h != 0 else 0 for j, h in zip(column_j, column_h)]
-
-    # Column L
-    column_l = [j * 100 / i if i != 0 else 0 for j, i in zip(column_j, column_i)]
-
-    # Column M
-    column_m = [e + j for e, j in zip(column_e, column_j)]
-
-    # Column N
-    column_n = []
-    for _field in sub_field_ids:
-        if isinstance(_field, tuple):
-            _unused_fields = ['Pearl', 'Topaz', 'Diamond', 'HSD']
-            _v = 0
-            for sub_field in _field:
-                if sub_field in _unused_fields:
-                    _v += 0
-                else:
-                    _prod = PGDB.get_accum_daily_prod_up_to_date(field_id=sub_field, report_date=query_date, prod_type='GAS_PROD', unit='prod_ft3', year=year)
-                    if _prod is None:
-                        _prod = 0
-                    _v += _prod
-            column_n.append(_v)
-        else:
-            _prod = PGDB.get_accum_daily_prod_up_to_date(field_id=_field, report_date=query_date, prod_type='GAS_PROD', unit='prod_ft3', year=year)
-            if _prod is not None:
-                column_n.append(_prod)
-            else:
-                column_n.append(0)
-
-    # Column O
-    column_o = [100*m/c if c != 0 else 0 for m, c in zip(column_m, column_c)]
-
-    # Column P
-    column_p = [100*m/d if d != 0 else 0 for m, d in zip(column_m, column_d)]
-
-    # Column Q
-    column_q = []
-    for _field in sub_field_ids:
-        if isinstance(_field, tuple):
-            _v = 0
-            for sub_field in _field:
-                _prod = PGDB.get_daily_prod_by_date(field_id=sub_field, report_date=query_date, prod_type='GAS_PROD', unit='prod_m3')
-                if _prod is None:
-                    _prod = 0
-                    _v += _prod
-                else:
-                    _v += _prod[0]
-            column_q.append(_v)
-        else:
-            _prod = PGDB.get_daily_prod_by_date(field_id=_field, report_date=query_date, prod_type='GAS_PROD', unit='prod_m3')
-            if _prod is not None:
-                column_q.append(_prod[0])
-            else:
-                column_q.append(0)
-
-    # Column R
-    column_r = []
-    for _field in sub_field_ids:
-        if isinstance(_field, tuple):
-            _unused_fields = ['Pearl', 'Topaz', 'Diamond', 'HSD']
-            _v = 0
-            for sub_field in _field:
-                if sub_field in _unused_fields:
-                    _v +=0
-                else:
-                    _prod = PGDB.get_daily_prod_by_date(field_id=sub_field, report_date=query_date, prod_type='GAS_PROD', unit='prod_ft3')
-                    if _prod is None:
-                        _prod = 0
-                        _v += _prod
-                    else:
-                        _v += _prod[0]
-            column_r.append(_v)
-        else:
-            _prod = PGDB.get_daily_prod_by_date(field_id=_field, report_date=query_date, prod_type='GAS_PROD', unit='prod_ft3')
-            if _prod is not None:
-                column_r.append(_prod[0])
-            else:
-                column_r.append(0)
-
-    data = {
-            "Mỏ": field_names,
-            "KHCP  (tr.m3)": ["%.2f" % elem for elem in column_c],
-            "KHQT  (tr.m3)": ["%.2f" % elem for elem in column_d],
-            "Tháng trước - Cộng dồn (tr.m3)": ["%.2f" % elem for elem in column_e],
-            "Tháng trước - %KHCP": ["%.2f" % elem for elem in column_f],
-            "Tháng trước - %KHQT": ["%.2f" % elem for elem in column_g],
-            "Tháng này - KHCP (tr.m3)": ["%.2f" % elem for elem in column_h],
-            "Tháng này - KHQT (tr.m3)": ["%.2f" % elem for elem in column_i],
-            "Tháng này - Thực hiện (tr.m3)": ["%.2f" % elem for elem in column_j],
-            "Tháng này - %KHCP": ["%.2f" % elem for elem in column_k],
-            "Tháng này - %KHQT": ["%.2f" % elem for elem in column_l],
-            "SL hiện tại - Cộng dồn (tr.m3)": ["%.2f" % elem for elem in column_m],
-            "SL hiện tại - Cộng dồn (tr.ft3)": ["%.2f" % elem for elem in column_n],
-            "SL hiện tại - %KHCP": ["%.2f" % elem for elem in column_o],
-            "SL hiện tại - %KHQT": ["%.2f" % elem for elem in column_p],
-            "SL ngày (tr.m3)": ["%.2f" % elem for elem in column_q],
-            "SL ngày (tr.ft3)": ["%.2f" % elem for elem in column_r]
-        }
-    return pd.DataFrame(data)
+    ) as PGDB:
+        return gas_report(PGDB, query_date, row_dates=row_dates, formatted=formatted)
 
 def generate_gas_report_w_latest_data(query_date, 
                     POSTGRES_DB, 
                     POSTGRES_USER, 
                     POSTGRES_PASSWORD,
                     HOST,
-                    PORT):
-    PGDB = PGGasQuery(
+                    PORT,
+                    formatted=True):
+    with PGGasQuery(
         dbname=POSTGRES_DB,
         user=POSTGRES_USER,
         password=POSTGRES_PASSWORD,
         host=HOST,
         port=PORT
-    )
-    sub_field_ids = [('BH', 'R'), 
-                    'TGT',
-                    ('RangDong', 'PhuongDong'),
-                    'CS',
-                    ('STD', 'STV', 'STD-DB', 'STT', 'STN'), 
-                    'CNV', 'KNT-N', 'LT', 'RD-RDT', 
-                    'PM3-46CN',
-                    'HST-HSD', 'HT', 'ThaiBinh', 'ThienUng', 'SV', 'DH', 'CT'
-                    ]
-    _latest_dates_by_field = {}
-    for sub_field_id in sub_field_ids:
-        if isinstance(sub_field_id, tuple):
-            dates = []
-            for field_id in sub_field_id:
-                _date = PGDB.get_latest_date_by_field(field_id, 'GAS_PROD', query_date)
-                dates.append(_date)
-            valid_dates = [d for d in dates if d is not None]
-            _date = max(valid_dates) if valid_dates else None
-            _latest_dates_by_field[sub_field_id] = _date
-        else:
-            _date = PGDB.get_latest_date_by_field(sub_field_id, 'GAS_PROD', query_date)
-            _latest_dates_by_field[sub_field_id] = _date
-
-    report = generate_gas_report(query_date,
-                                POSTGRES_DB, 
-                                POSTGRES_USER, 
-                                POSTGRES_PASSWORD,
-                                HOST,
-                                PORT)
-    _reformat_date = datetime.strptime(query_date, "%Y/%m/%d")
-    report['Dữ liệu cập nhật đến ngày'] = _reformat_date.strftime("%d/%m/%Y")
-    for i, (k, v) in enumerate(_latest_dates_by_field.items()):
-        if v is not None and v != datetime.strptime(query_date, "%Y/%m/%d").date():
-            _query_date = v.strftime("%Y/%m/%d")
-            print(f"Field {k} has latest data on {_query_date}, not {query_date}")
-            _new_query_report = generate_gas_report(_query_date,
-                                                    POSTGRES_DB, 
-                                                    POSTGRES_USER, 
-                                                    POSTGRES_PASSWORD,
-                                                    HOST,
-                                                    PORT)
-            _reformat_date = datetime.strptime(_query_date, "%Y/%m/%d")
-            _new_query_report['Dữ liệu cập nhật đến ngày'] = _reformat_date.strftime("%d/%m/%Y")
-            report.at[i, 'Dữ liệu cập nhật đến ngày'] = v.strftime("%d/%m/%Y")
-            report.loc[i, :] = _new_query_report.loc[i, :].values
-        else:
-            print(f"Field {k} has latest data on same date")
-    return report
\ No newline at end of file
+    ) as PGDB:
+        return gas_report_w_latest_data(PGDB, query_date, formatted=formatted)
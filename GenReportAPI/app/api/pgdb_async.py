@@ -0,0 +1,490 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+import psycopg
+import psycopg.conninfo
+import psycopg.errors
+from psycopg_pool import AsyncConnectionPool
+
+from .migrations import (
+    COMPLETE_DATES_VERSION,
+    MONTHLY_PROD_VERSION,
+    SCHEMA_MIGRATIONS_EXISTS_SQL,
+    SCHEMA_VERSION_SQL,
+    WATERMARK_VERSION,
+    get_cached_schema_version,
+    store_schema_version,
+)
+from .pgdb import PREPARE_STATEMENTS, build_report
+from .metrics import observe_query
+from .pool import (
+    CONNECT_TIMEOUT,
+    POOL_MAX_IDLE,
+    POOL_MAX_SIZE,
+    POOL_MIN_SIZE,
+    POOL_TIMEOUT,
+    _password_digest,
+    pool_key,
+    pool_registry,
+)
+from .report_engine import (
+    DAILY_AGGREGATE_KEYS,
+    DAILY_ROWS_SQL,
+    DATA_WATERMARK_SQL,
+    PLAN_AGGREGATE_KEYS,
+    PLAN_ROWS_SQL,
+    SNAPSHOT_TRANSACTION_SQL,
+    daily_aggregates_rollup_sql,
+    daily_aggregates_sql,
+    flatten_sub_field_ids,
+    group_rows_by_date,
+    latest_complete_dates_sql,
+    latest_row_dates,
+    plan_aggregates_sql,
+    print_lagging_rows,
+    report_window_params,
+    to_date,
+)
+from .report_plan import REPORT_PLANS
+
+
+# Rows fetched per round trip when streaming daily rows
+DAILY_ROWS_ITERSIZE = 2000
+
+# Executions of a query on a connection before psycopg prepares it server-side: the report
+# queries at once, or never with PG_PREPARE=0 (the switch of the psycopg2 path)
+PREPARE_THRESHOLD = 0 if PREPARE_STATEMENTS else None
+
+class BudgetedAsyncConnection(psycopg.AsyncConnection):
+    # Async pool connection counted against the connection budget of pool_registry
+    _budgeted = False
+
+    @classmethod
+    async def connect(cls, conninfo="", **kwargs):
+        params = psycopg.conninfo.conninfo_to_dict(conninfo, **kwargs)
+        key = async_pool_key(params['dbname'], params['user'], params['host'], params['port'])
+        # Waiting for a slot may close other pools, off the event loop since it blocks
+        await asyncio.to_thread(pool_registry.acquire, key, POOL_TIMEOUT)
+        try:
+            conn = await super().connect(conninfo, **kwargs)
+        except BaseException:
+            pool_registry.release()
+            raise
+        conn._budgeted = True
+        return conn
+
+    async def close(self):
+        if self._budgeted:
+            self._budgeted = False
+            pool_registry.release()
+        await super().close()
+
+
+class AsyncPoolTarget:
+    # Registry entry of an AsyncConnectionPool, which runs on one event loop
+    def __init__(self, pool, loop, password_digest):
+        self.pool = pool
+        self.loop = loop
+        self.password_digest = password_digest
+
+    def idle(self):
+        stats = self.pool.get_stats()
+        return stats['pool_size'] == stats['pool_available'] and not stats.get('requests_waiting')
+
+    def shed_idle(self):
+        # psycopg_pool shrinks itself after max_idle, its connections cannot be closed one by one
+        return False
+
+    def close(self):
+        # Evicted from any thread, the pool closes on its own loop
+        if not self.loop.is_closed():
+            asyncio.run_coroutine_threadsafe(self.pool.close(), self.loop)
+
+    def stats(self):
+        stats = self.pool.get_stats()
+        return {
+            "size": stats['pool_size'],
+            "idle": stats['pool_available'],
+            "in_use": stats['pool_size'] - stats['pool_available'],
+            "min_size": stats['pool_min'],
+            "max_size": stats['pool_max'],
+        }
+
+
+def async_pool_key(dbname, user, host, port):
+    return ('async',) + pool_key(dbname, user, host, port)
+
+
+# One async pool per (host, port, dbname, user) and event loop in pool_registry, sized like the sync pools.
+# {(key, loop): future} of the pools being created, done once the creation succeeded or failed
+_async_pool_creations = {}
+
+
+async def get_async_pool(dbname, user, password, host, port):
+    key = async_pool_key(dbname, user, host, port)
+    loop = asyncio.get_running_loop()
+    password_digest = _password_digest(password)
+    while True:
+        entry = pool_registry.get(key)
+        if entry is not None and entry.loop is loop and entry.password_digest == password_digest:
+            return entry.pool
+        creation = _async_pool_creations.get((key, loop))
+        if creation is None:
+            break
+        # Another request is creating the pool of this target, look again once it is done.
+        # Requests for other targets never wait on it.
+        await asyncio.wait([creation])
+    creation = _async_pool_creations[(key, loop)] = loop.create_future()
+    try:
+        return await _create_async_pool(key, loop, password_digest, dbname, user, password, host, port)
+    finally:
+        del _async_pool_creations[(key, loop)]
+        creation.set_result(None)
+
+
+async def _create_async_pool(key, loop, password_digest, dbname, user, password, host, port):
+    # Unknown target, another event loop or a different password: authenticate with a
+    # fresh connection first, so bad credentials fail at once instead of after the pool timeout
+    conninfo = psycopg.conninfo.make_conninfo(host=host, port=port, dbname=dbname, user=user, password=password,
+                                              connect_timeout=CONNECT_TIMEOUT)
+    conn = await psycopg.AsyncConnection.connect(conninfo)
+    await conn.close()
+    pool = AsyncConnectionPool(
+        conninfo,
+        connection_class=BudgetedAsyncConnection,
+        min_size=POOL_MIN_SIZE,
+        max_size=POOL_MAX_SIZE,
+        max_idle=POOL_MAX_IDLE,
+        timeout=POOL_TIMEOUT,
+        check=AsyncConnectionPool.check_connection,
+        kwargs={'prepare_threshold': PREPARE_THRESHOLD},
+        open=False,
+    )
+    # Registered once its first connections are open, so filling it never evicts it
+    try:
+        await pool.open(wait=True, timeout=POOL_TIMEOUT)
+    except BaseException:
+        # Stops the workers and gives back the budget of the connections it did open
+        await pool.close()
+        raise
+    _, replaced = pool_registry.put(key, AsyncPoolTarget(pool, loop, password_digest))
+    if replaced is not None:
+        if replaced.loop is loop:
+            await replaced.pool.close()
+        else:
+            replaced.close()
+    return pool
+
+
+async def close_all_async_pools():
+    loop = asyncio.get_running_loop()
+    targets = pool_registry.clear(AsyncPoolTarget)
+    for target in targets:
+        if target.loop is loop:
+            await target.pool.close()
+        else:
+            target.close()
+
+
+class AsyncPGReportQuery:
+    # Async counterpart of the PGReportQuery report operations. Every query borrows its own
+    # connection, so independent queries of one report can run concurrently. Inside snapshot(),
+    # they share one connection instead, see there.
+    def __init__(self, pool, schema_key, conn=None):
+        self.pool = pool
+        self.schema_key = schema_key  # (host, port, dbname) of the cached schema version
+        self.conn = conn  # connection of the snapshot every query reads from, see snapshot()
+        self._pending = []  # (sql, params, future) queued for the next pipeline on conn
+        self._lock = asyncio.Lock()  # one pipeline or cursor call on conn at a time
+        self._flush_task = None
+        self._begun = False
+
+    @classmethod
+    async def connect(cls, dbname, user, password, host, port):
+        return cls(await get_async_pool(dbname, user, password, host, port), (host, int(port), dbname))
+
+    @asynccontextmanager
+    async def snapshot(self):
+        # Borrow one connection for a READ ONLY REPEATABLE READ transaction, so every query of the
+        # yielded query object reads the same data. Queries issued together, e.g. by
+        # asyncio.gather, are sent as one pipeline: a single round trip, and a report holds one
+        # connection however many queries it runs. Inside a snapshot, the same query object is yielded again.
+        if self.conn is not None:
+            yield self
+            return
+        async with self.pool.connection() as conn:
+            try:
+                yield AsyncPGReportQuery(self.pool, self.schema_key, conn)
+            finally:
+                await conn.rollback()
+
+    async def _begin(self):
+        # Start the snapshot transaction before the first query on conn, with self._lock held
+        if not self._begun:
+            await self.conn.execute(SNAPSHOT_TRANSACTION_SQL, prepare=False)
+            self._begun = True
+
+    async def _flush(self):
+        # Run the queries queued on conn in one pipeline and resolve their futures
+        async with self._lock:
+            batch, self._pending = self._pending, []
+            start = time.perf_counter()
+            results = []
+            try:
+                async with self.conn.pipeline():
+                    await self._begin()
+                    cursors = [await self.conn.execute(sql, params) for sql, params, _ in batch]
+                    for cur in cursors:
+                        # The description arrives with the rows
+                        rows = await cur.fetchall()
+                        results.append(([d.name for d in cur.description], rows))
+            except Exception as e:
+                # The failed query and every query after it in the pipeline
+                for _, _, future in batch[len(results):]:
+                    if not future.done():
+                        future.set_exception(e)
+            seconds = (time.perf_counter() - start) / len(batch)
+            for (sql, _, future), result in zip(batch, results):
+                observe_query(sql, seconds, len(result[1]), result[0])
+                if not future.done():
+                    future.set_result(result)
+
+    async def _fetch(self, sql, params=None):
+        # -> (column names, list of row tuples)
+        if self.conn is None:
+            async with self.pool.connection() as conn:
+                start = time.perf_counter()
+                cur = await conn.execute(sql, params)
+                rows = await cur.fetchall()
+                columns = [d.name for d in cur.description]
+                observe_query(sql, time.perf_counter() - start, len(rows), columns)
+                return columns, rows
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((sql, params, future))
+        if len(self._pending) == 1:
+            # Runs once the other tasks ready now have queued their queries too
+            self._flush_task = loop.create_task(self._flush())
+        return await future
+
+    async def _fetchall(self, sql, params=None):
+        return (await self._fetch(sql, params))[1]
+
+    async def schema_version(self):
+        version = get_cached_schema_version(self.schema_key)
+        if version is None:
+            rows = await self._fetchall(SCHEMA_MIGRATIONS_EXISTS_SQL)
+            version = 0
+            if rows[0][0] is not None:
+                rows = await self._fetchall(SCHEMA_VERSION_SQL)
+                version = rows[0][0]
+            store_schema_version(self.schema_key, version)
+        return version
+
+    async def has_monthly_rollup(self):
+        # monthly_prod exists and is maintained from this schema version on
+        return await self.schema_version() >= MONTHLY_PROD_VERSION
+
+    async def has_complete_dates(self):
+        # complete_dates exists and is maintained from this schema version on
+        return await self.schema_version() >= COMPLETE_DATES_VERSION
+
+    #=======SET-BASED AGGREGATES=========
+    async def get_daily_aggregates(self, field_ids, prod_type, report_date, keys=DAILY_AGGREGATE_KEYS):
+        params = report_window_params(report_date)
+        params.update(field_ids=list(field_ids), prod_type=prod_type)
+        sql = daily_aggregates_rollup_sql(keys) if await self.has_monthly_rollup() else daily_aggregates_sql(keys)
+        rows = await self._fetchall(sql, params)
+        return {row[0]: dict(zip(keys, row[1:])) for row in rows}
+
+    async def get_plan_aggregates(self, field_ids, plan_types, report_date, keys=PLAN_AGGREGATE_KEYS):
+        params = report_window_params(report_date)
+        params.update(field_ids=list(field_ids), plan_types=list(plan_types))
+        rows = await self._fetchall(plan_aggregates_sql(keys), params)
+        return {(row[0], row[1]): dict(zip(keys, row[2:])) for row in rows}
+
+    async def get_latest_dates_by_fields(self, field_ids, prod_type, query_date):
+        latest_dates = {field_id: None for field_id in field_ids}
+        sql = latest_complete_dates_sql(prod_type, indexed=await self.has_complete_dates())
+        if sql is None:
+            return latest_dates
+        latest_dates.update(await self._fetchall(sql, {
+            'field_ids': list(field_ids),
+            'prod_type': prod_type,
+            'query_date': to_date(query_date),
+        }))
+        return latest_dates
+
+    async def get_data_watermark(self, query_date):
+        if self.conn is not None:
+            # A failed query would abort the snapshot and the queries pipelined with it
+            if await self.schema_version() < WATERMARK_VERSION:
+                return None
+            return (await self._fetchall(DATA_WATERMARK_SQL, report_window_params(query_date)))[0]
+        try:
+            rows = await self._fetchall(DATA_WATERMARK_SQL, report_window_params(query_date))
+        except psycopg.errors.UndefinedTable:
+            return None
+        return rows[0]
+
+    async def iter_daily_rows(self, field_ids, prod_type, start_date, end_date):
+        # (field_id, report_date, prod_ton, prod_bbls, prod_m3, prod_ft3) of [start_date, end_date] ordered by date,
+        # streamed from a server-side cursor so long ranges are never held in memory
+        if self.conn is None:
+            async with self.snapshot() as snapshot:
+                async for row in snapshot.iter_daily_rows(field_ids, prod_type, start_date, end_date):
+                    yield row
+            return
+        async with self.conn.cursor(name="daily_rows") as cur:
+            # Time spent waiting on the server, not on the consumer of the rows
+            seconds, rows = 0.0, 0
+            start = time.perf_counter()
+            async with self._lock:
+                await self._begin()
+                await cur.execute(DAILY_ROWS_SQL, {
+                    'field_ids': list(field_ids),
+                    'prod_type': prod_type,
+                    'start_date': to_date(start_date),
+                    'end_date': to_date(end_date),
+                })
+            seconds += time.perf_counter() - start
+            while True:
+                start = time.perf_counter()
+                async with self._lock:
+                    batch = await cur.fetchmany(DAILY_ROWS_ITERSIZE)
+                seconds += time.perf_counter() - start
+                if not batch:
+                    break
+                rows += len(batch)
+                for row in batch:
+                    yield row
+            observe_query(DAILY_ROWS_SQL, seconds, rows, [d.name for d in cur.description])
+
+    async def get_plan_rows(self, field_ids, plan_types, start_date, end_date):
+        # [(field_id, plan_type, report_date, prod_ton, prod_bbls, prod_m3, prod_ft3)] of [start_date, end_date)
+        return await self._fetchall(PLAN_ROWS_SQL, {
+            'field_ids': list(field_ids),
+            'plan_types': list(plan_types),
+            'start_date': to_date(start_date),
+            'end_date': to_date(end_date),
+        })
+
+    async def get_row_aggregates(self, row_dates, report_plan):
+        # Same result as PGReportQuery.get_row_aggregates, with the plan and daily
+        # queries of every distinct row date issued concurrently (one pipeline in a snapshot)
+        groups = list(group_rows_by_date(row_dates).items())
+        results = await asyncio.gather(*(
+            query
+            for report_date, rows in groups
+            for query in (
+                self.get_plan_aggregates({field for i in rows for field in report_plan.plan_field_ids[i]},
+                                         report_plan.plan_types, report_date, report_plan.plan_keys),
+                self.get_daily_aggregates(flatten_sub_field_ids([report_plan.sub_field_ids[i] for i in rows]),
+                                          report_plan.prod_type, report_date, report_plan.daily_keys),
+            )
+        ))
+        plans = [None] * len(row_dates)
+        dailies = [None] * len(row_dates)
+        for n, (report_date, rows) in enumerate(groups):
+            for i in rows:
+                plans[i] = results[2 * n]
+                dailies[i] = results[2 * n + 1]
+        return plans, dailies
+
+    #=======REPORTS=========
+    async def get_report(self, kind, query_date, row_dates=None, formatted=True):
+        report_plan = REPORT_PLANS[kind]
+        if row_dates is None:
+            row_dates = [query_date] * len(report_plan.field_names)
+        # Every query of the report reads one snapshot
+        async with self.snapshot() as snapshot:
+            plans, dailies = await snapshot.get_row_aggregates(row_dates, report_plan)
+        return build_report(report_plan, plans, dailies, formatted)
+
+    async def get_report_w_latest_data(self, kind, query_date, formatted=True):
+        report_plan = REPORT_PLANS[kind]
+        async with self.snapshot() as snapshot:
+            _latest_dates = await snapshot.get_latest_dates_by_fields(report_plan.daily_field_ids, report_plan.prod_type, query_date)
+            # Each row is computed once at the latest date its sub-fields have complete data
+            row_dates = latest_row_dates(report_plan.sub_field_ids, _latest_dates, query_date)
+            print_lagging_rows(report_plan.sub_field_ids, row_dates, query_date)
+            report = await snapshot.get_report(kind, query_date, row_dates=row_dates, formatted=formatted)
+        report['Dữ liệu cập nhật đến ngày'] = [v.strftime("%d/%m/%Y") for v in row_dates]
+        return report
+
+    async def get_oil_report(self, query_date, row_dates=None, formatted=True):
+        return await self.get_report('oil', query_date, row_dates=row_dates, formatted=formatted)
+
+    async def get_oil_report_w_latest_data(self, query_date, formatted=True):
+        return await self.get_report_w_latest_data('oil', query_date, formatted=formatted)
+
+    async def get_gas_report(self, query_date, row_dates=None, formatted=True):
+        return await self.get_report('gas', query_date, row_dates=row_dates, formatted=formatted)
+
+    async def get_gas_report_w_latest_data(self, query_date, formatted=True):
+        return await self.get_report_w_latest_data('gas', query_date, formatted=formatted)
+
+
+async def generate_oil_report_async(query_date,
+                    POSTGRES_DB,
+                    POSTGRES_USER,
+                    POSTGRES_PASSWORD,
+                    HOST,
+                    PORT,
+                    row_dates=None,
+                    formatted=True):
+    PGDB = await AsyncPGReportQuery.connect(POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, HOST, PORT)
+    return await PGDB.get_oil_report(query_date, row_dates=row_dates, formatted=formatted)
+
+
+async def generate_oil_report_w_latest_data_async(query_date,
+                    POSTGRES_DB,
+                    POSTGRES_USER,
+                    POSTGRES_PASSWORD,
+                    HOST,
+                    PORT,
+                    formatted=True):
+    PGDB = await AsyncPGReportQuery.connect(POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, HOST, PORT)
+    return await PGDB.get_oil_report_w_latest_data(query_date, formatted=formatted)
+
+
+async def generate_gas_report_async(query_date,
+                    POSTGRES_DB,
+                    POSTGRES_USER,
+                    POSTGRES_PASSWORD,
+                    HOST,
+                    PORT,
+                    row_dates=None,
+                    formatted=True):
+    PGDB = await AsyncPGReportQuery.connect(POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, HOST, PORT)
+    return await PGDB.get_gas_report(query_date, row_dates=row_dates, formatted=formatted)
+
+
+async def generate_gas_report_w_latest_data_async(query_date,
+                    POSTGRES_DB,
+                    POSTGRES_USER,
+                    POSTGRES_PASSWORD,
+                    HOST,
+                    PORT,
+                    formatted=True):
+    PGDB = await AsyncPGReportQuery.connect(POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, HOST, PORT)
+    return await PGDB.get_gas_report_w_latest_data(query_date, formatted=formatted)
+
+
+async def generate_oil_gas_reports_async(query_date,
+                    POSTGRES_DB,
+                    POSTGRES_USER,
+                    POSTGRES_PASSWORD,
+                    HOST,
+                    PORT,
+                    formatted=True):
+    # Oil and gas latest-data reports built concurrently from one READ ONLY REPEATABLE READ
+    # snapshot -> (data watermark or None, oil report, gas report), all of the same data version
+    PGDB = await AsyncPGReportQuery.connect(POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, HOST, PORT)
+    async with PGDB.snapshot() as snapshot:
+        return await asyncio.gather(
+            snapshot.get_data_watermark(query_date),
+            snapshot.get_oil_report_w_latest_data(query_date, formatted=formatted),
+            snapshot.get_gas_report_w_latest_data(query_date, formatted=formatted),
+        )
@@ -1,15 +1,44 @@
-from fastapi import APIRouter
-from .pgdb import generate_oil_report_w_latest_data, generate_gas_report_w_latest_data
-from fastapi.responses import StreamingResponse, JSONResponse
+from functools import partial
+from typing import Optional
+import psycopg2
+from fastapi import APIRouter, Header, HTTPException
+from .pgdb import PGOilQuery, format_report
+from .report_engine import to_date
+from .pgdb_async import generate_oil_report_w_latest_data_async, generate_gas_report_w_latest_data_async
+from .report_range import (
+    generate_oil_report_range,
+    generate_gas_report_range,
+    iter_oil_report_range,
+    iter_gas_report_range,
+)
+from .streaming import csv_response, ndjson_response, prefetch, single_report
+from .serializers import report_response
+from .excel import write_workbook, xlsx_response
+from .cache import cached_oil_gas_reports_async, cached_report_async
+from fastapi.responses import JSONResponse
 import pandas as pd
-from io import StringIO
-from app.schemas.pgsql import ReportRequest
+from app.schemas.pgsql import ReportRequest, RangeReportRequest, DailyProdUpsertRequest
 
 router = APIRouter()
 
-@router.post("/oilreport")
-def gen_df_oil_report(request: ReportRequest):
-    report_df: pd.DataFrame = generate_oil_report_w_latest_data(
+# Reports are cached with float64 values, each endpoint renders them in its own format
+REPORT_GENERATORS = {
+    "oil": partial(generate_oil_report_w_latest_data_async, formatted=False),
+    "gas": partial(generate_gas_report_w_latest_data_async, formatted=False),
+}
+
+def _check_query_date(request: ReportRequest):
+    # A malformed query_date is the client's error, 400 as for the range endpoints
+    try:
+        to_date(request.query_date)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def _report_values(kind, request: ReportRequest):
+    _check_query_date(request)
+    return await cached_report_async(
+        f"{kind}_values",
+        REPORT_GENERATORS[kind],
         request.query_date,
         request.POSTGRES_DB,
         request.POSTGRES_USER,
@@ -17,11 +46,30 @@ def gen_df_oil_report(request: ReportRequest):
         request.HOST,
         request.PORT
     )
-    return JSONResponse(content=report_df.to_dict(orient="records"))
+
+@router.post("/oilreport")
+async def gen_df_oil_report(request: ReportRequest, accept: Optional[str] = Header(None)):
+    """
+    Oil report as JSON records of '%.2f' strings, or typed float64 columns
+    as Arrow IPC / msgpack when the Accept header asks for them
+    """
+    return report_response(await _report_values("oil", request), accept)
 
 @router.post("/gasreport")
-def gen_df_gas_report(request: ReportRequest):
-    report_df: pd.DataFrame = generate_gas_report_w_latest_data(
+async def gen_df_gas_report(request: ReportRequest, accept: Optional[str] = Header(None)):
+    """
+    Gas report as JSON records of '%.2f' strings, or typed float64 columns
+    as Arrow IPC / msgpack when the Accept header asks for them
+    """
+    return report_response(await _report_values("gas", request), accept)
+
+@router.post("/oilgasreport")
+async def gen_df_oil_gas_report(request: ReportRequest):
+    """
+    Oil and gas reports together, built concurrently from one database snapshot
+    """
+    _check_query_date(request)
+    oil_df, gas_df = await cached_oil_gas_reports_async(
         request.query_date,
         request.POSTGRES_DB,
         request.POSTGRES_USER,
@@ -29,27 +77,207 @@ def gen_df_gas_report(request: ReportRequest):
         request.HOST,
         request.PORT
     )
-    return JSONResponse(content=report_df.to_dict(orient="records"))
-
-# @router.post("/oilcsv")
-# def gen_csv_report(request: ReportRequest):
-#     """
-#     Return dataframe as CSV file
-#     """
-#     report_df: pd.DataFrame = generate_oil_report(
-#         request.query_date,
-#         request.POSTGRES_DB,
-#         request.POSTGRES_USER,
-#         request.POSTGRES_PASSWORD,
-#         request.HOST,
-#         request.PORT
-#     )
-
-#     stream = StringIO()
-#     report_df.to_csv(stream, index=False)
-#     response = StreamingResponse(
-#         iter([stream.getvalue()]),
-#         media_type="text/csv"
-#     )
-#     response.headers["Content-Disposition"] = "attachment; filename=daily_oil_report.csv"
-#     return response
\ No newline at end of file
+    return JSONResponse(content={
+        "oil": format_report(oil_df).to_dict(orient="records"),
+        "gas": format_report(gas_df).to_dict(orient="records"),
+    })
+
+@router.post("/oilreport/range")
+async def gen_df_oil_report_range(request: RangeReportRequest, accept: Optional[str] = Header(None)):
+    """
+    Oil report rows of every date from start_date to end_date, computed in one pass
+    """
+    try:
+        report_df: pd.DataFrame = await generate_oil_report_range(
+            request.start_date,
+            request.end_date,
+            request.POSTGRES_DB,
+            request.POSTGRES_USER,
+            request.POSTGRES_PASSWORD,
+            request.HOST,
+            request.PORT,
+            formatted=False
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return report_response(report_df, accept)
+
+@router.post("/gasreport/range")
+async def gen_df_gas_report_range(request: RangeReportRequest, accept: Optional[str] = Header(None)):
+    """
+    Gas report rows of every date from start_date to end_date, computed in one pass
+    """
+    try:
+        report_df: pd.DataFrame = await generate_gas_report_range(
+            request.start_date,
+            request.end_date,
+            request.POSTGRES_DB,
+            request.POSTGRES_USER,
+            request.POSTGRES_PASSWORD,
+            request.HOST,
+            request.PORT,
+            formatted=False
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return report_response(report_df, accept)
+
+async def _report_frames(kind, request: ReportRequest):
+    return single_report(format_report(await _report_values(kind, request)))
+
+async def _formatted_frames(reports):
+    # '%.2f' strings per frame, like the single-day CSV/NDJSON exports
+    async for report in reports:
+        yield format_report(report)
+
+async def _range_frames(kind, request: RangeReportRequest):
+    iter_range = iter_oil_report_range if kind == "oil" else iter_gas_report_range
+    try:
+        return _formatted_frames(await prefetch(iter_range(
+            request.start_date,
+            request.end_date,
+            request.POSTGRES_DB,
+            request.POSTGRES_USER,
+            request.POSTGRES_PASSWORD,
+            request.HOST,
+            request.PORT,
+            formatted=False
+        )))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/oilreport/csv")
+async def gen_csv_oil_report(request: ReportRequest):
+    """
+    Return the oil report as a streamed CSV file
+    """
+    return csv_response(await _report_frames("oil", request), "daily_oil_report.csv")
+
+@router.post("/gasreport/csv")
+async def gen_csv_gas_report(request: ReportRequest):
+    """
+    Return the gas report as a streamed CSV file
+    """
+    return csv_response(await _report_frames("gas", request), "daily_gas_report.csv")
+
+@router.post("/oilreport/ndjson")
+async def gen_ndjson_oil_report(request: ReportRequest):
+    """
+    Return the oil report as newline-delimited JSON, one row per line
+    """
+    return ndjson_response(await _report_frames("oil", request))
+
+@router.post("/gasreport/ndjson")
+async def gen_ndjson_gas_report(request: ReportRequest):
+    """
+    Return the gas report as newline-delimited JSON, one row per line
+    """
+    return ndjson_response(await _report_frames("gas", request))
+
+@router.post("/oilreport/range/csv")
+async def gen_csv_oil_report_range(request: RangeReportRequest):
+    """
+    Stream the oil report rows of every date of the range as CSV, day by day
+    """
+    return csv_response(await _range_frames("oil", request), "oil_report_range.csv")
+
+@router.post("/gasreport/range/csv")
+async def gen_csv_gas_report_range(request: RangeReportRequest):
+    """
+    Stream the gas report rows of every date of the range as CSV, day by day
+    """
+    return csv_response(await _range_frames("gas", request), "gas_report_range.csv")
+
+@router.post("/oilreport/range/ndjson")
+async def gen_ndjson_oil_report_range(request: RangeReportRequest):
+    """
+    Stream the oil report rows of every date of the range as newline-delimited JSON
+    """
+    return ndjson_response(await _range_frames("oil", request))
+
+@router.post("/gasreport/range/ndjson")
+async def gen_ndjson_gas_report_range(request: RangeReportRequest):
+    """
+    Stream the gas report rows of every date of the range as newline-delimited JSON
+    """
+    return ndjson_response(await _range_frames("gas", request))
+
+async def _report_sheets(kind, request: ReportRequest):
+    report = await _report_values(kind, request)
+    yield to_date(request.query_date).strftime("%d-%m-%Y"), report
+
+async def _range_sheets(reports):
+    # One sheet per report date, the date moves from the first column to the sheet title
+    async for report in reports:
+        yield report['Ngày báo cáo'].iloc[0].replace("/", "-"), report.drop(columns='Ngày báo cáo')
+
+async def _range_workbook(kind, request: RangeReportRequest):
+    iter_range = iter_oil_report_range if kind == "oil" else iter_gas_report_range
+    try:
+        return await write_workbook(_range_sheets(iter_range(
+            request.start_date,
+            request.end_date,
+            request.POSTGRES_DB,
+            request.POSTGRES_USER,
+            request.POSTGRES_PASSWORD,
+            request.HOST,
+            request.PORT,
+            formatted=False
+        )))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/oilreport/xlsx")
+async def gen_xlsx_oil_report(request: ReportRequest):
+    """
+    Return the oil report as an .xlsx file in the official column layout
+    """
+    _check_query_date(request)
+    return xlsx_response(await write_workbook(_report_sheets("oil", request)), "daily_oil_report.xlsx")
+
+@router.post("/gasreport/xlsx")
+async def gen_xlsx_gas_report(request: ReportRequest):
+    """
+    Return the gas report as an .xlsx file in the official column layout
+    """
+    _check_query_date(request)
+    return xlsx_response(await write_workbook(_report_sheets("gas", request)), "daily_gas_report.xlsx")
+
+@router.post("/oilreport/range/xlsx")
+async def gen_xlsx_oil_report_range(request: RangeReportRequest):
+    """
+    Return the oil reports of every date of the range as one .xlsx, one sheet per date
+    """
+    return xlsx_response(await _range_workbook("oil", request), "oil_report_range.xlsx")
+
+@router.post("/gasreport/range/xlsx")
+async def gen_xlsx_gas_report_range(request: RangeReportRequest):
+    """
+    Return the gas reports of every date of the range as one .xlsx, one sheet per date
+    """
+    return xlsx_response(await _range_workbook("gas", request), "gas_report_range.xlsx")
+
+@router.post("/dailyprod")
+def upsert_daily_prod(request: DailyProdUpsertRequest):
+    """
+    Insert or correct daily production rows, returns the report dates that changed
+    """
+    try:
+        with PGOilQuery(
+            dbname=request.POSTGRES_DB,
+            user=request.POSTGRES_USER,
+            password=request.POSTGRES_PASSWORD,
+            host=request.HOST,
+            port=request.PORT
+        ) as PGDB:
+            changed_dates = PGDB.upsert_daily_prod([
+                (row.field_id, row.report_date, row.prod_type, row.prod_ton, row.prod_bbls, row.prod_m3, row.prod_ft3)
+                for row in request.rows
+            ])
+    # Malformed rows, values the columns cannot hold and constraint violations are the client's
+    except (ValueError, psycopg2.DataError, psycopg2.IntegrityError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return JSONResponse(content={
+        "rows": len(request.rows),
+        "changed_dates": [d.strftime("%Y/%m/%d") for d in changed_dates],
+    })
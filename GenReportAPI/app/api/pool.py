@@ -0,0 +1,414 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import psycopg2
+import psycopg2.extensions
+
+# Pool sizing, overridable per deployment
+POOL_MIN_SIZE = int(os.environ.get("PG_POOL_MIN_SIZE", 1))
+POOL_MAX_SIZE = int(os.environ.get("PG_POOL_MAX_SIZE", 10))
+# Idle connections above POOL_MIN_SIZE are closed after this many seconds
+POOL_MAX_IDLE = float(os.environ.get("PG_POOL_MAX_IDLE", 300))
+# Idle connections are pinged with SELECT 1 before reuse after this many seconds
+POOL_CHECK_AFTER = float(os.environ.get("PG_POOL_CHECK_AFTER", 30))
+# Seconds to wait for a free connection when the pool is at POOL_MAX_SIZE
+POOL_TIMEOUT = float(os.environ.get("PG_POOL_TIMEOUT", 30))
+# Seconds a new connection may take to reach the server, so an unreachable target fails fast
+CONNECT_TIMEOUT = int(os.environ.get("PG_CONNECT_TIMEOUT", 10))
+# Connections open at once across the pools of every target, sync and async
+POOL_BUDGET = int(os.environ.get("PG_POOL_BUDGET", 100))
+# Seconds between eviction attempts of a request waiting for the budget
+BUDGET_RETRY_INTERVAL = 0.1
+# Seconds between two passes of the maintenance thread over the sync pools
+POOL_MAINTENANCE_INTERVAL = float(os.environ.get("PG_POOL_MAINTENANCE_INTERVAL", 30))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    # psycopg2 connection that remembers the statements prepared on its session
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def _password_digest(password):
+    return hashlib.sha256((password or "").encode("utf-8")).hexdigest()
+
+
+class ConnectionPool:
+    def __init__(self, dbname, user, password, host, port,
+                 min_size=POOL_MIN_SIZE,
+                 max_size=POOL_MAX_SIZE,
+                 max_idle=POOL_MAX_IDLE,
+                 check_after=POOL_CHECK_AFTER,
+                 timeout=POOL_TIMEOUT,
+                 registry=None):
+        self.dbname = dbname
+        self.user = user
+        self.host = host
+        self.port = port
+        self.password_digest = _password_digest(password)
+        self._password = password
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.timeout = timeout
+        self.registry = registry  # PoolRegistry whose budget the connections count against, if any
+        self.key = pool_key(dbname, user, host, port)
+        self._idle = []  # [(conn, last_used)], most recently used last
+        self._size = 0  # idle + borrowed connections
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _connect(self):
+        return psycopg2.connect(
+            host=self.host,
+            port=self.port,
+            dbname=self.dbname,
+            user=self.user,
+            password=self._password,
+            connect_timeout=CONNECT_TIMEOUT,
+            connection_factory=PooledConnection,
+        )
+
+    def _healthy(self, conn, last_used):
+        # Cheap check first, ping only connections that sat idle for a while
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        self._size -= 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        if self.registry is not None:
+            self.registry.release()
+
+    def evict_idle(self):
+        # Close connections idle for longer than max_idle, keeping min_size open
+        now = time.monotonic()
+        with self._cond:
+            keep = []
+            # Oldest first, so the most recently used connections survive
+            for conn, last_used in self._idle:
+                if now - last_used > self.max_idle and self._size > self.min_size:
+                    self._discard(conn)
+                else:
+                    keep.append((conn, last_used))
+            self._idle = keep
+
+    def maintain(self):
+        # Close connections idle past max_idle, then open new ones up to min_size as far as
+        # the budget has free slots, without evicting other targets
+        self.evict_idle()
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.min_size:
+                    return
+                if self.registry is not None and not self.registry.try_acquire():
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except psycopg2.Error:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                if self.registry is not None:
+                    self.registry.release()
+                return
+            self.putconn(conn)
+
+    def getconn(self):
+        self.evict_idle()
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                conn = None
+                while True:
+                    if self._closed:
+                        raise PoolTimeout(f"Pool for {self.dbname}@{self.host}:{self.port} is closed")
+                    if self._idle:
+                        conn, last_used = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(f"No free connection to {self.dbname}@{self.host}:{self.port} after {self.timeout}s")
+                    self._cond.wait(remaining)
+            if conn is None:
+                break
+            # Checked outside the lock, a slow ping holds up no other borrower. The connection
+            # counts as borrowed meanwhile.
+            if self._healthy(conn, last_used):
+                return conn
+            with self._cond:
+                self._discard(conn)
+                self._cond.notify()
+        # Budget and connect outside the lock so a slow handshake does not block other borrowers
+        budgeted = False
+        try:
+            if self.registry is not None:
+                self.registry.acquire(self.key, max(0.0, deadline - time.monotonic()))
+                budgeted = True
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            if budgeted:
+                self.registry.release()
+            raise
+
+    def putconn(self, conn):
+        with self._cond:
+            if self._closed or conn.closed:
+                self._discard(conn)
+            else:
+                try:
+                    # Never hand out a connection in the middle of a transaction
+                    if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                    self._idle.append((conn, time.monotonic()))
+                except psycopg2.Error:
+                    self._discard(conn)
+            self._cond.notify()
+        if self.registry is not None:
+            # The pool may be idle now, so a request waiting for the budget can evict it
+            self.registry.notify_idle()
+
+    def idle(self):
+        # No connection borrowed, so closing the pool interrupts nobody
+        with self._cond:
+            return self._size == len(self._idle)
+
+    def shed_idle(self):
+        # Close the least recently used idle connection, False when there is none
+        with self._cond:
+            if not self._idle:
+                return False
+            conn, _ = self._idle.pop(0)
+            self._discard(conn)
+            return True
+
+    def close(self):
+        # Close idle connections now, borrowed ones when they are returned
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._discard(conn)
+            self._idle = []
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+            }
+
+
+def pool_key(dbname, user, host, port):
+    return (host, int(port), dbname, user)
+
+
+class PoolRegistry:
+    # Pools by target, least recently used first, sharing one budget of open connections.
+    # A pool asks for a slot of the budget before opening a connection and gives it back on close.
+    # When the budget is spent, idle pools of the least recently used targets are closed, then
+    # idle connections of busy ones. Entries implement idle(), shed_idle(), close() and stats().
+    def __init__(self, budget=POOL_BUDGET):
+        self.budget = budget
+        self._entries = OrderedDict()  # key -> pool
+        self._lock = threading.Lock()  # guards _entries
+        self._cond = threading.Condition()  # guards _open
+        self._open = 0
+        self.evictions = 0
+
+    def get(self, key):
+        # Pool of key, now the most recently used, or None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry, reuse=None):
+        # Register entry for key -> (registered pool, replaced pool or None). A pool already
+        # registered for key stays, and is returned instead, when reuse(pool) is true.
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None and reuse is not None and reuse(current):
+                self._entries.move_to_end(key)
+                return current, None
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            return entry, current
+
+    def remove(self, key, entry=None):
+        # Unregister key (only if it is still entry, when given) -> the removed pool, or None
+        with self._lock:
+            if key not in self._entries or (entry is not None and self._entries[key] is not entry):
+                return None
+            return self._entries.pop(key)
+
+    def entries(self, kind=None):
+        # Every registered pool, or the pools of one type, without touching the LRU order
+        with self._lock:
+            return [entry for entry in self._entries.values() if kind is None or isinstance(entry, kind)]
+
+    def clear(self, kind=None):
+        # Unregister every pool, or the pools of one type -> the removed pools
+        with self._lock:
+            keys = [key for key, entry in self._entries.items() if kind is None or isinstance(entry, kind)]
+            return [self._entries.pop(key) for key in keys]
+
+    def acquire(self, key, timeout):
+        # Reserve one connection of the budget for the pool of key, waiting up to timeout
+        # seconds while idle targets are evicted or borrowed connections are closed
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._cond:
+                if self._open < self.budget:
+                    self._open += 1
+                    return
+            self._evict(key)
+            with self._cond:
+                remaining = deadline - time.monotonic()
+                if self._open < self.budget:
+                    continue
+                if remaining <= 0:
+                    raise PoolTimeout(f"Connection budget of {self.budget} spent, no idle target to evict after {timeout}s")
+                # Evicted async pools close on their event loop, release() wakes us up, and so
+                # does a sync pool going idle. Async pools going idle do not tell, so try again
+                # every BUDGET_RETRY_INTERVAL
+                self._cond.wait(min(remaining, BUDGET_RETRY_INTERVAL))
+
+    def try_acquire(self):
+        # Reserve one connection of the budget if a slot is free, never evicting -> True when reserved
+        with self._cond:
+            if self._open < self.budget:
+                self._open += 1
+                return True
+            return False
+
+    def release(self):
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+
+    def notify_idle(self):
+        # A connection was returned to its pool: waiters in acquire() retry the eviction
+        with self._cond:
+            self._cond.notify_all()
+
+    def _evict(self, key):
+        # Close the least recently used idle target other than key, else one idle connection
+        # of the least recently used target that has one -> True when something was closed.
+        # The pools are asked outside _lock, so lookups of other targets never wait on them.
+        with self._lock:
+            others = [(other, entry) for other, entry in self._entries.items() if other != key]
+        for other, entry in others:
+            if not entry.idle():
+                continue
+            with self._lock:
+                # Replaced or evicted by someone else meanwhile
+                if self._entries.get(other) is not entry:
+                    continue
+                del self._entries[other]
+                self.evictions += 1
+            entry.close()
+            return True
+        return any(entry.shed_idle() for _, entry in others)
+
+    def stats(self):
+        # Budget use and the stats of every target, least recently used first. Served without
+        # authentication, so the targets are not named: no host, port, database or user
+        with self._lock:
+            entries = list(self._entries.values())
+        with self._cond:
+            used = self._open
+        return {
+            "budget": self.budget,
+            "open": used,
+            "evictions": self.evictions,
+            "targets": [
+                dict(entry.stats(), type=type(entry).__name__)
+                for entry in entries
+            ],
+        }
+
+
+# Process-wide registry of the sync and async pools, one per target
+pool_registry = PoolRegistry()
+
+
+_maintenance_thread = None
+_maintenance_lock = threading.Lock()
+
+
+def _maintain_pools():
+    # Idle eviction and min_size top-up of the sync pools, also while no request borrows from them
+    while True:
+        time.sleep(POOL_MAINTENANCE_INTERVAL)
+        for pool in pool_registry.entries(ConnectionPool):
+            try:
+                pool.maintain()
+            except Exception as e:
+                print(f"Maintenance of the pool for {pool.dbname}@{pool.host}:{pool.port} failed: {e}")
+
+
+def start_pool_maintenance():
+    # Started with the first sync pool, one daemon thread per process
+    global _maintenance_thread
+    with _maintenance_lock:
+        if _maintenance_thread is None:
+            _maintenance_thread = threading.Thread(target=_maintain_pools, name="pg-pool-maintenance", daemon=True)
+            _maintenance_thread.start()
+
+
+def get_pool(dbname, user, password, host, port):
+    start_pool_maintenance()
+    key = pool_key(dbname, user, host, port)
+    pool = pool_registry.get(key)
+    if pool is not None and pool.password_digest == _password_digest(password):
+        return pool
+    # Unknown target or a different password: authenticate with a fresh connection
+    # before creating or replacing the pool, so a wrong password never borrows
+    # an already authenticated connection
+    new_pool = ConnectionPool(dbname, user, password, host, port, registry=pool_registry)
+    conn = new_pool.getconn()
+    pool, replaced = pool_registry.put(key, new_pool, reuse=lambda p: p.password_digest == new_pool.password_digest)
+    new_pool.putconn(conn)
+    if pool is not new_pool:
+        new_pool.close()
+    if replaced is not None:
+        replaced.close()
+    return pool
+
+
+def close_all_pools():
+    for pool in pool_registry.clear(ConnectionPool):
+        pool.close()
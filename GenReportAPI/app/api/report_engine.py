@@ -0,0 +1,402 @@
+import functools
+import re
+from datetime import date, datetime
+
+# %(name)s parameter of the report queries
+SQL_PARAMETER = re.compile(r"%\((\w+)\)s")
+
+# First statement of a report's transaction: every query of the report reads the same data
+SNAPSHOT_TRANSACTION_SQL = "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;"
+
+# Unit columns shared by daily_prod and plan_prod
+UNITS = ('prod_ton', 'prod_bbls', 'prod_m3', 'prod_ft3')
+
+# Decimals the daily_prod and plan_prod units are stored with. The report rounds its sums to
+# them, so a sum does not depend on the order its rows were added in: SQL SUM, the monthly_prod
+# rollup, the running sums of the range reports and the vectorized engine all give one value.
+DAILY_DECIMALS = 6
+PLAN_DECIMALS = 9
+
+# Daily windows, all restricted to [1/1/year, report_date] by the WHERE clause
+#   prev: 1/1 -> end of previous month (Column E)
+#   mtd:  1st of month -> report_date  (Column J)
+#   ytd:  1/1 -> report_date           (Column N)
+#   day:  report_date only             (Column Q, R)
+DAILY_WINDOWS = {
+    'prev': "report_date < %(month_start)s",
+    'mtd': "report_date >= %(month_start)s",
+    'ytd': "report_date >= %(year_start)s",
+    'day': "report_date = %(report_date)s",
+}
+
+# Plan windows, all restricted to the plan year by the WHERE clause
+#   year:  whole year (Column C, D)
+#   month: month of report_date (Column H, I)
+PLAN_WINDOWS = {
+    'year': "report_date >= %(year_start)s",
+    'month': "report_date >= %(month_start)s AND report_date < %(next_month)s",
+}
+
+DAILY_AGGREGATE_KEYS = tuple(f'{window}_{unit}' for window in DAILY_WINDOWS for unit in UNITS)
+PLAN_AGGREGATE_KEYS = tuple(f'{window}_{unit}' for window in PLAN_WINDOWS for unit in UNITS)
+
+
+def split_aggregate_key(key):
+    # 'prev_prod_ton' -> ('prev', 'prod_ton')
+    window, unit = key.split('_', 1)
+    return window, unit
+
+
+def _aggregate_columns(windows, keys):
+    return ",\n".join(
+        f"SUM({unit}) FILTER (WHERE {windows[window]}) AS {window}_{unit}"
+        for window, unit in map(split_aggregate_key, keys)
+    )
+
+
+# The aggregate queries select only the keys a report plan reads, in the order of keys and named after them.
+# Cached, so a plan always runs the same SQL text.
+@functools.lru_cache(maxsize=None)
+def daily_aggregates_sql(keys=DAILY_AGGREGATE_KEYS):
+    return f"""
+    SELECT field_id,
+        {_aggregate_columns(DAILY_WINDOWS, keys)}
+    FROM daily_prod
+    WHERE field_id = ANY(%(field_ids)s) AND prod_type = %(prod_type)s
+    AND report_date >= %(year_start)s AND report_date <= %(report_date)s
+    GROUP BY field_id;
+"""
+
+
+# Same result as daily_aggregates_sql, with the previous months read from the
+# monthly_prod rollup and only the current month scanned in daily_prod
+@functools.lru_cache(maxsize=None)
+def daily_aggregates_rollup_sql(keys=DAILY_AGGREGATE_KEYS):
+    windows = [split_aggregate_key(key) for key in keys]
+    prev_units = [unit for unit in UNITS if ('prev', unit) in windows or ('ytd', unit) in windows]
+    mtd_units = [unit for unit in UNITS if ('mtd', unit) in windows or ('ytd', unit) in windows]
+    day_units = [unit for unit in UNITS if ('day', unit) in windows]
+    columns = {
+        'prev': "prev.{unit}",
+        'mtd': "cur.mtd_{unit}",
+        'ytd': "COALESCE(prev.{unit} + cur.mtd_{unit}, prev.{unit}, cur.mtd_{unit})",
+        'day': "cur.day_{unit}",
+    }
+    return f"""
+    WITH prev AS (
+        SELECT {", ".join(['field_id'] + [f"SUM({unit}) AS {unit}" for unit in prev_units])}
+        FROM monthly_prod
+        WHERE field_id = ANY(%(field_ids)s) AND prod_type = %(prod_type)s
+        AND year = %(year)s AND month < %(month)s
+        GROUP BY field_id
+    ), cur AS (
+        SELECT {", ".join(['field_id']
+                          + [f"SUM({unit}) AS mtd_{unit}" for unit in mtd_units]
+                          + [f"SUM({unit}) FILTER (WHERE report_date = %(report_date)s) AS day_{unit}" for unit in day_units])}
+        FROM daily_prod
+        WHERE field_id = ANY(%(field_ids)s) AND prod_type = %(prod_type)s
+        AND report_date >= %(month_start)s AND report_date <= %(report_date)s
+        GROUP BY field_id
+    )
+    SELECT field_id,
+        {", ".join(f"{columns[window].format(unit=unit)} AS {window}_{unit}" for window, unit in windows)}
+    FROM prev FULL JOIN cur USING (field_id);
+"""
+
+
+@functools.lru_cache(maxsize=None)
+def plan_aggregates_sql(keys=PLAN_AGGREGATE_KEYS):
+    return f"""
+    SELECT field_id, plan_type,
+        {_aggregate_columns(PLAN_WINDOWS, keys)}
+    FROM plan_prod
+    WHERE field_id = ANY(%(field_ids)s) AND plan_type = ANY(%(plan_types)s)
+    AND report_date >= %(year_start)s AND report_date < %(next_year)s
+    GROUP BY field_id, plan_type;
+"""
+
+
+# Every window of every unit
+DAILY_AGGREGATES_SQL = daily_aggregates_sql()
+DAILY_AGGREGATES_ROLLUP_SQL = daily_aggregates_rollup_sql()
+PLAN_AGGREGATES_SQL = plan_aggregates_sql()
+
+# Raw rows for the range reports, which accumulate the windows themselves in one ordered pass
+DAILY_ROWS_SQL = f"""
+    SELECT field_id, report_date, {", ".join(UNITS)}
+    FROM daily_prod
+    WHERE field_id = ANY(%(field_ids)s) AND prod_type = %(prod_type)s
+    AND report_date >= %(start_date)s AND report_date <= %(end_date)s
+    ORDER BY report_date;
+"""
+
+PLAN_ROWS_SQL = f"""
+    SELECT field_id, plan_type, report_date, {", ".join(UNITS)}
+    FROM plan_prod
+    WHERE field_id = ANY(%(field_ids)s) AND plan_type = ANY(%(plan_types)s)
+    AND report_date >= %(start_date)s AND report_date < %(end_date)s;
+"""
+
+# Latest change to the daily rows up to report_date and the plan rows up to its year end,
+# i.e. everything a report for report_date can read
+DATA_WATERMARK_SQL = """
+    SELECT COALESCE(MAX(version) FILTER (WHERE table_name = 'daily_prod' AND report_date <= %(report_date)s), 0),
+           COALESCE(MAX(version) FILTER (WHERE table_name = 'plan_prod' AND report_date < %(next_year)s), 0)
+    FROM data_version;
+"""
+
+
+# Units that must all be present for a daily row to count as complete
+COMPLETE_UNITS = {
+    'OIL_PROD': ('prod_ton', 'prod_bbls'),
+    'GAS_PROD': ('prod_m3', 'prod_ft3'),
+}
+
+LATEST_COMPLETE_DATES_SQL = """
+    SELECT DISTINCT ON (field_id) field_id, report_date
+    FROM daily_prod
+    WHERE field_id = ANY(%(field_ids)s) AND prod_type = %(prod_type)s
+    AND report_date <= %(query_date)s AND {complete}
+    ORDER BY field_id, report_date DESC;
+"""
+
+
+# Same result from the complete_dates index (schema version 5 on): one backward probe per field
+LATEST_COMPLETE_DATES_INDEX_SQL = """
+    SELECT f.field_id, c.report_date
+    FROM unnest(%(field_ids)s::VARCHAR[]) AS f(field_id)
+    CROSS JOIN LATERAL (
+        SELECT report_date FROM complete_dates
+        WHERE field_id = f.field_id AND prod_type = %(prod_type)s AND report_date <= %(query_date)s
+        ORDER BY report_date DESC
+        LIMIT 1
+    ) c;
+"""
+
+
+def latest_complete_dates_sql(prod_type, indexed=False):
+    # Query of the latest complete date of each field, None for a product without complete units
+    units = COMPLETE_UNITS.get(prod_type)
+    if units is None:
+        return None
+    if indexed:
+        return LATEST_COMPLETE_DATES_INDEX_SQL
+    return LATEST_COMPLETE_DATES_SQL.format(complete=" AND ".join(f"{unit} IS NOT NULL" for unit in units))
+
+
+def to_date(value):
+    # "%Y/%m/%d" string, datetime or date -> date
+    if isinstance(value, str):
+        return datetime.strptime(value, "%Y/%m/%d").date()
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+
+def year_range(year):
+    # Half-open [1/1/year, 1/1/year+1), lets the planner use an index on report_date
+    return date(int(year), 1, 1), date(int(year) + 1, 1, 1)
+
+
+def month_range(year, month):
+    # Half-open [1st of month, 1st of next month)
+    year, month = int(year), int(month)
+    if month == 12:
+        return date(year, 12, 1), date(year + 1, 1, 1)
+    return date(year, month, 1), date(year, month + 1, 1)
+
+
+def report_window_params(report_date):
+    # Boundaries of the report windows for a date, as half-open ranges
+    report_date = to_date(report_date)
+    year_start, next_year = year_range(report_date.year)
+    month_start, next_month = month_range(report_date.year, report_date.month)
+    return {
+        'report_date': report_date,
+        'year': report_date.year,
+        'month': report_date.month,
+        'year_start': year_start,
+        'month_start': month_start,
+        'next_month': next_month,
+        'next_year': next_year,
+    }
+
+
+def flatten_sub_field_ids(sub_field_ids):
+    # ('BH', 'R'), 'TGT' -> ['BH', 'R', 'TGT']
+    flat = []
+    for _field in sub_field_ids:
+        for sub_field in (_field if isinstance(_field, tuple) else (_field,)):
+            if sub_field not in flat:
+                flat.append(sub_field)
+    return flat
+
+
+def sum_sub_fields(daily, _field, key, unused_fields=()):
+    # Sum one daily aggregate over the sub-fields of a report row, missing data counts as 0
+    _v = 0
+    for sub_field in (_field if isinstance(_field, tuple) else (_field,)):
+        if sub_field in unused_fields:
+            continue
+        _prod = daily.get(sub_field, {}).get(key)
+        if _prod is not None:
+            _v += _prod
+    return _v
+
+
+def plan_value(plan, field_id, plan_type, key):
+    # Plan aggregate of one field, missing plan counts as 0
+    _v = plan.get((field_id, plan_type), {}).get(key)
+    return _v if _v is not None else 0
+
+
+def group_rows_by_date(row_dates):
+    # [d1, d2, d1] -> {d1: [0, 2], d2: [1]}
+    groups = {}
+    for i, report_date in enumerate(row_dates):
+        groups.setdefault(to_date(report_date), []).append(i)
+    return groups
+
+
+def latest_row_dates(sub_field_ids, latest_dates, query_date):
+    # Effective date of each report row: latest complete date of its sub-fields,
+    # query_date when none of them has data
+    row_dates = []
+    for _field in sub_field_ids:
+        valid_dates = [latest_dates[sub_field] for sub_field in (_field if isinstance(_field, tuple) else (_field,))
+                       if latest_dates.get(sub_field) is not None]
+        row_dates.append(max(valid_dates) if valid_dates else to_date(query_date))
+    return row_dates
+
+
+def print_lagging_rows(sub_field_ids, row_dates, query_date):
+    # Log the report rows whose latest complete data is older than query_date
+    for k, v in zip(sub_field_ids, row_dates):
+        if v != to_date(query_date):
+            print(f"Field {k} has latest data on {v.strftime('%Y/%m/%d')}, not {query_date}")
+
+
+#=======REPORT SPECS=========
+# Every report is declared here and compiled once into a ReportPlan (report_plan.py).
+#   prod_type:       daily_prod rows the report sums
+#   plan_field_type: field_type of its plan fields in the field table
+#   plan_types:      alias used in the formulas -> plan_type of plan_prod
+#   unused_fields:   sub-fields daily_used() leaves out
+#   rows:            (column B name, plan field, daily sub-fields); the plan field is one id for
+#                    every plan type or {alias: id}
+#   columns:         (letter, header, formula), the formula of column B is None
+# Formulas are arithmetic over numbers, earlier column letters and
+#   plan(ALIAS, window, unit)      plan total of the row's plan field, window of PLAN_WINDOWS
+#   daily(window, unit)            total of the row's sub-fields, window of DAILY_WINDOWS
+#   daily_used(window, unit)       same without unused_fields
+#   ratio(numerator, denominator)  0 when the denominator is 0
+# with missing data counted as 0.
+
+# Sub-fields left out of the bbls/ft3 and daily columns of grouped rows
+UNUSED_FIELDS = ['Pearl', 'Topaz', 'Diamond', 'HSD']
+
+OIL_REPORT_SPEC = {
+    'prod_type': 'OIL_PROD',
+    'plan_field_type': 'OIL_PLAN',
+    'plan_types': {'KHCP': 'KHSLCPGiaoOil', 'KHQT': 'KHQTOIL'},
+    'unused_fields': UNUSED_FIELDS,
+    'rows': [
+        ("Bạch Hổ & Rồng& 50%NR-ĐM", 'BHR', ('BH', 'R', 'GT', 'ThT', 'NR')),
+        ("NR-ĐM (Zarubezhneft)", 'DM', 'DM'),
+        ("Cond. Dinh Cố & GPP Ca Mau", 'DC', 'DC-GPP'),
+        ("Đại Hùng", 'DH', 'DH'),
+        ("PM3-CAA", 'PM3CA', 'PM3CAA'),
+        ("46 CN", '46CN', '46CN'),
+        ("Rạng Đông+Phương Đông", 'RDPD', ('RangDong', 'PhuongDong')),
+        ("Ruby+Pearl+Topaz+ Diamond", 'RPT', ('Ruby', 'Pearl', 'Topaz', 'Diamond')),
+        ("STĐ+STV+STT+STN", 'STD-STV-STT-STN', ('STD', 'STV', 'STD-DB', 'STT', 'STN')),
+        ("Cá Ngừ Vàng", 'CNV', 'CNV'),
+        ("Tê  Giác Trắng", 'TGT', 'TGT'),
+        ("Chim Sáo+ Dừa", 'CS', 'CS'),
+        ("Lan Tây + Lan Đỏ", 'LTLD', 'LT'),
+        ("Rồng Đôi+Rồng Đôi Tây", 'RD-RDT', 'RD-RDT'),
+        ("Hải Sư Trắng +Hải Sư Đen", 'HST-HSD', ('HST', 'HSD')),
+        ("Thăng Long + Đông Đô", 'TLDD', 'TLDD'),
+        ("Hải Thạch + Mộc Tinh", 'HT-MT', 'HT-MT'),
+        ("Kình Ngư Trắng - Nam", 'KNT-N', 'KNT-N'),
+        ("Cá Tầm", 'CT', 'CT'),
+        ("Thiên Ưng", 'ThienUng', 'ThienUng'),
+        ("Sao Vàng -Đại Nguyệt", 'SVDN', 'SV'),
+        ("Nhenhesky (49%VN)", 'Nhenhexky', 'Nhenhexky'),
+        ("Algeria", 'Algeria', 'Algeria'),
+    ],
+    # Plans in tr.tấn, daily_prod in ton
+    'columns': [
+        ('B', "Mỏ", None),
+        ('C', "KHCP  (tr.tấn)", "plan(KHCP, year, prod_ton)"),
+        ('D', "KHQT  (tr.tấn)", "plan(KHQT, year, prod_ton)"),
+        ('E', "Tháng trước - Cộng dồn (ng.tấn)", "daily(prev, prod_ton) / 1000"),
+        ('F', "Tháng trước - %KHCP", "ratio(E * 100, 1000 * C)"),
+        ('G', "Tháng trước - %KHQT", "ratio(E * 100, 1000 * D)"),
+        ('H', "Tháng này - KHCP (ng.tấn)", "plan(KHCP, month, prod_ton) * 1000"),
+        ('I', "Tháng này - KHQT (ng.tấn)", "plan(KHQT, month, prod_ton) * 1000"),
+        ('J', "Tháng này - Thực hiện (ng.tấn)", "daily(mtd, prod_ton) / 1000"),
+        ('K', "Tháng này - %KHCP", "ratio(J * 100, H)"),
+        ('L', "Tháng này - %KHQT", "ratio(J * 100, I)"),
+        ('M', "SL hiện tại - Cộng dồn (ng.tấn)", "E + J"),
+        ('N', "SL hiện tại - Cộng dồn (thùng)", "daily_used(ytd, prod_bbls)"),
+        ('O', "SL hiện tại - %KHCP", "ratio(M, 1000 * C)"),
+        ('P', "SL hiện tại - %KHQT", "ratio(M, 1000 * D)"),
+        ('Q', "SL ngày (tấn)", "daily_used(day, prod_ton)"),
+        ('R', "SL ngày (thùng)", "daily_used(day, prod_bbls)"),
+    ],
+}
+
+GAS_REPORT_SPEC = {
+    'prod_type': 'GAS_PROD',
+    'plan_field_type': 'GAS_PLAN',
+    'plan_types': {'KHCP': 'KHSLCPGiaoGas', 'KHQT': 'KHQTGAS'},
+    'unused_fields': UNUSED_FIELDS,
+    'rows': [
+        ('Bạch Hổ+ Rồng', 'BH', ('BH', 'R')),
+        ('Tê Giác Trắng', 'TGT', 'TGT'),
+        ('Rạng Đông+Phương Đông', {'KHCP': 'RDPD', 'KHQT': 'RangDong'}, ('RangDong', 'PhuongDong')),
+        ('Chim Sáo+  Dừa', {'KHCP': 'CS-D', 'KHQT': 'CS'}, 'CS'),
+        ('STĐ+STV+STT+STN', {'KHCP': 'STD-STV-STT-STN', 'KHQT': 'STD-STV-STT'}, ('STD', 'STV', 'STD-DB', 'STT', 'STN')),
+        ('Cá Ngừ Vàng', 'CNV', 'CNV'),
+        ('Kình Ngư Trắng', 'KNT-N', 'KNT-N'),
+        ('Lan Tây+Lan Đỏ', 'LTLD', 'LT'),
+        ('Rồng Đôi+Rồng Đôi Tây', 'RD-RDT', 'RD-RDT'),
+        ('Lô PM3-CAA ( tổng khí về bờ)', 'PM3CA-46CN', 'PM3-46CN'),
+        ('Hải Sư Trắng +Hải Sư Đen', 'HST-HSD', 'HST-HSD'),
+        ('Hải Thạch + Mộc Tinh', 'HT-MT', 'HT'),
+        ('Thái Bình', 'TB', 'ThaiBinh'),
+        ('Thiên Ưng', 'ThienUng', 'ThienUng'),
+        ('Sao Vàng -Đại Nguyet', 'SVDN', 'SV'),
+        ('Đại Hùng', 'DH', 'DH'),
+        ('Cá Tầm', 'CT', 'CT'),
+    ],
+    # Plans and daily_prod both in tr.m3
+    'columns': [
+        ('B', "Mỏ", None),
+        ('C', "KHCP  (tr.m3)", "plan(KHCP, year, prod_m3)"),
+        ('D', "KHQT  (tr.m3)", "plan(KHQT, year, prod_m3)"),
+        ('E', "Tháng trước - Cộng dồn (tr.m3)", "daily(prev, prod_m3)"),
+        ('F', "Tháng trước - %KHCP", "ratio(E * 100, C)"),
+        ('G', "Tháng trước - %KHQT", "ratio(E * 100, D)"),
+        ('H', "Tháng này - KHCP (tr.m3)", "plan(KHCP, month, prod_m3)"),
+        ('I', "Tháng này - KHQT (tr.m3)", "plan(KHQT, month, prod_m3)"),
+        ('J', "Tháng này - Thực hiện (tr.m3)", "daily(mtd, prod_m3)"),
+        ('K', "Tháng này - %KHCP", "ratio(J * 100, H)"),
+        ('L', "Tháng này - %KHQT", "ratio(J * 100, I)"),
+        ('M', "SL hiện tại - Cộng dồn (tr.m3)", "E + J"),
+        ('N', "SL hiện tại - Cộng dồn (tr.ft3)", "daily_used(ytd, prod_ft3)"),
+        ('O', "SL hiện tại - %KHCP", "ratio(100 * M, C)"),
+        ('P', "SL hiện tại - %KHQT", "ratio(100 * M, D)"),
+        ('Q', "SL ngày (tr.m3)", "daily(day, prod_m3)"),
+        ('R', "SL ngày (tr.ft3)", "daily_used(day, prod_ft3)"),
+    ],
+}
+
+REPORT_SPECS = {
+    'oil': OIL_REPORT_SPEC,
+    'gas': GAS_REPORT_SPEC,
+}
+
+# prod_type of the daily_prod rows the reports read
+DAILY_PROD_TYPES = tuple(spec['prod_type'] for spec in REPORT_SPECS.values())
@@ -0,0 +1,211 @@
+"""Report specs (report_engine.REPORT_SPECS) compiled into query plans.
+
+A ReportPlan is built once per spec when the module is imported. It holds the row layout,
+the aggregates the column formulas read, each kept once however many formulas call it, and
+aggregate SQL selecting only the (window, unit) pairs those aggregates need: 5 of the 16
+daily and 2 of the 8 plan sums for the oil and gas reports. daily() and daily_used() of the
+same window and unit share one SQL column.
+
+The formulas are checked and compiled to code objects, then evaluated column by column
+over arrays with one value per report row. The SQL engine fills those arrays from its
+grouped queries, the vectorized engine from its snapshot, so both share the column logic.
+"""
+import ast
+
+import numpy as np
+
+from .report_engine import (
+    DAILY_DECIMALS,
+    DAILY_WINDOWS,
+    PLAN_DECIMALS,
+    PLAN_WINDOWS,
+    REPORT_SPECS,
+    UNITS,
+    daily_aggregates_rollup_sql,
+    daily_aggregates_sql,
+    flatten_sub_field_ids,
+    plan_aggregates_sql,
+    plan_value,
+    sum_sub_fields,
+)
+
+# Aggregate functions of the formulas -> number of arguments
+AGGREGATE_FUNCTIONS = {'plan': 3, 'daily': 2, 'daily_used': 2}
+
+# Syntax a formula may use besides calls, names and numbers
+_FORMULA_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.USub, ast.Load)
+
+
+def ratio(numerator, denominator):
+    # numerator / denominator over report rows, 0 where the denominator is 0
+    numerator, denominator = np.broadcast_arrays(np.asarray(numerator, dtype='float64'),
+                                                 np.asarray(denominator, dtype='float64'))
+    return np.divide(numerator, denominator, out=np.zeros(numerator.shape), where=denominator != 0)
+
+
+class _FormulaCompiler(ast.NodeTransformer):
+    # Checks one formula and replaces its aggregate calls by the names of the plan's aggregates
+    def __init__(self, report_plan, letter, columns):
+        self.report_plan = report_plan
+        self.letter = letter
+        self.columns = columns
+        self.reads = set()  # aggregates the formula reads, directly or through earlier columns
+
+    def fail(self, message):
+        raise ValueError(f"{self.report_plan.kind} report, column {self.letter}: {message}")
+
+    def visit(self, node):
+        if isinstance(node, (ast.Call, ast.Name, ast.Constant)) or isinstance(node, _FORMULA_NODES):
+            return super().visit(node)
+        return self.fail(f"{type(node).__name__} is not allowed in a formula")
+
+    def visit_Constant(self, node):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            self.fail(f"constant {node.value!r} is not a number")
+        return node
+
+    def visit_Name(self, node):
+        if node.id not in self.columns:
+            self.fail(f"{node.id} is not an earlier column")
+        self.reads |= self.report_plan.column_aggregates[node.id]
+        return node
+
+    def visit_Call(self, node):
+        name = node.func.id if isinstance(node.func, ast.Name) else None
+        if node.keywords:
+            self.fail("keyword arguments are not allowed")
+        if name == 'ratio':
+            if len(node.args) != 2:
+                self.fail("ratio() takes a numerator and a denominator")
+            node.args = [self.visit(arg) for arg in node.args]
+            return node
+        if name not in AGGREGATE_FUNCTIONS:
+            self.fail(f"unknown function {name}()")
+        if len(node.args) != AGGREGATE_FUNCTIONS[name] or not all(isinstance(arg, ast.Name) for arg in node.args):
+            self.fail(f"{name}() takes {AGGREGATE_FUNCTIONS[name]} bare names")
+        args = [arg.id for arg in node.args]
+        if name == 'plan':
+            alias, window, unit = args
+            if alias not in self.report_plan.plan_aliases:
+                self.fail(f"unknown plan type alias {alias}")
+            if window not in PLAN_WINDOWS:
+                self.fail(f"unknown plan window {window}")
+            aggregate = ('plan', self.report_plan.plan_aliases[alias], window, unit)
+        else:
+            window, unit = args
+            if window not in DAILY_WINDOWS:
+                self.fail(f"unknown daily window {window}")
+            aggregate = ('daily', window, unit, name == 'daily_used')
+        if unit not in UNITS:
+            self.fail(f"unknown unit {unit}")
+        # Shared by every formula reading the same aggregate
+        aggregate_name = self.report_plan.aggregates.setdefault(aggregate, f"_a{len(self.report_plan.aggregates)}")
+        self.reads.add(aggregate)
+        return ast.copy_location(ast.Name(id=aggregate_name, ctx=ast.Load()), node)
+
+
+class ReportPlan:
+    # One report spec compiled: row layout, deduplicated aggregates and their SQL, column code
+    def __init__(self, kind, spec):
+        self.kind = kind
+        self.prod_type = spec['prod_type']
+        self.plan_field_type = spec['plan_field_type']
+        self.plan_aliases = dict(spec['plan_types'])
+        self.unused_fields = tuple(spec.get('unused_fields', ()))
+
+        # Rows
+        self.field_names = [name for name, _, _ in spec['rows']]
+        self.sub_field_ids = [sub_fields for _, _, sub_fields in spec['rows']]
+        self.daily_field_ids = flatten_sub_field_ids(self.sub_field_ids)
+        # {plan_type: plan field} of every row
+        self.row_plan_fields = [
+            {plan_type: plan_field if isinstance(plan_field, str) else plan_field[alias]
+             for alias, plan_type in self.plan_aliases.items()}
+            for _, plan_field, _ in spec['rows']
+        ]
+
+        # Columns, compiled in order so a formula can only read the columns before it
+        self.aggregates = {}  # ('plan', plan_type, window, unit) or ('daily', window, unit, used) -> name
+        self.column_aggregates = {}  # letter -> aggregates the column is computed from
+        self.headers = []
+        self._columns = []  # (letter, header, code or None)
+        letters = set()
+        for letter, header, formula in spec['columns']:
+            if formula is None:
+                code = None
+            else:
+                try:
+                    tree = ast.parse(formula, mode='eval')
+                except SyntaxError as e:
+                    raise ValueError(f"{kind} report, column {letter}: {e}") from None
+                compiler = _FormulaCompiler(self, letter, letters)
+                tree = ast.fix_missing_locations(compiler.visit(tree))
+                self.column_aggregates[letter] = frozenset(compiler.reads)
+                code = compile(tree, f"<{kind} report column {letter}>", 'eval')
+            self.headers.append(header)
+            self._columns.append((letter, header, code))
+            letters.add(letter)
+
+        # Only the plan types, plan fields and (window, unit) pairs the formulas read
+        used_plan_types = {aggregate[1] for aggregate in self.aggregates if aggregate[0] == 'plan'}
+        self.plan_types = tuple(t for t in self.plan_aliases.values() if t in used_plan_types)
+        self.plan_field_ids = [tuple(dict.fromkeys(fields[t] for t in self.plan_types)) for fields in self.row_plan_fields]
+        self.plan_fields = list(dict.fromkeys(fields[t] for t in self.plan_types for fields in self.row_plan_fields))
+        self.daily_keys = tuple(dict.fromkeys(
+            f'{window}_{unit}' for _, window, unit, _ in self._aggregates_of('daily')))
+        self.plan_keys = tuple(dict.fromkeys(
+            f'{window}_{unit}' for _, _, window, unit in self._aggregates_of('plan')))
+        self.daily_sql = daily_aggregates_sql(self.daily_keys)
+        self.daily_rollup_sql = daily_aggregates_rollup_sql(self.daily_keys)
+        self.plan_sql = plan_aggregates_sql(self.plan_keys)
+        self._decimals = {
+            name: PLAN_DECIMALS if aggregate[0] == 'plan' else DAILY_DECIMALS
+            for aggregate, name in self.aggregates.items()
+        }
+
+    def _aggregates_of(self, kind):
+        return [aggregate for aggregate in self.aggregates if aggregate[0] == kind]
+
+    def aggregate_values(self, plans, dailies):
+        # {aggregate name: array over the report rows} from the plan and daily aggregates of each row
+        values = {}
+        for aggregate, name in self.aggregates.items():
+            if aggregate[0] == 'plan':
+                _, plan_type, window, unit = aggregate
+                values[name] = np.array([
+                    plan_value(plan, fields[plan_type], plan_type, f'{window}_{unit}')
+                    for fields, plan in zip(self.row_plan_fields, plans)
+                ], dtype='float64')
+            else:
+                _, window, unit, used = aggregate
+                unused_fields = self.unused_fields if used else ()
+                values[name] = np.array([
+                    sum_sub_fields(daily, _field, f'{window}_{unit}', unused_fields)
+                    for _field, daily in zip(self.sub_field_ids, dailies)
+                ], dtype='float64')
+        return values
+
+    def evaluate(self, values):
+        # Aggregate arrays -> {header: column} with the field names first. The sums are rounded
+        # to the stored decimals first, so every engine evaluates the formulas on the same values.
+        namespace = {name: np.round(value, self._decimals[name]) for name, value in values.items()}
+        namespace['ratio'] = ratio
+        data = {}
+        for letter, header, code in self._columns:
+            if code is None:
+                data[header] = self.field_names
+            else:
+                namespace[letter] = data[header] = eval(code, {'__builtins__': {}}, namespace)
+        return data
+
+    def build(self, plans, dailies):
+        # {header: column} of the report from the plan and daily aggregates of each row
+        return self.evaluate(self.aggregate_values(plans, dailies))
+
+
+def compile_report_specs(specs):
+    return {kind: ReportPlan(kind, spec) for kind, spec in specs.items()}
+
+
+# Compiled at import, a broken spec fails at startup rather than on the first request
+REPORT_PLANS = compile_report_specs(REPORT_SPECS)
@@ -0,0 +1,101 @@
+import contextlib
+
+from .field_metadata import FIELD_METADATA_SQL, field_metadata_from_rows
+from .report_engine import (
+    DAILY_AGGREGATE_KEYS,
+    PLAN_AGGREGATE_KEYS,
+    daily_aggregates_rollup_sql,
+    daily_aggregates_sql,
+    flatten_sub_field_ids,
+    group_rows_by_date,
+    latest_complete_dates_sql,
+    plan_aggregates_sql,
+    report_window_params,
+    to_date,
+)
+
+
+class ReportQuery:
+    # Report queries over a storage backend. A backend runs the %(name)s SQL of report_engine
+    # against its field, plan_prod and daily_prod tables by implementing query() and close(),
+    # has_monthly_rollup() when it maintains monthly_prod and has_complete_dates() when it
+    # maintains complete_dates.
+    def query(self, sql, params=None):
+        # -> (column names, list of row tuples)
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def has_monthly_rollup(self):
+        return False
+
+    def has_complete_dates(self):
+        return False
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        # Block whose queries all read the same data. Backends with concurrent writers
+        # override this with a transaction, embedded ones have nothing to isolate from.
+        yield self
+
+    def load_field_metadata(self):
+        # {(field_id, field_type): FieldInfo} read from the field table
+        return field_metadata_from_rows(*self.query(FIELD_METADATA_SQL))
+
+    def get_field_metadata(self):
+        return self.load_field_metadata()
+
+    #=======SET-BASED AGGREGATES=========
+    def get_daily_aggregates(self, field_ids, prod_type, report_date, keys=DAILY_AGGREGATE_KEYS):
+        # Previous months, month-to-date, year-to-date and daily totals (keys, every unit by default)
+        # for all field_ids in one grouped query -> {field_id: {'mtd_prod_ton': ..., ...}}
+        params = report_window_params(report_date)
+        params.update(field_ids=list(field_ids), prod_type=prod_type)
+        sql = daily_aggregates_rollup_sql(keys) if self.has_monthly_rollup() else daily_aggregates_sql(keys)
+        _, rows = self.query(sql, params)
+        return {row[0]: dict(zip(keys, row[1:])) for row in rows}
+
+    def get_plan_aggregates(self, field_ids, plan_types, report_date, keys=PLAN_AGGREGATE_KEYS):
+        # Year and month plan totals (keys, every unit by default) for all (field_id, plan_type)
+        # in one grouped query -> {(field_id, plan_type): {'year_prod_ton': ..., 'month_prod_ton': ..., ...}}
+        params = report_window_params(report_date)
+        params.update(field_ids=list(field_ids), plan_types=list(plan_types))
+        _, rows = self.query(plan_aggregates_sql(keys), params)
+        return {(row[0], row[1]): dict(zip(keys, row[2:])) for row in rows}
+
+    def get_latest_dates_by_fields(self, field_ids, prod_type, query_date):
+        # Latest date on or before query_date with complete units (ton+bbls for OIL_PROD,
+        # m3+ft3 for GAS_PROD) for every field_id in one query -> {field_id: date or None}
+        latest_dates = {field_id: None for field_id in field_ids}
+        sql = latest_complete_dates_sql(prod_type, indexed=self.has_complete_dates())
+        if sql is None:
+            return latest_dates
+        _, rows = self.query(sql, {
+            'field_ids': list(field_ids),
+            'prod_type': prod_type,
+            'query_date': to_date(query_date),
+        })
+        latest_dates.update(rows)
+        return latest_dates
+
+    def get_row_aggregates(self, row_dates, report_plan):
+        # Plan and daily aggregates that report_plan reads for report rows that each have their own
+        # effective date, rows sharing a date are fetched together -> ([plan of each row], [daily of each row])
+        plans = [None] * len(row_dates)
+        dailies = [None] * len(row_dates)
+        for report_date, rows in group_rows_by_date(row_dates).items():
+            plan = self.get_plan_aggregates({field for i in rows for field in report_plan.plan_field_ids[i]},
+                                            report_plan.plan_types, report_date, report_plan.plan_keys)
+            daily = self.get_daily_aggregates(flatten_sub_field_ids([report_plan.sub_field_ids[i] for i in rows]),
+                                              report_plan.prod_type, report_date, report_plan.daily_keys)
+            for i in rows:
+                plans[i] = plan
+                dailies[i] = daily
+        return plans, dailies
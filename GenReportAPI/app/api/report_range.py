@@ -0,0 +1,199 @@
+import asyncio
+import os
+from datetime import timedelta
+
+import pandas as pd
+
+from .pgdb import build_report
+from .pgdb_async import AsyncPGReportQuery
+from .report_engine import (
+    COMPLETE_UNITS,
+    DAILY_WINDOWS,
+    PLAN_WINDOWS,
+    UNITS,
+    latest_row_dates,
+    to_date,
+    year_range,
+)
+from .report_plan import REPORT_PLANS
+
+# Longest range a single request may cover
+REPORT_RANGE_MAX_DAYS = int(os.environ.get("REPORT_RANGE_MAX_DAYS", 366))
+
+
+def _add(totals, values):
+    # Add a row's units into a running total, NULL units are skipped like SUM() does
+    for n, v in enumerate(values):
+        if v is not None:
+            totals[n] = v if totals[n] is None else totals[n] + v
+
+
+def _daily_snapshot(prev, mtd, day):
+    # Running totals -> {field_id: {'prev_prod_ton': ..., ...}}, the shape of get_daily_aggregates
+    snapshot = {}
+    for field_id in set(prev) | set(mtd):
+        p = prev.get(field_id, [None] * len(UNITS))
+        m = mtd.get(field_id, [None] * len(UNITS))
+        y = [a if b is None else b if a is None else a + b for a, b in zip(p, m)]
+        d = day.get(field_id, [None] * len(UNITS))
+        windows = {'prev': p, 'mtd': m, 'ytd': y, 'day': d}
+        snapshot[field_id] = {
+            f'{window}_{unit}': windows[window][n]
+            for window in DAILY_WINDOWS for n, unit in enumerate(UNITS)
+        }
+    return snapshot
+
+
+async def running_daily_snapshots(daily_rows, start_date, end_date, keep_dates=()):
+    # One pass over an async iterator of daily rows ordered by date, starting at 1/1 of start_date's year.
+    # Yields (date, snapshot, {field_id: units of that date}) for every date of [start_date, end_date]
+    # and of keep_dates, with the windows of DAILY_WINDOWS kept as running sums instead of re-aggregated per date.
+    scan_start = year_range(start_date.year)[0]
+    rows = aiter(daily_rows)
+    pending = await anext(rows, None)
+    prev, mtd, day = {}, {}, {}
+    d = scan_start
+    while d <= end_date:
+        if d.month == 1 and d.day == 1:
+            prev, mtd = {}, {}
+        elif d.day == 1:
+            for field_id, totals in mtd.items():
+                _add(prev.setdefault(field_id, [None] * len(UNITS)), totals)
+            mtd = {}
+        day = {}
+        while pending is not None and pending[1] == d:
+            field_id, _, *values = pending
+            _add(mtd.setdefault(field_id, [None] * len(UNITS)), values)
+            _add(day.setdefault(field_id, [None] * len(UNITS)), values)
+            pending = await anext(rows, None)
+        if d >= start_date or d in keep_dates:
+            yield d, _daily_snapshot(prev, mtd, day), day
+        d += timedelta(days=1)
+
+
+def plan_snapshot(plan_rows, report_date):
+    # Plan rows -> {(field_id, plan_type): {'year_prod_ton': ..., 'month_prod_ton': ..., ...}}
+    # for the year and month of report_date, the shape of get_plan_aggregates
+    snapshot = {}
+    for field_id, plan_type, plan_date, *values in plan_rows:
+        if plan_date.year != report_date.year:
+            continue
+        totals = snapshot.setdefault((field_id, plan_type), {'year': [None] * len(UNITS), 'month': [None] * len(UNITS)})
+        _add(totals['year'], values)
+        if plan_date.month == report_date.month:
+            _add(totals['month'], values)
+    return {
+        key: {f'{window}_{unit}': totals[window][n] for window in PLAN_WINDOWS for n, unit in enumerate(UNITS)}
+        for key, totals in snapshot.items()
+    }
+
+
+def check_report_range(start_date, end_date):
+    # Raises ValueError for an unusable range, meant to be called before a response starts
+    start_date, end_date = to_date(start_date), to_date(end_date)
+    if end_date < start_date:
+        raise ValueError("end_date is before start_date")
+    if (end_date - start_date).days + 1 > REPORT_RANGE_MAX_DAYS:
+        raise ValueError(f"Range is longer than {REPORT_RANGE_MAX_DAYS} days")
+    return start_date, end_date
+
+
+async def _iter_report_range(start_date, end_date, PGDB, report_plan, formatted=True):
+    # Yields the report of each date of [start_date, end_date] as soon as the scan has passed it
+    start_date, end_date = check_report_range(start_date, end_date)
+    plan_types, sub_field_ids, prod_type = report_plan.plan_types, report_plan.sub_field_ids, report_plan.prod_type
+    field_ids = report_plan.daily_field_ids
+    plan_fields = report_plan.plan_fields
+    scan_start = year_range(start_date.year)[0]
+    plan_rows, latest_dates = await asyncio.gather(
+        PGDB.get_plan_rows(plan_fields, plan_types, scan_start, year_range(end_date.year)[1]),
+        PGDB.get_latest_dates_by_fields(field_ids, prod_type, start_date),
+    )
+    # Rows lagging behind start_date are computed at their latest complete date: from the scan when
+    # it is this year, from the grouped queries when it is older
+    keep_dates = {v for v in latest_dates.values() if v is not None and scan_start <= v < start_date}
+    old_dates = sorted({v for v in latest_dates.values() if v is not None and v < scan_start})
+    old_plans = await asyncio.gather(*(PGDB.get_plan_aggregates(plan_fields, plan_types, d, report_plan.plan_keys) for d in old_dates))
+    old_dailies = await asyncio.gather(*(PGDB.get_daily_aggregates(field_ids, prod_type, d, report_plan.daily_keys) for d in old_dates))
+    dailies_at = dict(zip(old_dates, old_dailies))
+    plans_at = dict(zip(old_dates, old_plans))
+    plans_by_month = {}
+
+    complete = [UNITS.index(unit) for unit in COMPLETE_UNITS[prod_type]]
+    daily_rows = PGDB.iter_daily_rows(field_ids, prod_type, scan_start, end_date)
+    async for d, daily, day_values in running_daily_snapshots(daily_rows, start_date, end_date, keep_dates):
+        dailies_at[d] = daily
+        if d < start_date:
+            continue
+        for field_id, values in day_values.items():
+            if all(values[n] is not None for n in complete):
+                latest_dates[field_id] = d
+        # Each row at the latest date its sub-fields have complete data, as in the single-day report
+        row_dates = latest_row_dates(sub_field_ids, latest_dates, d)
+        plans = []
+        for r in row_dates:
+            if r in plans_at:
+                plans.append(plans_at[r])
+                continue
+            if (r.year, r.month) not in plans_by_month:
+                plans_by_month[(r.year, r.month)] = plan_snapshot(plan_rows, r)
+            plans.append(plans_by_month[(r.year, r.month)])
+        report = build_report(report_plan, plans, [dailies_at[r] for r in row_dates], formatted)
+        report.insert(0, 'Ngày báo cáo', d.strftime("%d/%m/%Y"))
+        report['Dữ liệu cập nhật đến ngày'] = [v.strftime("%d/%m/%Y") for v in row_dates]
+        yield report
+        # Only snapshots that a later row can still point back to are kept
+        needed = set(latest_dates.values())
+        dailies_at = {k: v for k, v in dailies_at.items() if k in needed}
+
+
+async def iter_oil_report_range(start_date, end_date,
+                    POSTGRES_DB,
+                    POSTGRES_USER,
+                    POSTGRES_PASSWORD,
+                    HOST,
+                    PORT,
+                    formatted=True):
+    # Rows of generate_oil_report_w_latest_data for every date of [start_date, end_date], one frame per date
+    PGDB = await AsyncPGReportQuery.connect(POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, HOST, PORT)
+    # One snapshot for the whole range, a write during the scan cannot split it
+    async with PGDB.snapshot() as snapshot:
+        async for report in _iter_report_range(start_date, end_date, snapshot, REPORT_PLANS['oil'], formatted):
+            yield report
+
+
+async def iter_gas_report_range(start_date, end_date,
+                    POSTGRES_DB,
+                    POSTGRES_USER,
+                    POSTGRES_PASSWORD,
+                    HOST,
+                    PORT,
+                    formatted=True):
+    # Rows of generate_gas_report_w_latest_data for every date of [start_date, end_date], one frame per date
+    PGDB = await AsyncPGReportQuery.connect(POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, HOST, PORT)
+    # One snapshot for the whole range, a write during the scan cannot split it
+    async with PGDB.snapshot() as snapshot:
+        async for report in _iter_report_range(start_date, end_date, snapshot, REPORT_PLANS['gas'], formatted):
+            yield report
+
+
+async def generate_oil_report_range(start_date, end_date,
+                    POSTGRES_DB,
+                    POSTGRES_USER,
+                    POSTGRES_PASSWORD,
+                    HOST,
+                    PORT,
+                    formatted=True):
+    reports = [report async for report in iter_oil_report_range(start_date, end_date, POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, HOST, PORT, formatted)]
+    return pd.concat(reports, ignore_index=True)
+
+
+async def generate_gas_report_range(start_date, end_date,
+                    POSTGRES_DB,
+                    POSTGRES_USER,
+                    POSTGRES_PASSWORD,
+                    HOST,
+                    PORT,
+                    formatted=True):
+    reports = [report async for report in iter_gas_report_range(start_date, end_date, POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, HOST, PORT, formatted)]
+    return pd.concat(reports, ignore_index=True)
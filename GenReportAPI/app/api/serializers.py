@@ -0,0 +1,90 @@
+from fastapi.responses import JSONResponse, Response
+
+from .pgdb import REPORT_DECIMALS, format_report
+
+# Binary formats are optional, a deployment without them serves JSON only
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "application/json"
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+MSGPACK = "application/msgpack"
+MSGPACK_ALIASES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+
+
+def available_media_types():
+    media_types = [JSON]
+    if pa is not None:
+        media_types.append(ARROW_STREAM)
+    if msgpack is not None:
+        media_types.extend(MSGPACK_ALIASES)
+    return media_types
+
+
+def negotiate(accept):
+    # Media type of the response for an Accept header: the highest q the server can produce,
+    # JSON when nothing matches or the header is missing
+    best, best_q = JSON, 0.0
+    supported = available_media_types()
+    for part in (accept or "").split(","):
+        media_type, *params = [p.strip() for p in part.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if media_type in MSGPACK_ALIASES:
+            media_type = MSGPACK
+        if media_type in supported and q > best_q:
+            best, best_q = media_type, q
+    return best
+
+
+def _value_columns(report):
+    return [column for column in report.columns if report[column].dtype == 'float64']
+
+
+def arrow_ipc(report, decimals=REPORT_DECIMALS):
+    # Report with float64 value columns -> Arrow IPC stream bytes, the display decimals are
+    # kept as field metadata instead of being baked into the values
+    value_columns = set(_value_columns(report))
+    table = pa.Table.from_pandas(report, preserve_index=False)
+    schema = pa.schema([
+        field.with_metadata({"decimals": str(decimals)}) if field.name in value_columns else field
+        for field in table.schema
+    ])
+    table = table.cast(schema)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def msgpack_columns(report, decimals=REPORT_DECIMALS):
+    # Report -> msgpack map of columns: {"columns", "types", "decimals", "data": [values of each column]}
+    value_columns = _value_columns(report)
+    return msgpack.packb({
+        "columns": list(report.columns),
+        "types": ["float64" if column in value_columns else "string" for column in report.columns],
+        "decimals": {column: decimals for column in value_columns},
+        "data": [report[column].tolist() for column in report.columns],
+    }, use_bin_type=True)
+
+
+def report_response(report, accept):
+    # Typed report (float64 value columns) in the format the client asked for,
+    # JSON records of '%.2f' strings by default
+    media_type = negotiate(accept)
+    if media_type == ARROW_STREAM:
+        return Response(arrow_ipc(report), media_type=ARROW_STREAM)
+    if media_type == MSGPACK:
+        return Response(msgpack_columns(report), media_type=MSGPACK)
+    return JSONResponse(content=format_report(report).to_dict(orient="records"))
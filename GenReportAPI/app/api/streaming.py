@@ -0,0 +1,58 @@
+import csv
+import io
+import json
+
+from fastapi.responses import StreamingResponse
+
+
+async def single_report(report):
+    # Async iterator over a single report frame
+    yield report
+
+
+async def prefetch(reports):
+    # Pull the first frame now, so a bad request fails before the response has started
+    first = await anext(reports, None)
+
+    async def chained():
+        if first is not None:
+            yield first
+        async for report in reports:
+            yield report
+    return chained()
+
+
+async def iter_csv(reports):
+    # CSV text of an async iterator of report frames, header once, one chunk per frame
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    header = None
+    async for report in reports:
+        if header is None:
+            header = list(report.columns)
+            writer.writerow(header)
+        writer.writerows(report.itertuples(index=False, name=None))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+async def iter_ndjson(reports):
+    # One JSON object per report row and line, one chunk per frame
+    async for report in reports:
+        columns = list(report.columns)
+        yield "".join(
+            json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n"
+            for row in report.itertuples(index=False, name=None)
+        )
+
+
+def csv_response(reports, filename):
+    # Chunked CSV download, rows are sent as the report frames are produced
+    response = StreamingResponse(iter_csv(reports), media_type="text/csv")
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
+
+
+def ndjson_response(reports):
+    return StreamingResponse(iter_ndjson(reports), media_type="application/x-ndjson")
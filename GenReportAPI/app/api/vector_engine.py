@@ -0,0 +1,308 @@
+"""Vectorized report engine.
+
+The daily_prod and plan_prod rows a report needs are read once into columnar frames
+(ProductionSnapshot), and columns C..R of every row are computed with array operations:
+
+- sub-fields map to report rows through a group-index array, so row totals are one scatter-add;
+- each year becomes a (report row x day of year) matrix; its cumsum within each month gives
+  month-to-date totals and the cumsum of the month totals the previous months, at any date;
+- plan totals are scattered into (plan field x plan type x year x month) arrays and indexed per row;
+- the columns are the formulas of the report plan (report_plan.py), evaluated as in the SQL engine.
+
+A snapshot serves any number of report dates within its range, which makes backfills one read.
+Results equal the SQL engine: the formulas read the sums rounded to the stored decimals (report_plan.py),
+whatever order they were added in.
+"""
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from .pgdb import PGReportQuery, report_frame
+from .report_engine import (
+    DAILY_ROWS_SQL,
+    PLAN_ROWS_SQL,
+    UNITS,
+    latest_row_dates,
+    print_lagging_rows,
+    to_date,
+    year_range,
+)
+from .report_plan import REPORT_PLANS
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def _columns(columns, rows, names):
+    # Rows of a query -> {name: NumPy array} for the columns in names, NULL units become NaN
+    by_name = dict(zip(columns, zip(*rows))) if rows else {column: () for column in columns}
+    arrays = {}
+    for name in names:
+        if name == 'report_date':
+            # Through ordinals, much faster than NumPy parsing date objects one by one
+            ordinals = np.fromiter((d.toordinal() for d in by_name[name]), dtype=np.int64, count=len(by_name[name]))
+            arrays[name] = (ordinals - EPOCH_ORDINAL).astype('datetime64[D]')
+        elif name in UNITS:
+            arrays[name] = np.array(by_name[name], dtype='float64')
+        else:
+            arrays[name] = np.array(by_name[name], dtype=object)
+    return arrays
+
+
+def sub_field_groups(sub_field_ids, unused_fields=()):
+    # Group-index of the layout: (sub-field id, report row) pairs, a sub-field listed in several
+    # rows appears once per row. Sub-fields in unused_fields are left out.
+    field_ids, rows = [], []
+    for row, _field in enumerate(sub_field_ids):
+        for sub_field in dict.fromkeys(_field if isinstance(_field, tuple) else (_field,)):
+            if sub_field not in unused_fields:
+                field_ids.append(sub_field)
+                rows.append(row)
+    return field_ids, np.array(rows, dtype=int)
+
+
+def _month_bounds(year_start, n_days):
+    # Day-of-year index of each 1st of month, plus the year length
+    months = np.arange(year_start.astype('datetime64[M]'), year_start.astype('datetime64[M]') + 12)
+    return np.append((months.astype('datetime64[D]') - year_start).astype(int), n_days)
+
+
+class ProductionSnapshot:
+    # daily_prod rows of one prod_type and plan_prod rows of the report plan types as NumPy
+    # columns, covering every report date in [start_date, end_date]
+    def __init__(self, daily, plan, start_date, end_date):
+        self.start_date = start_date
+        self.end_date = end_date
+        # Daily rows: field code of each row into daily_fields, date, units with NULL as 0
+        self.daily_codes, daily_fields = pd.factorize(daily['field_id'])
+        self.daily_fields = pd.Index(daily_fields)
+        self.daily_dates = daily['report_date']
+        self.daily_units = {unit: np.nan_to_num(daily[unit]) for unit in UNITS}
+        self._field_days = {}
+        # Plan totals as (plan field x plan type x year x month) arrays, one per unit
+        self.first_year = start_date.year
+        n_years = end_date.year - start_date.year + 1
+        field_codes, plan_fields = pd.factorize(plan['field_id'])
+        type_codes, plan_types = pd.factorize(plan['plan_type'])
+        self.plan_fields, self.plan_types = pd.Index(plan_fields), pd.Index(plan_types)
+        plan_dates = plan['report_date']
+        index = (
+            field_codes,
+            type_codes,
+            plan_dates.astype('datetime64[Y]').astype(int) + 1970 - self.first_year,
+            plan_dates.astype('datetime64[M]').astype(int) % 12,
+        )
+        self.plan_months = {}
+        for unit in UNITS:
+            totals = np.zeros((len(self.plan_fields), len(self.plan_types), n_years, 12))
+            np.add.at(totals, index, np.nan_to_num(plan[unit]))
+            self.plan_months[unit] = totals
+
+    @classmethod
+    def load(cls, PGDB, field_ids, prod_type, plan_field_ids, plan_types, start_date, end_date):
+        # Daily rows from 1/1 of the start_date year to end_date and plan rows of the years between,
+        # read through any ReportQuery backend
+        start_date, end_date = to_date(start_date), to_date(end_date)
+        year_start, next_year = year_range(start_date.year)[0], year_range(end_date.year)[1]
+        daily = _columns(*PGDB.query(DAILY_ROWS_SQL, {
+            'field_ids': list(field_ids),
+            'prod_type': prod_type,
+            'start_date': year_start,
+            'end_date': end_date,
+        }), ('field_id', 'report_date') + UNITS)
+        plan = _columns(*PGDB.query(PLAN_ROWS_SQL, {
+            'field_ids': list(plan_field_ids),
+            'plan_types': list(plan_types),
+            'start_date': year_start,
+            'end_date': next_year,
+        }), ('field_id', 'plan_type', 'report_date') + UNITS)
+        return cls(daily, plan, start_date, end_date)
+
+    def field_days(self, unit, year):
+        # (field x day of year) totals of unit, built once per unit and year
+        key = (unit, year)
+        if key not in self._field_days:
+            year_start = year.astype('datetime64[D]')
+            n_days = int(((year + 1).astype('datetime64[D]') - year_start).astype(int))
+            in_year = self.daily_dates.astype('datetime64[Y]') == year
+            flat = self.daily_codes[in_year] * n_days + (self.daily_dates[in_year] - year_start).astype(int)
+            self._field_days[key] = np.bincount(
+                flat, weights=self.daily_units[unit][in_year], minlength=len(self.daily_fields) * n_days,
+            ).reshape(len(self.daily_fields), n_days)
+        return self._field_days[key]
+
+    def daily_windows(self, sub_field_ids, row_dates, unit, unused_fields=()):
+        # Previous months, month-to-date, year-to-date and day totals of unit for every report
+        # row at its own date -> {'prev': array, 'mtd': ..., 'ytd': ..., 'day': ...}.
+        # With unused_fields, those sub-fields are left out of the totals.
+        field_ids, group_rows = sub_field_groups(sub_field_ids, unused_fields)
+        codes = self.daily_fields.get_indexer(field_ids)
+        n_rows = len(row_dates)
+        # (report row x field) 0/1 matrix of the group-index, sub-fields without rows are skipped
+        membership = np.zeros((n_rows, len(self.daily_fields)))
+        membership[group_rows[codes >= 0], codes[codes >= 0]] = 1
+
+        dates = np.array([to_date(d) for d in row_dates], dtype='datetime64[D]')
+        row_years = dates.astype('datetime64[Y]')
+        windows = {name: np.zeros(n_rows) for name in ('prev', 'mtd', 'ytd', 'day')}
+        for year in np.unique(row_years):
+            year_start = year.astype('datetime64[D]')
+            # (report row x day of year) totals
+            matrix = membership @ self.field_days(unit, year)
+            # Cumulated along the days of each month, and month totals cumulated along the year,
+            # so month-to-date and previous months are sums like in the monthly rollup rather than
+            # differences of one running total
+            month_bounds = _month_bounds(year_start, matrix.shape[1])
+            month_to_date = np.zeros_like(matrix)
+            for first, last in zip(month_bounds[:-1], month_bounds[1:]):
+                month_to_date[:, first:last] = matrix[:, first:last].cumsum(axis=1)
+            before_month = np.zeros((n_rows, 13))
+            before_month[:, 1:] = month_to_date[:, month_bounds[1:] - 1].cumsum(axis=1)
+
+            rows = np.flatnonzero(row_years == year)
+            day = (dates[rows] - year_start).astype(int)
+            month = dates[rows].astype('datetime64[M]').astype(int) % 12
+            prev = before_month[rows, month]
+            mtd = month_to_date[rows, day]
+            windows['prev'][rows] = prev
+            windows['mtd'][rows] = mtd
+            windows['ytd'][rows] = prev + mtd
+            windows['day'][rows] = matrix[rows, day]
+        return windows
+
+    def plan_windows(self, plan_fields, plan_type, row_dates, unit):
+        # Year and month plan totals of unit for the plan field of every report row at its date
+        # -> {'year': array, 'month': array}, missing plans count as 0
+        n_rows = len(row_dates)
+        windows = {'year': np.zeros(n_rows), 'month': np.zeros(n_rows)}
+        if plan_type not in self.plan_types:
+            return windows
+        totals = self.plan_months[unit][:, self.plan_types.get_loc(plan_type)]
+        fields = self.plan_fields.get_indexer(list(plan_fields))
+        dates = [to_date(d) for d in row_dates]
+        years = np.array([d.year for d in dates]) - self.first_year
+        months = np.array([d.month for d in dates]) - 1
+        found = (fields >= 0) & (years >= 0) & (years < totals.shape[1])
+        windows['year'][found] = totals[fields[found], years[found]].sum(axis=1)
+        windows['month'][found] = totals[fields[found], years[found], months[found]]
+        return windows
+
+    def aggregate_values(self, report_plan, row_dates):
+        # {aggregate name: array over the report rows} of report_plan, what the SQL engine reads
+        # from its grouped queries. The windows of a unit come from one daily_windows/plan_windows call.
+        values = {}
+        windows = {}
+        for aggregate, name in report_plan.aggregates.items():
+            if aggregate[0] == 'plan':
+                _, plan_type, window, unit = aggregate
+                key = ('plan', plan_type, unit)
+                if key not in windows:
+                    plan_fields = [fields[plan_type] for fields in report_plan.row_plan_fields]
+                    windows[key] = self.plan_windows(plan_fields, plan_type, row_dates, unit)
+            else:
+                _, window, unit, used = aggregate
+                key = ('daily', unit, used)
+                if key not in windows:
+                    unused_fields = report_plan.unused_fields if used else ()
+                    windows[key] = self.daily_windows(report_plan.sub_field_ids, row_dates, unit, unused_fields)
+            values[name] = windows[key][window]
+        return values
+
+    def report(self, report_plan, row_dates, formatted=True):
+        # Report of report_plan with every row at its row date, same columns as pgdb.build_report
+        return report_frame(report_plan.evaluate(self.aggregate_values(report_plan, row_dates)), formatted)
+
+
+def load_snapshot(PGDB, kind, start_date, end_date):
+    # Snapshot with the daily and plan rows of every report date in [start_date, end_date]
+    report_plan = REPORT_PLANS[kind]
+    return ProductionSnapshot.load(PGDB, report_plan.daily_field_ids, report_plan.prod_type,
+                                   report_plan.plan_fields, report_plan.plan_types, start_date, end_date)
+
+
+def _row_dates(query_date, row_dates, n_rows):
+    if row_dates is None:
+        return [to_date(query_date)] * n_rows
+    return [to_date(d) for d in row_dates]
+
+
+def query_report(PGDB, kind, query_date, row_dates=None, formatted=True):
+    # Vectorized counterpart of pgdb.query_report, on any ReportQuery backend
+    report_plan = REPORT_PLANS[kind]
+    row_dates = _row_dates(query_date, row_dates, len(report_plan.field_names))
+    with PGDB.snapshot():
+        snapshot = load_snapshot(PGDB, kind, min(row_dates), max(row_dates))
+    return snapshot.report(report_plan, row_dates, formatted)
+
+
+def query_report_w_latest_data(PGDB, kind, query_date, formatted=True):
+    report_plan = REPORT_PLANS[kind]
+    with PGDB.snapshot():
+        _latest_dates = PGDB.get_latest_dates_by_fields(report_plan.daily_field_ids, report_plan.prod_type, query_date)
+        row_dates = latest_row_dates(report_plan.sub_field_ids, _latest_dates, query_date)
+        print_lagging_rows(report_plan.sub_field_ids, row_dates, query_date)
+        report = query_report(PGDB, kind, query_date, row_dates=row_dates, formatted=formatted)
+    report['Dữ liệu cập nhật đến ngày'] = [v.strftime("%d/%m/%Y") for v in row_dates]
+    return report
+
+
+def oil_report(PGDB, query_date, row_dates=None, formatted=True):
+    return query_report(PGDB, 'oil', query_date, row_dates=row_dates, formatted=formatted)
+
+
+def gas_report(PGDB, query_date, row_dates=None, formatted=True):
+    return query_report(PGDB, 'gas', query_date, row_dates=row_dates, formatted=formatted)
+
+
+def oil_report_w_latest_data(PGDB, query_date, formatted=True):
+    return query_report_w_latest_data(PGDB, 'oil', query_date, formatted=formatted)
+
+
+def gas_report_w_latest_data(PGDB, query_date, formatted=True):
+    return query_report_w_latest_data(PGDB, 'gas', query_date, formatted=formatted)
+
+
+def iter_report_backfill(PGDB, kind, report_dates, latest=False, formatted=True):
+    # Reports of every date in report_dates from a single snapshot, one frame per date with
+    # 'Ngày báo cáo' first. With latest=True rows are at their latest complete date as in
+    # *_report_w_latest_data, resolved with one lookup per date before the snapshot is read.
+    report_plan = REPORT_PLANS[kind]
+    report_dates = [to_date(d) for d in report_dates]
+    with PGDB.snapshot():
+        if latest:
+            rows_at = [latest_row_dates(report_plan.sub_field_ids,
+                                        PGDB.get_latest_dates_by_fields(report_plan.daily_field_ids, report_plan.prod_type, d), d)
+                       for d in report_dates]
+        else:
+            rows_at = [[d] * len(report_plan.field_names) for d in report_dates]
+        snapshot = load_snapshot(PGDB, kind, min(min(row_dates) for row_dates in rows_at), max(report_dates))
+    for report_date, row_dates in zip(report_dates, rows_at):
+        report = snapshot.report(report_plan, row_dates, formatted)
+        report.insert(0, 'Ngày báo cáo', report_date.strftime("%d/%m/%Y"))
+        if latest:
+            report['Dữ liệu cập nhật đến ngày'] = [v.strftime("%d/%m/%Y") for v in row_dates]
+        yield report
+
+
+def generate_oil_report(query_date, POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, HOST, PORT,
+                        row_dates=None, formatted=True):
+    with PGReportQuery(POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, HOST, PORT) as PGDB:
+        return oil_report(PGDB, query_date, row_dates=row_dates, formatted=formatted)
+
+
+def generate_gas_report(query_date, POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, HOST, PORT,
+                        row_dates=None, formatted=True):
+    with PGReportQuery(POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, HOST, PORT) as PGDB:
+        return gas_report(PGDB, query_date, row_dates=row_dates, formatted=formatted)
+
+
+def generate_oil_report_w_latest_data(query_date, POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, HOST, PORT,
+                                      formatted=True):
+    with PGReportQuery(POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, HOST, PORT) as PGDB:
+        return oil_report_w_latest_data(PGDB, query_date, formatted=formatted)
+
+
+def generate_gas_report_w_latest_data(query_date, POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, HOST, PORT,
+                                      formatted=True):
+    with PGReportQuery(POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, HOST, PORT) as PGDB:
+        return gas_report_w_latest_data(PGDB, query_date, formatted=formatted)
@@ -1,11 +1,47 @@
-from fastapi import FastAPI
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from app.api import pgsql
+from app.api.metrics import REQUEST_SECONDS, server_timing_header, start_request_timings
+from app.api.pool import close_all_pools, pool_registry
+from app.api.pgdb_async import close_all_async_pools
 
-app = FastAPI(title="Daily Oil Report API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Release the pooled Postgres connections on shutdown
+    close_all_pools()
+    await close_all_async_pools()
+
+app = FastAPI(title="Daily Oil Report API", lifespan=lifespan)
+
+@app.middleware("http")
+async def server_timing(request: Request, call_next):
+    # Report responses carry the time spent in each kind of query as a Server-Timing header
+    if not request.url.path.startswith("/report"):
+        return await call_next(request)
+    timings = start_request_timings()
+    start = time.perf_counter()
+    response = await call_next(request)
+    total = time.perf_counter() - start
+    REQUEST_SECONDS.labels(request.url.path).observe(total)
+    response.headers["Server-Timing"] = server_timing_header(timings, total)
+    return response
 
 # Register routers
 app.include_router(pgsql.router, prefix="/report", tags=["Oil Production Report"])
 
 @app.get("/")
 def root():
-    return {"message": "Automatic Daily Oil Production Reporting API"}
\ No newline at end of file
+    return {"message": "Automatic Daily Oil Production Reporting API"}
+
+@app.get("/metrics")
+def metrics():
+    # Prometheus exposition of the query and request histograms
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/pools")
+def pools():
+    # Connection budget use and the pool of every database target, least recently used first
+    return pool_registry.stats()
@@ -1,9 +1,28 @@
+from typing import List, Optional
 from pydantic import BaseModel
 
-class ReportRequest(BaseModel):
-    query_date: str
+class DBRequest(BaseModel):
     POSTGRES_DB: str
     POSTGRES_USER: str
     POSTGRES_PASSWORD: str
     HOST: str
     PORT: int
+
+class ReportRequest(DBRequest):
+    query_date: str
+
+class RangeReportRequest(DBRequest):
+    start_date: str  # "%Y/%m/%d"
+    end_date: str  # "%Y/%m/%d", inclusive
+
+class DailyProdRow(BaseModel):
+    field_id: str
+    report_date: str  # "%Y/%m/%d"
+    prod_type: str
+    prod_ton: Optional[float] = None
+    prod_bbls: Optional[float] = None
+    prod_m3: Optional[float] = None
+    prod_ft3: Optional[float] = None
+
+class DailyProdUpsertRequest(DBRequest):
+    rows: List[DailyProdRow]
\ No newline at end of file
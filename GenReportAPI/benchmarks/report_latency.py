@@ -0,0 +1,173 @@
+"""Report latency benchmark against a local Postgres, on synthetic data.
+
+For every (field scale, years of history) scenario the database is migrated, its
+field, plan_prod and daily_prod tables are REPLACED with synthetic data, and each
+report function is timed. Point it at a scratch database:
+
+    python -m benchmarks.report_latency --dbname bench --user dev --host localhost \\
+        --field-scales 1 2 --years 1 10 --incomplete-fraction 0.02 --output bench.json
+
+The JSON output (stdout by default) holds the scenario parameters, the row counts and
+min/median/p95/mean/max milliseconds per report function, so two runs can be diffed.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime
+
+import psycopg2
+
+from app.api.bulk_load import bulk_load
+from app.api.migrations import migrate
+from app.api.pgdb import (
+    generate_gas_report,
+    generate_gas_report_w_latest_data,
+    generate_oil_report,
+    generate_oil_report_w_latest_data,
+)
+from app.api.report_engine import to_date
+from app.api import vector_engine
+from .synthetic_data import layout_field_count, synthetic_dataset
+
+REPORT_FUNCTIONS = {
+    'generate_oil_report': generate_oil_report,
+    'generate_gas_report': generate_gas_report,
+    'generate_oil_report_w_latest_data': generate_oil_report_w_latest_data,
+    'generate_gas_report_w_latest_data': generate_gas_report_w_latest_data,
+    'vector_engine.generate_oil_report': vector_engine.generate_oil_report,
+    'vector_engine.generate_gas_report': vector_engine.generate_gas_report,
+    'vector_engine.generate_oil_report_w_latest_data': vector_engine.generate_oil_report_w_latest_data,
+    'vector_engine.generate_gas_report_w_latest_data': vector_engine.generate_gas_report_w_latest_data,
+}
+
+
+def percentile(values, q):
+    # Nearest-rank percentile of a non-empty list
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered))) - 1))]
+
+
+def summarize(seconds):
+    ms = [s * 1000 for s in seconds]
+    return {
+        'runs': len(ms),
+        'min_ms': round(min(ms), 3),
+        'median_ms': round(statistics.median(ms), 3),
+        'p95_ms': round(percentile(ms, 95), 3),
+        'mean_ms': round(statistics.fmean(ms), 3),
+        'max_ms': round(max(ms), 3),
+    }
+
+
+def time_report(function, query_date, db_args, repeat, warmup):
+    # Seconds of each timed call, after warmup untimed calls that fill the pool and caches
+    for _ in range(warmup):
+        function(query_date, *db_args)
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(query_date, *db_args)
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def run_scenario(conn, db_args, field_scale, n_years, args):
+    n_oil_fields = round(layout_field_count('OIL_PROD') * field_scale)
+    n_gas_fields = round(layout_field_count('GAS_PROD') * field_scale)
+    end_date = to_date(args.query_date)
+    start = time.perf_counter()
+    fields, plan_prod, daily_prod = synthetic_dataset(
+        n_oil_fields, n_gas_fields, n_years, end_date,
+        incomplete_fraction=args.incomplete_fraction,
+        missing_fraction=args.missing_fraction,
+        seed=args.seed,
+    )
+    generate_seconds = time.perf_counter() - start
+    load_stats = bulk_load(conn, fields=fields, plan_prod=plan_prod, daily_prod=daily_prod, replace=True)
+    with conn.cursor() as cur:
+        # Fresh statistics, as autovacuum would have them on a long-lived database
+        cur.execute("ANALYZE field, plan_prod, daily_prod;")
+    conn.commit()
+
+    results = {}
+    for name, function in REPORT_FUNCTIONS.items():
+        print(f"  {name}", file=sys.stderr)
+        results[name] = summarize(time_report(function, args.query_date, db_args, args.repeat, args.warmup))
+    return {
+        'field_scale': field_scale,
+        'years': n_years,
+        'oil_fields': n_oil_fields,
+        'gas_fields': n_gas_fields,
+        'rows': {table_name: s['rows'] for table_name, s in load_stats.items()},
+        'generate_seconds': round(generate_seconds, 3),
+        'load_seconds': round(sum(s['seconds'] for s in load_stats.values()), 3),
+        'reports': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the report functions on synthetic data (replaces the tables of --dbname)")
+    parser.add_argument("--dbname", required=True, help="scratch database, its field/plan_prod/daily_prod rows are replaced")
+    parser.add_argument("--user", default=os.environ.get("POSTGRES_USER"))
+    parser.add_argument("--password", default=os.environ.get("POSTGRES_PASSWORD", ""))
+    parser.add_argument("--host", default=os.environ.get("HOST", "localhost"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 5432)))
+    parser.add_argument("--field-scales", type=float, nargs="+", default=[1, 2],
+                        help="daily fields per product as a multiple of the report layout")
+    parser.add_argument("--years", type=int, nargs="+", default=[1, 10], help="years of daily history up to --query-date")
+    parser.add_argument("--incomplete-fraction", type=float, default=0.02, help="daily rows with a NULL unit")
+    parser.add_argument("--missing-fraction", type=float, default=0.01, help="daily rows left out")
+    parser.add_argument("--query-date", default="2025/07/01", help="report date, %%Y/%%m/%%d")
+    parser.add_argument("--repeat", type=int, default=20, help="timed calls per report function")
+    parser.add_argument("--warmup", type=int, default=2, help="untimed calls before timing")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    db_args = (args.dbname, args.user, args.password, args.host, args.port)
+    started_at = datetime.now().isoformat(timespec="seconds")
+    conn = psycopg2.connect(host=args.host, port=args.port, dbname=args.dbname, user=args.user, password=args.password)
+    scenarios = []
+    try:
+        migrate(conn)
+        with conn.cursor() as cur:
+            cur.execute("SHOW server_version;")
+            server_version = cur.fetchone()[0]
+        # The reports log lagging rows on stdout, keep it for the JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            for n_years in args.years:
+                for field_scale in args.field_scales:
+                    print(f"fields x{field_scale:g}, {n_years} year(s)", file=sys.stderr)
+                    scenarios.append(run_scenario(conn, db_args, field_scale, n_years, args))
+    finally:
+        conn.close()
+
+    result = {
+        'started_at': started_at,
+        'python': platform.python_version(),
+        'postgres': server_version,
+        'parameters': {
+            'query_date': args.query_date,
+            'incomplete_fraction': args.incomplete_fraction,
+            'missing_fraction': args.missing_fraction,
+            'repeat': args.repeat,
+            'warmup': args.warmup,
+            'seed': args.seed,
+        },
+        'scenarios': scenarios,
+    }
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Synthetic field, plan_prod and daily_prod data in the shape of the formatted to_sql_* CSVs.
+
+The report layout fields are always generated, so every report row has data. Extra
+fields (SYN_OIL_001, SYN_GAS_001, ...) grow the tables the report queries scan.
+Everything is drawn from a seeded generator, so the same arguments give the same data.
+"""
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from app.api.field_metadata import LAYOUT_FIELDS
+
+# prod_type -> (unit, conversion factor to the second unit column, first unit column, second unit column)
+PROD_UNITS = {
+    'OIL_PROD': ('ton', 7.51, 'prod_ton', 'prod_bbls'),
+    'GAS_PROD': ('tr.m3', 35.3146667, 'prod_m3', 'prod_ft3'),
+}
+# plan_type -> (field_type of its fields, unit columns it fills)
+PLAN_TYPES = {
+    'KHSLCPGiaoOil': ('OIL_PLAN', ('prod_ton',)),
+    'KHQTOIL': ('OIL_PLAN', ('prod_ton',)),
+    'KHSLCPGiaoGas': ('GAS_PLAN', ('prod_m3', 'prod_ft3')),
+    'KHQTGAS': ('GAS_PLAN', ('prod_m3', 'prod_ft3')),
+}
+# Typical daily production of one field: oil in ton, gas in tr.m3
+DAILY_MEAN = {'OIL_PROD': 2000.0, 'GAS_PROD': 0.5}
+
+UNIT_COLUMNS = ['prod_ton', 'prod_bbls', 'prod_m3', 'prod_ft3']
+
+
+def layout_field_count(prod_type):
+    return len(LAYOUT_FIELDS[prod_type])
+
+
+def daily_field_ids(prod_type, n_fields):
+    # Layout sub-fields of prod_type, then synthetic ones up to n_fields
+    field_ids = list(LAYOUT_FIELDS[prod_type])
+    prefix = "SYN_OIL" if prod_type == 'OIL_PROD' else "SYN_GAS"
+    field_ids += [f"{prefix}_{n:03d}" for n in range(1, n_fields - len(field_ids) + 1)]
+    return field_ids
+
+
+def synthetic_fields(n_oil_fields, n_gas_fields):
+    # field table rows: every layout field plus the synthetic daily fields
+    rows = []
+    for prod_type, n_fields in (('OIL_PROD', n_oil_fields), ('GAS_PROD', n_gas_fields)):
+        unit, factor = PROD_UNITS[prod_type][:2]
+        rows += [(field_id, field_id, unit, prod_type, factor) for field_id in daily_field_ids(prod_type, n_fields)]
+    for field_type in ('OIL_PLAN', 'GAS_PLAN'):
+        unit = 'tr.tấn' if field_type == 'OIL_PLAN' else 'tr.m3'
+        rows += [(field_id, field_id, unit, field_type, None) for field_id in LAYOUT_FIELDS[field_type]]
+    return pd.DataFrame(rows, columns=['field_id', 'field_name', 'unit', 'field_type', 'conversion_factor'])
+
+
+def synthetic_plan_prod(years, seed=0):
+    # Monthly plan rows (dated the 1st) of every plan field and plan type for each year
+    rng = np.random.default_rng(seed)
+    frames = []
+    for plan_type, (field_type, units) in PLAN_TYPES.items():
+        field_ids = LAYOUT_FIELDS[field_type]
+        months = pd.date_range(date(min(years), 1, 1), date(max(years), 12, 1), freq="MS")
+        months = months[months.year.isin(years)]
+        index = pd.MultiIndex.from_product([months, field_ids], names=['report_date', 'field_id'])
+        frame = index.to_frame(index=False)
+        frame['plan_type'] = plan_type
+        # Oil plans are in million ton per month, gas plans in million m3 per month
+        monthly = rng.uniform(0.01, 0.3, len(frame)) if field_type == 'OIL_PLAN' else rng.uniform(1.0, 15.0, len(frame))
+        for column in UNIT_COLUMNS:
+            frame[column] = np.nan
+        frame[units[0]] = monthly.round(6)
+        if len(units) > 1:
+            frame[units[1]] = (monthly * PROD_UNITS['GAS_PROD'][1]).round(6)
+        frames.append(frame)
+    plan = pd.concat(frames, ignore_index=True)
+    return plan[['report_date', 'field_id', 'plan_type'] + UNIT_COLUMNS]
+
+
+def synthetic_daily_prod(n_oil_fields, n_gas_fields, start_date, end_date,
+                         incomplete_fraction=0.0, missing_fraction=0.0, seed=0):
+    # One row per field and day in [start_date, end_date]. A missing_fraction of the
+    # (field, day) rows is dropped and an incomplete_fraction has its second unit left NULL,
+    # so the latest-data reports have lagging rows to resolve.
+    rng = np.random.default_rng(seed)
+    days = pd.date_range(start_date, end_date, freq="D")
+    frames = []
+    for prod_type, n_fields in (('OIL_PROD', n_oil_fields), ('GAS_PROD', n_gas_fields)):
+        _, factor, first_unit, second_unit = PROD_UNITS[prod_type]
+        field_ids = daily_field_ids(prod_type, n_fields)
+        index = pd.MultiIndex.from_product([days, field_ids], names=['report_date', 'field_id'])
+        frame = index.to_frame(index=False)
+        frame['prod_type'] = prod_type
+        # Each field produces around its own level, days vary by +-20%
+        level = rng.uniform(0.2, 1.8, len(field_ids)) * DAILY_MEAN[prod_type]
+        values = np.tile(level, len(days)) * rng.uniform(0.8, 1.2, len(frame))
+        for column in UNIT_COLUMNS:
+            frame[column] = np.nan
+        frame[first_unit] = values.round(3)
+        frame[second_unit] = (values * factor).round(6)
+
+        draw = rng.random(len(frame))
+        incomplete = draw < incomplete_fraction
+        missing = ~incomplete & (draw < incomplete_fraction + missing_fraction)
+        frame.loc[incomplete, second_unit] = np.nan
+        frame = frame[~missing]
+        frames.append(frame)
+    daily = pd.concat(frames, ignore_index=True)
+    return daily[['report_date', 'field_id', 'prod_type'] + UNIT_COLUMNS]
+
+
+def synthetic_dataset(n_oil_fields, n_gas_fields, n_years, end_date,
+                      incomplete_fraction=0.0, missing_fraction=0.0, seed=0):
+    # (fields, plan_prod, daily_prod) DataFrames with n_years of daily history ending on end_date
+    if incomplete_fraction + missing_fraction > 1:
+        raise ValueError("incomplete_fraction + missing_fraction must not exceed 1")
+    start_date = date(end_date.year - n_years + 1, 1, 1)
+    years = list(range(start_date.year, end_date.year + 1))
+    return (
+        synthetic_fields(n_oil_fields, n_gas_fields),
+        synthetic_plan_prod(years, seed=seed),
+        synthetic_daily_prod(n_oil_fields, n_gas_fields, start_date, end_date,
+                             incomplete_fraction, missing_fraction, seed=seed + 1),
+    )
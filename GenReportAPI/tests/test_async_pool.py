@@ -0,0 +1,73 @@
+"""Tests of the async pool creation in pgdb_async, against a scratch Postgres database:
+
+    TEST_POSTGRES_DSN="dbname=scratch user=dev host=localhost" python -m pytest tests
+"""
+import asyncio
+import os
+import socket
+import time
+
+import psycopg
+import psycopg2.extensions
+import pytest
+
+from app.api import pgdb_async
+from app.api.pool import pool_registry
+
+DSN = os.environ.get("TEST_POSTGRES_DSN")
+
+pytestmark = pytest.mark.skipif(not DSN, reason="TEST_POSTGRES_DSN is not set")
+
+
+def pool_args():
+    # get_async_pool arguments of TEST_POSTGRES_DSN
+    params = psycopg2.extensions.parse_dsn(DSN)
+    return params["dbname"], params["user"], params.get("password"), params.get("host"), params.get("port", 5432)
+
+
+@pytest.fixture
+def silent_server():
+    # (host, port) that accepts connections and never answers, like a hung database
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    yield server.getsockname()
+    server.close()
+
+
+def test_hung_target_does_not_block_other_targets(monkeypatch, silent_server):
+    monkeypatch.setattr(pgdb_async, "CONNECT_TIMEOUT", 2)
+    dbname, user, password, host, port = pool_args()
+
+    async def main():
+        hung = asyncio.create_task(pgdb_async.get_async_pool(dbname, user, password, *silent_server))
+        await asyncio.sleep(0.1)
+        start = time.monotonic()
+        pool = await pgdb_async.get_async_pool(dbname, user, password, host, port)
+        elapsed = time.monotonic() - start
+        # The hung target fails after its connect timeout instead of hanging
+        with pytest.raises(psycopg.OperationalError):
+            await hung
+        await pgdb_async.close_all_async_pools()
+        return pool, elapsed
+
+    pool, elapsed = asyncio.run(main())
+    assert elapsed < 1
+    assert pool.closed
+
+
+def test_pool_that_fails_to_open_is_closed(monkeypatch):
+    monkeypatch.setattr(pgdb_async, "POOL_TIMEOUT", 0.5)
+    monkeypatch.setattr(pool_registry, "budget", 0)
+    opened = []
+
+    class RecordingPool(pgdb_async.AsyncConnectionPool):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            opened.append(self)
+
+    monkeypatch.setattr(pgdb_async, "AsyncConnectionPool", RecordingPool)
+    with pytest.raises(Exception):
+        asyncio.run(pgdb_async.get_async_pool(*pool_args()))
+    assert len(opened) == 1 and opened[0].closed
+    assert not pgdb_async._async_pool_creations
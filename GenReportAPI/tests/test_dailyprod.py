@@ -0,0 +1,64 @@
+"""Tests of the /report/dailyprod upsert endpoint, against a scratch Postgres database.
+
+They write rows dated 2030+ under a test field id and delete them afterwards:
+
+    TEST_POSTGRES_DSN="dbname=scratch user=dev host=localhost" python -m pytest tests
+"""
+import os
+
+import psycopg2
+import psycopg2.extensions
+import pytest
+from fastapi.testclient import TestClient
+
+from app.api.migrations import migrate
+from app.main import app
+
+DSN = os.environ.get("TEST_POSTGRES_DSN")
+FIELD_ID = "_test_dailyprod"
+
+pytestmark = pytest.mark.skipif(not DSN, reason="TEST_POSTGRES_DSN is not set")
+
+
+@pytest.fixture
+def post_rows():
+    conn = psycopg2.connect(DSN)
+    migrate(conn)
+    params = psycopg2.extensions.parse_dsn(DSN)
+    target = {
+        "POSTGRES_DB": params["dbname"],
+        "POSTGRES_USER": params["user"],
+        "POSTGRES_PASSWORD": params.get("password", ""),
+        "HOST": params.get("host", "localhost"),
+        "PORT": int(params.get("port", 5432)),
+    }
+    with TestClient(app) as client:
+        yield lambda rows: client.post("/report/dailyprod", json=dict(target, rows=rows))
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM daily_prod WHERE field_id = %s;", (FIELD_ID,))
+    conn.commit()
+    conn.close()
+
+
+def row(report_date="2030/01/02", prod_type="OIL_PROD", prod_ton=1.0):
+    return {"field_id": FIELD_ID, "report_date": report_date, "prod_type": prod_type, "prod_ton": prod_ton}
+
+
+def test_repeated_key_in_a_batch_keeps_the_last_row(post_rows):
+    response = post_rows([row(prod_ton=1.0), row(prod_ton=2.0)])
+    assert response.status_code == 200
+    assert response.json() == {"rows": 2, "changed_dates": ["2030/01/02"]}
+    # Same values again: nothing changes
+    assert post_rows([row(prod_ton=2.0)]).json()["changed_dates"] == []
+
+
+@pytest.mark.parametrize("bad_row", [
+    row(report_date="02/01/2030"),
+    row(prod_type="WATER_PROD"),
+    dict(row(), field_id="_test\x00"),  # no NUL in a Postgres string
+])
+def test_bad_rows_are_rejected_with_400(post_rows, bad_row):
+    response = post_rows([row(), bad_row])
+    assert response.status_code == 400
+    # Nothing of the batch is written
+    assert post_rows([row()]).json()["changed_dates"] == ["2030/01/02"]
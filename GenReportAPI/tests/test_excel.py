@@ -0,0 +1,51 @@
+"""Temporary files of the .xlsx exports, which must not outlive their request."""
+import asyncio
+import tempfile
+
+import pandas as pd
+import pytest
+
+from app.api.excel import write_workbook, xlsx_response
+
+
+@pytest.fixture
+def temp_dir(tmp_path, monkeypatch):
+    # Where write_workbook and openpyxl put their temporary files during the test
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    return tmp_path
+
+
+def report(rows=3):
+    return pd.DataFrame({"Mỏ": [f"field {n}" for n in range(rows)], "KHCP": [float(n) for n in range(rows)]})
+
+
+def test_failing_sheet_leaves_no_files(temp_dir):
+    async def sheets():
+        yield "01-07-2025", report()
+        yield "02-07-2025", report()
+        raise ValueError("report of 03-07-2025 failed")
+
+    with pytest.raises(ValueError):
+        asyncio.run(write_workbook(sheets()))
+    assert list(temp_dir.iterdir()) == []
+
+
+def test_response_removes_the_file_when_the_client_goes_away(temp_dir):
+    async def sheets():
+        yield "01-07-2025", report()
+
+    async def main():
+        response = xlsx_response(await write_workbook(sheets()), "report.xlsx")
+
+        async def receive():
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            raise OSError("client went away")
+
+        scope = {"type": "http", "method": "POST", "headers": [], "asgi": {"spec_version": "2.4"}}
+        with pytest.raises(OSError):
+            await response(scope, receive, send)
+
+    asyncio.run(main())
+    assert list(temp_dir.iterdir()) == []
@@ -0,0 +1,103 @@
+"""Concurrency tests of the migrated triggers, against a scratch Postgres database.
+
+They write rows dated 2030+ under a test field id and delete them afterwards:
+
+    TEST_POSTGRES_DSN="dbname=scratch user=dev host=localhost" python -m pytest tests
+"""
+import os
+import threading
+import time
+
+import psycopg2
+import pytest
+
+from app.api.migrations import migrate
+from app.api.report_engine import DATA_WATERMARK_SQL, report_window_params
+
+DSN = os.environ.get("TEST_POSTGRES_DSN")
+FIELD_ID = "_test_concurrent"
+
+pytestmark = pytest.mark.skipif(not DSN, reason="TEST_POSTGRES_DSN is not set")
+
+
+@pytest.fixture
+def connect():
+    conns = []
+
+    def _connect():
+        conn = psycopg2.connect(DSN)
+        conns.append(conn)
+        return conn
+
+    conn = _connect()
+    migrate(conn)
+    yield _connect
+    for c in conns:
+        c.rollback()
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM daily_prod WHERE field_id = %s;", (FIELD_ID,))
+        cur.execute("DELETE FROM plan_prod WHERE field_id = %s;", (FIELD_ID,))
+    conn.commit()
+    for c in conns:
+        c.close()
+
+
+def insert_daily(conn, report_date, prod_ton):
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO daily_prod (field_id, report_date, prod_type, prod_ton)
+            VALUES (%s, %s, 'OIL_PROD', %s);
+        """, (FIELD_ID, report_date, prod_ton))
+
+
+def in_thread(target):
+    # Starts target, returns the thread once it has had time to block
+    thread = threading.Thread(target=target)
+    thread.start()
+    time.sleep(0.5)
+    return thread
+
+
+def test_concurrent_writes_to_one_month_keep_both_rows(connect):
+    a, b = connect(), connect()
+    insert_daily(a, "2030-01-05", 10)
+    # B's refresh of January waits for A to commit, then sums both rows
+    thread = in_thread(lambda: (insert_daily(b, "2030-01-06", 20), b.commit()))
+    assert thread.is_alive()
+    a.commit()
+    thread.join(10)
+    with a.cursor() as cur:
+        cur.execute("""
+            SELECT prod_ton, row_count FROM monthly_prod
+            WHERE field_id = %s AND prod_type = 'OIL_PROD' AND year = 2030 AND month = 1;
+        """, (FIELD_ID,))
+        assert cur.fetchone() == (30, 2)
+
+
+def watermark(conn, report_date):
+    with conn.cursor() as cur:
+        cur.execute(DATA_WATERMARK_SQL, report_window_params(report_date))
+        row = cur.fetchone()
+    conn.commit()
+    return row
+
+
+def test_watermark_moves_on_every_commit(connect):
+    a, b, reader = connect(), connect(), connect()
+    before = watermark(reader, "2031/04/01")
+    insert_daily(a, "2031-03-01", 10)
+    # B writes a later date and commits while A is still open
+    thread = in_thread(lambda: (insert_daily(b, "2031-04-01", 20), b.commit()))
+    assert watermark(reader, "2031/04/01") == before
+    a.commit()
+    thread.join(10)
+    after_both = watermark(reader, "2031/04/01")
+    assert after_both[0] > before[0]
+    # The version of the writer that committed last is the highest
+    with reader.cursor() as cur:
+        cur.execute("""
+            SELECT report_date, version FROM data_version
+            WHERE table_name = 'daily_prod' AND report_date IN ('2031-03-01', '2031-04-01') ORDER BY report_date;
+        """)
+        (_, version_a), (_, version_b) = cur.fetchall()
+    assert version_a < version_b == after_both[0]
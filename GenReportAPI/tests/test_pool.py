@@ -0,0 +1,123 @@
+"""Tests of the connection budget shared by the pools in a PoolRegistry.
+
+The sync pool test opens connections to a scratch Postgres database:
+
+    TEST_POSTGRES_DSN="dbname=scratch user=dev host=localhost" python -m pytest tests
+"""
+import os
+import threading
+import time
+
+import psycopg2.extensions
+import pytest
+
+from app.api.pool import ConnectionPool, PoolRegistry
+
+DSN = os.environ.get("TEST_POSTGRES_DSN")
+
+
+def pool_args():
+    # ConnectionPool arguments of TEST_POSTGRES_DSN
+    params = psycopg2.extensions.parse_dsn(DSN)
+    return params["dbname"], params["user"], params.get("password"), params.get("host"), params.get("port", 5432)
+
+
+class FakeTarget:
+    # Registry entry holding one budget slot until close(), idle once its connection is returned
+    def __init__(self, registry):
+        self.registry = registry
+        self.returned = False
+        self.closed = False
+
+    def idle(self):
+        return self.returned
+
+    def shed_idle(self):
+        return False
+
+    def close(self):
+        self.closed = True
+        self.registry.release()
+
+    def stats(self):
+        return {}
+
+
+def test_waiter_evicts_a_target_that_goes_idle_without_notice():
+    registry = PoolRegistry(budget=1)
+    busy = FakeTarget(registry)
+    registry.acquire("busy", 0)
+    registry.put("busy", busy)
+
+    threading.Timer(0.2, setattr, (busy, "returned", True)).start()
+    start = time.monotonic()
+    registry.acquire("other", 5)
+    assert time.monotonic() - start < 1
+    assert busy.closed
+    assert registry.evictions == 1
+
+
+def test_lookups_do_not_wait_for_an_eviction():
+    registry = PoolRegistry(budget=1)
+    registry.acquire("busy", 0)
+
+    class SlowTarget(FakeTarget):
+        # A pool whose idle() is held up, e.g. by its own lock
+        def idle(self):
+            time.sleep(0.5)
+            return False
+
+    registry.put("busy", SlowTarget(registry))
+    registry.put("warm", FakeTarget(registry))
+    waiter = threading.Thread(target=lambda: pytest.raises(Exception, registry.acquire, "new", 0.2))
+    waiter.start()
+    time.sleep(0.1)
+    start = time.monotonic()
+    assert registry.get("warm") is not None
+    assert time.monotonic() - start < 0.1
+    waiter.join()
+
+
+@pytest.mark.skipif(not DSN, reason="TEST_POSTGRES_DSN is not set")
+def test_connection_returned_to_a_sync_pool_wakes_a_waiter():
+    args = pool_args()
+    registry = PoolRegistry(budget=1)
+    busy = ConnectionPool(*args, registry=registry)
+    registry.put("busy", busy)
+    other = ConnectionPool(*args, timeout=5, registry=registry)
+    registry.put("other", other)
+    conn = busy.getconn()
+    try:
+        threading.Timer(0.2, busy.putconn, (conn,)).start()
+        start = time.monotonic()
+        other.putconn(other.getconn())
+        # Well before the next retry of the waiter would have noticed the idle pool
+        assert time.monotonic() - start < 0.2 + 0.05
+        assert registry.evictions == 1
+    finally:
+        busy.close()
+        other.close()
+
+
+@pytest.mark.skipif(not DSN, reason="TEST_POSTGRES_DSN is not set")
+def test_maintain_closes_idle_connections_and_reopens_the_minimum():
+    args = pool_args()
+    registry = PoolRegistry(budget=10)
+    pool = ConnectionPool(*args, min_size=1, max_idle=0, registry=registry)
+    try:
+        conns = [pool.getconn() for _ in range(3)]
+        for conn in conns:
+            pool.putconn(conn)
+        pool.maintain()
+        assert pool.stats()["size"] == 1
+        # A connection dropped by the server is discarded on borrow, maintain() opens its replacement
+        conn = pool.getconn()
+        conn.close()
+        pool.putconn(conn)
+        assert pool.stats()["size"] == 0
+        pool.maintain()
+        assert pool.stats()["size"] == pool.stats()["idle"] == 1
+        assert registry.stats()["open"] == 1
+    finally:
+        pool.close()
+    assert registry.stats()["open"] == 0
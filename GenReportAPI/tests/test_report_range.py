@@ -0,0 +1,90 @@
+"""Range reports against the single-day reports, on a scratch Postgres database.
+
+They write random rows dated 2031 for the report fields and delete them afterwards:
+
+    TEST_POSTGRES_DSN="dbname=scratch user=dev host=localhost" python -m pytest tests
+"""
+import asyncio
+import os
+import random
+from datetime import date, datetime, timedelta
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import pytest
+
+from app.api.migrations import migrate
+from app.api.pgdb_async import (
+    close_all_async_pools,
+    generate_gas_report_w_latest_data_async,
+    generate_oil_report_w_latest_data_async,
+)
+from app.api.report_plan import REPORT_PLANS
+from app.api.report_range import generate_gas_report_range, generate_oil_report_range
+
+DSN = os.environ.get("TEST_POSTGRES_DSN")
+START, END = date(2031, 1, 1), date(2031, 3, 10)
+
+pytestmark = pytest.mark.skipif(not DSN, reason="TEST_POSTGRES_DSN is not set")
+
+
+def random_units(rng, decimals):
+    # Values with the stored decimals, their float sums depend on the order they are added in
+    return tuple(round(rng.uniform(0, 5000), decimals) for _ in range(4))
+
+
+@pytest.fixture(scope="module")
+def target():
+    rng = random.Random(2031)
+    daily, plan = [], []
+    for report_plan in REPORT_PLANS.values():
+        for d in (START + timedelta(days=i) for i in range((END - START).days + 1)):
+            # Some fields skip days, so rows fall back to their latest complete date
+            daily += [(field_id, d, report_plan.prod_type) + random_units(rng, 6)
+                      for field_id in report_plan.daily_field_ids if rng.random() < 0.9]
+        plan += [(field_id, date(2031, month, 1), plan_type) + random_units(rng, 9)
+                 for field_id in report_plan.plan_fields for plan_type in report_plan.plan_types for month in range(1, 13)]
+    conn = psycopg2.connect(DSN)
+    migrate(conn)
+    with conn.cursor() as cur:
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO daily_prod (field_id, report_date, prod_type, prod_ton, prod_bbls, prod_m3, prod_ft3) VALUES %s;
+        """, daily)
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO plan_prod (field_id, report_date, plan_type, prod_ton, prod_bbls, prod_m3, prod_ft3) VALUES %s;
+        """, plan)
+    conn.commit()
+    params = psycopg2.extensions.parse_dsn(DSN)
+    yield (params["dbname"], params["user"], params.get("password", ""),
+           params.get("host", "localhost"), int(params.get("port", 5432)))
+    with conn.cursor() as cur:
+        cur.execute("""
+            DELETE FROM daily_prod WHERE (field_id, report_date, prod_type) IN (SELECT * FROM unnest(%s, %s::date[], %s));
+        """, [list(column) for column in zip(*(row[:3] for row in daily))])
+        cur.execute("""
+            DELETE FROM plan_prod WHERE (field_id, report_date, plan_type) IN (SELECT * FROM unnest(%s, %s::date[], %s));
+        """, [list(column) for column in zip(*(row[:3] for row in plan))])
+    conn.commit()
+    conn.close()
+
+
+@pytest.mark.parametrize("generate_range, generate_day", [
+    (generate_oil_report_range, generate_oil_report_w_latest_data_async),
+    (generate_gas_report_range, generate_gas_report_w_latest_data_async),
+])
+def test_range_rows_equal_the_single_day_reports(target, generate_range, generate_day):
+    async def main():
+        reports = await generate_range(START.strftime("%Y/%m/%d"), END.strftime("%Y/%m/%d"), *target, formatted=False)
+        days = []
+        for report_date in reports["Ngày báo cáo"].unique():
+            query_date = datetime.strptime(report_date, "%d/%m/%Y").strftime("%Y/%m/%d")
+            days.append((report_date, await generate_day(query_date, *target, formatted=False)))
+        await close_all_async_pools()
+        return reports, days
+
+    reports, days = asyncio.run(main())
+    for report_date, day in days:
+        rows = reports[reports["Ngày báo cáo"] == report_date].drop(columns="Ngày báo cáo").reset_index(drop=True)
+        # Exactly, not approximately: the exports of both must print the same digits
+        assert rows.equals(day), report_date
@@ -0,0 +1,26 @@
+"""Request validation of the single-day report endpoints, which happens before any database work."""
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import app
+
+# Never reached: a request that got as far as connecting would fail with 500
+UNREACHABLE_TARGET = {
+    "POSTGRES_DB": "report",
+    "POSTGRES_USER": "report",
+    "POSTGRES_PASSWORD": "",
+    "HOST": "unreachable.invalid",
+    "PORT": 5432,
+}
+
+
+@pytest.mark.parametrize("path", [
+    "oilreport", "gasreport", "oilgasreport",
+    "oilreport/csv", "gasreport/ndjson",
+    "oilreport/xlsx", "gasreport/xlsx",
+])
+def test_malformed_query_date_is_rejected_with_400(path):
+    with TestClient(app) as client:
+        response = client.post(f"/report/{path}", json=dict(UNREACHABLE_TARGET, query_date="01/07/2025"))
+    assert response.status_code == 400
+    assert "%Y/%m/%d" in response.json()["detail"]